@@ -0,0 +1,396 @@
+import hashlib
+import io
+import os
+import socket
+import stat
+import sys
+import time
+from threading import Thread
+from unittest.mock import patch
+
+import pytest
+
+from wandarr import protocol
+from wandarr.agent import TAIL_BLOCK, EncoderSlots, InputCache, OutputTail, Runner, parse_slots
+from wandarr.agenthost import AgentManagedHost, AgentUpload
+from wandarr.base import RemoteHostProperties, EncodeJob
+from wandarr.dispatch import Dispatcher
+from wandarr.probecache import ProbeCache
+from .fixtures import media_info, basic_config
+
+
+def _fake_ffmpeg(tmp_path, delay=0):
+    # reports progress once and copies the input, a file or stdin, to the output, the last argument
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text('#!/bin/sh\n'
+                      'while [ $# -gt 1 ]; do if [ "$1" = "-i" ]; then in="$2"; fi; shift; done\n'
+                      'printf "frame=1\\ntotal_size=0\\nout_time_us=1000000\\nspeed=2.0x\\nprogress=end\\n"\n'
+                      f'sleep {delay}\n'
+                      'if [ "$in" = "pipe:0" ]; then cat > "$1"; else cp "$in" "$1"; fi\n')
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IEXEC)
+    return str(ffmpeg)
+
+
+def test_frames_roundtrip(tmp_path):
+    a, b = socket.socketpair()
+    with a, b:
+        protocol.send_message(a, protocol.PROGRESS, 7, time=12, speed="2.0")
+        assert protocol.recv_message(b) == (protocol.PROGRESS, 7, {"time": 12, "speed": "2.0"})
+
+        src = tmp_path / "src"
+        src.write_bytes(bytes(range(256)) * 100)
+        protocol.send_file(a, 7, str(src), offset=1000, size=5000)
+        out = io.BytesIO()
+        assert protocol.recv_file(b, 7, 5000, out) == 5000
+        assert out.getvalue()[1000:] == src.read_bytes()[1000:6000]
+
+
+def _agent_host(basic_config, tmp_path, ffmpeg, **settings):
+    props = dict(basic_config.hosts["server4"], working_dir=str(tmp_path / "agent"), ffmpeg=ffmpeg, **settings)
+    (tmp_path / "agent").mkdir(exist_ok=True)
+    d = Dispatcher()
+    host = AgentManagedHost("server4", RemoteHostProperties("server4", props), d)
+    host.video_cli = "-c:v copy"
+    return host, d
+
+
+def _run_agent_job(host, d, *jobs):
+    for job in jobs:
+        d.submit(job)
+    d.close()
+    controller, agent = socket.socketpair()
+    runner = Runner(agent, "test", 1)
+    runner.start()
+    with patch.object(host, "open_connection", return_value=controller) as connect:
+        host.testrun()
+    runner.join(timeout=10)
+    return connect
+
+
+@patch("wandarr.KEEP_SOURCE", True, create=True)
+def test_agent_job_v2(media_info, basic_config, tmp_path):
+    basic_config.templates["tv"].template["threshold"] = 0
+    src = tmp_path / "test.mp4"
+    src.write_bytes(b"media" * 100_000)
+    host, d = _agent_host(basic_config, tmp_path, _fake_ffmpeg(tmp_path))
+    job = EncodeJob(str(src), media_info, basic_config.templates["tv"])
+    assert not host.can_stream(job)
+    _run_agent_job(host, d, job)
+
+    assert job.status == "done"
+    assert job.stats["speed"] == "2.0"
+    assert (tmp_path / "test.mp4.tmp").read_bytes() == src.read_bytes()
+    # the agent cleans up its working dir
+    assert not list((tmp_path / "agent").iterdir())
+
+
+@patch("wandarr.KEEP_SOURCE", True, create=True)
+@patch("wandarr.protocol.CHUNK_SIZE", 64 * 1024)
+def test_agent_job_streamed(media_info, basic_config, tmp_path):
+    basic_config.templates["tv"].template["threshold"] = 0
+    src = tmp_path / "test.mkv"
+    src.write_bytes(os.urandom(1024 * 1024))
+    host, d = _agent_host(basic_config, tmp_path, _fake_ffmpeg(tmp_path))
+    job = EncodeJob(str(src), media_info, basic_config.templates["tv"])
+    assert host.can_stream(job)
+    _run_agent_job(host, d, job)
+
+    assert job.status == "done"
+    # ffmpeg read the source from stdin, in many DATA frames
+    assert (tmp_path / "test.mkv.tmp").read_bytes() == src.read_bytes()
+    # the agent cleans up its working dir
+    assert not list((tmp_path / "agent").iterdir())
+
+
+@patch("wandarr.KEEP_SOURCE", True, create=True)
+def test_agent_session_pipelined(media_info, basic_config, tmp_path):
+    basic_config.templates["tv"].template["threshold"] = 0
+    host, d = _agent_host(basic_config, tmp_path, _fake_ffmpeg(tmp_path, delay=0.5))
+    jobs = []
+    for n, ext in enumerate([".mp4", ".mkv", ".mp4"]):
+        src = tmp_path / f"episode{n}{ext}"
+        src.write_bytes(os.urandom(100_000))
+        jobs.append(EncodeJob(str(src), media_info, basic_config.templates["tv"]))
+
+    events = []
+    start_job, encode = Runner.start_job, Runner.encode
+
+    def record_start(runner, job_id, fields):
+        events.append(("announced", job_id))
+        start_job(runner, job_id, fields)
+
+    def record_encode(runner, job):
+        encode(runner, job)
+        events.append(("encoded", job.job_id))
+
+    with patch.object(Runner, "start_job", record_start), patch.object(Runner, "encode", record_encode):
+        connect = _run_agent_job(host, d, *jobs)
+
+    # one connection for the whole batch
+    assert connect.call_count == 1
+    for job in jobs:
+        assert job.status == "done"
+        assert open(job.in_path + ".tmp", "rb").read() == open(job.in_path, "rb").read()
+    # each next job reached the agent while the one before it was encoding
+    assert events.index(("announced", 2)) < events.index(("encoded", 1))
+    assert events.index(("announced", 3)) < events.index(("encoded", 2))
+    assert not list((tmp_path / "agent").iterdir())
+
+
+@patch("wandarr.KEEP_SOURCE", True, create=True)
+def test_agent_input_cache(media_info, basic_config, tmp_path):
+    basic_config.templates["tv"].template["threshold"] = 0
+    src = tmp_path / "test.mkv"
+    src.write_bytes(os.urandom(300_000))
+    probe_cache = ProbeCache(str(tmp_path / "probe.db"))
+    sent = []
+    send_file = protocol.send_file
+
+    def record_send(sock, job_id, path, *args, **kwargs):
+        sent.append(path)
+        return send_file(sock, job_id, path, *args, **kwargs)
+
+    with patch("wandarr.protocol.send_file", record_send), \
+            patch("wandarr.protocol.file_hash", side_effect=AssertionError("hashed ahead of the upload")):
+        # a second run over the same source, as after a crash or with another template
+        for _ in range(2):
+            host, d = _agent_host(basic_config, tmp_path, _fake_ffmpeg(tmp_path), input_cache=1)
+            host.ffmpeg.probe_cache = probe_cache
+            job = EncodeJob(str(src), media_info, basic_config.templates["tv"])
+            _run_agent_job(host, d, job)
+            assert job.status == "done"
+            assert (tmp_path / "test.mkv.tmp").read_bytes() == src.read_bytes()
+
+    # uploaded once and hashed on the way, the second job found it in the cache
+    assert sent.count(str(src)) == 1
+    digest = hashlib.sha256(src.read_bytes()).hexdigest()
+    assert probe_cache.get_hash(str(src)) == digest
+    cached = list((tmp_path / "agent" / "wandarr-cache").iterdir())
+    assert [path.name for path in cached] == [digest + ".mkv"]
+    assert [path.name for path in (tmp_path / "agent").iterdir()] == ["wandarr-cache"]
+
+
+@patch("wandarr.KEEP_SOURCE", True, create=True)
+@patch("wandarr.agent.TAIL_INTERVAL", 0.05)
+@patch("wandarr.agent.TAIL_MIN", 1)
+def test_agent_returns_output_while_encoding(media_info, basic_config, tmp_path):
+    basic_config.templates["tv"].template["threshold"] = 0
+    src = tmp_path / "test.mp4"
+    src.write_bytes(os.urandom(1_200_000))
+    # writes the output in three parts, then goes back to fill in the header as the matroska muxer does
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text(f"#!{sys.executable}\n"
+                      "import sys, time\n"
+                      "data = open(sys.argv[sys.argv.index('-i') + 1], 'rb').read()\n"
+                      "print('out_time_us=1000000\\nspeed=2.0x\\nprogress=end')\n"
+                      "with open(sys.argv[-1], 'wb') as out:\n"
+                      "    for n in range(3):\n"
+                      "        out.write(data[n * 400000:(n + 1) * 400000])\n"
+                      "        out.flush()\n"
+                      "        time.sleep(0.3)\n"
+                      "    out.seek(0)\n"
+                      "    out.write(b'HEADER')\n")
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IEXEC)
+    host, d = _agent_host(basic_config, tmp_path, str(ffmpeg))
+    host.video_cli = "-c:v copy -f matroska"
+    job = EncodeJob(str(src), media_info, basic_config.templates["tv"])
+
+    left = []
+    remaining = OutputTail.remaining
+
+    def record_remaining(tail):
+        left.extend(remaining(tail))
+        return left
+
+    with patch.object(OutputTail, "remaining", record_remaining):
+        _run_agent_job(host, d, job)
+
+    assert job.status == "done"
+    assert (tmp_path / "test.mp4.tmp").read_bytes() == b"HEADER" + src.read_bytes()[6:]
+    # only the rewritten header and what came after the last look were left for the end
+    assert left[0] == (0, TAIL_BLOCK)
+    assert sum(length for _, length in left) < 1_200_000
+
+
+def test_input_cache_evicts_least_recently_used(tmp_path):
+    cache = InputCache()
+    paths = []
+    for n in range(3):
+        received = tmp_path / f"upload{n}"
+        received.write_bytes(b"x" * 1000)
+        paths.append(cache.store(str(received), str(tmp_path), f"hash{n}", ".mkv", quota=2500))
+        os.utime(paths[-1], (n, n))
+        cache.release(paths[-1])
+    # the oldest went once the third was added, a cached source in use is kept
+    assert not os.path.exists(paths[0])
+    assert cache.lookup(str(tmp_path), "hash1", ".mkv") == paths[1]
+    received = tmp_path / "upload3"
+    received.write_bytes(b"x" * 1000)
+    cache.store(str(received), str(tmp_path), "hash3", ".mkv", quota=2500)
+    assert os.path.exists(paths[1])
+    assert not os.path.exists(paths[2])
+
+
+def test_parse_slots():
+    assert parse_slots("nvenc=2, libx265=1,*=4") == {"nvenc": 2, "libx265": 1, "*": 4}
+    for bad in ("nvenc", "nvenc=0", "=2", "nvenc=two"):
+        with pytest.raises(ValueError):
+            parse_slots(bad)
+
+
+def test_encoder_slots_queue():
+    slots = EncoderSlots({"nvenc": 1, "*": 2})
+    assert slots.key(["ffmpeg", "-i", "{FILENAME}", "-c:v", "hevc_nvenc"]) == "nvenc"
+    assert slots.key(["ffmpeg", "-c:v", "libx265"]) == "*"
+    assert slots.key(["ffmpeg", "-c:v", "copy"]) == "*"
+    assert slots.acquire("nvenc")
+
+    reports, results = [], []
+    waiter = Thread(target=lambda: results.append(slots.acquire("nvenc", reports.append)))
+    waiter.start()
+    cancelled = []
+    second = Thread(target=lambda: results.append(slots.acquire("nvenc", reports.append, lambda: bool(cancelled))))
+    second.start()
+    deadline = time.monotonic() + 5
+    while sorted(reports) != [1, 2] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(reports) == [1, 2]
+    # other encoders are not held up
+    assert slots.acquire("*")
+
+    cancelled.append(True)
+    slots.wake()
+    second.join(timeout=5)
+    assert results == [False]
+    slots.release("nvenc")
+    waiter.join(timeout=5)
+    assert results == [False, True]
+
+
+def test_agent_host_shows_queue_position(media_info, basic_config, tmp_path):
+    host, _ = _agent_host(basic_config, tmp_path, "/usr/bin/ffmpeg")
+    job = EncodeJob(str(tmp_path / "test.mkv"), media_info, basic_config.templates["tv"])
+    upload = AgentUpload(job, 4, [], False)
+    controller, agent = socket.socketpair()
+    with controller, agent:
+        protocol.send_message(agent, protocol.QUEUED, 4, position=2)
+        protocol.send_message(agent, protocol.DONE, 4, code=0, size=10)
+        with patch("wandarr.status_queue") as status:
+            assert host.monitor_v2(controller, upload, lambda stats: False) == (protocol.DONE, {"code": 0, "size": 10})
+    assert status.put.call_args.args[0]["status"] == "Queued (2)"
+
+
+@patch("wandarr.protocol.CHUNK_SIZE", 64 * 1024)
+def test_agent_job_ffmpeg_does_not_start(media_info, basic_config, tmp_path):
+    host, d = _agent_host(basic_config, tmp_path, str(tmp_path / "missing-ffmpeg"))
+    jobs = []
+    for n in range(2):
+        src = tmp_path / f"episode{n}.mkv"
+        src.write_bytes(os.urandom(2 * 1024 * 1024))
+        jobs.append(EncodeJob(str(src), media_info, basic_config.templates["tv"]))
+        d.submit(jobs[-1])
+    d.close()
+
+    controller, agent = socket.socketpair()
+    runner = Runner(agent, "test", 1)
+    runner.start()
+    started = time.monotonic()
+    with patch.object(host, "open_connection", return_value=controller):
+        host.testrun()
+    runner.join(timeout=10)
+
+    # each job fails with the reason, and the session ends with the controller's
+    assert [job.status for job in jobs] == ["failed", "failed"]
+    assert "missing-ffmpeg" in open(host.ffmpeg.log_path, encoding="utf8").read()
+    assert time.monotonic() - started < 10
+    assert not runner.is_alive()
+    assert not list((tmp_path / "agent").iterdir())
+
+
+def test_agent_falls_back_to_v1(media_info, basic_config, tmp_path):
+    src = tmp_path / "test.mkv"
+    src.write_bytes(b"media")
+    host, d = _agent_host(basic_config, tmp_path, "/usr/bin/ffmpeg")
+    job = EncodeJob(str(src), media_info, basic_config.templates["tv"])
+
+    # an agent from before version 2 closes the connection on an opening it does not know
+    controller, agent = socket.socketpair()
+    legacy = Thread(target=lambda: agent.recv(2048) and agent.close())
+    legacy.start()
+    with patch.object(host, "open_connection", return_value=controller):
+        assert not host.encode_v2(job, ["/usr/bin/ffmpeg"], {}, None)
+    legacy.join()
+    assert host.protocol == 1
+
+
+def test_agent_answers_v1_ping():
+    controller, agent = socket.socketpair()
+    runner = Runner(agent, "test", 1)
+    runner.start()
+    controller.send(b"PING")
+    assert controller.recv(4) == b"PONG"
+    runner.join(timeout=5)
+    controller.close()
+
+
+# a regression to copying through small user space buffers falls far below this on loopback
+MIN_LOOPBACK_MB_S = 100
+
+
+def test_transfer_throughput(tmp_path):
+    size = 128 * 1024 * 1024
+    src = tmp_path / "src.bin"
+    with open(src, "wb") as f:
+        f.write(os.urandom(1024 * 1024) * (size // (1024 * 1024)))
+    dest = tmp_path / "dest.bin"
+
+    listener = socket.socket()
+    protocol.tune_socket(listener)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    def receive():
+        conn, _ = listener.accept()
+        with conn, open(dest, "wb") as out:
+            protocol.recv_file(conn, 1, size, out)
+
+    receiver = Thread(target=receive)
+    receiver.start()
+    sender = socket.socket()
+    protocol.tune_socket(sender)
+    sender.connect(listener.getsockname())
+    started = time.perf_counter()
+    with sender:
+        protocol.send_file(sender, 1, str(src))
+    receiver.join(timeout=60)
+    elapsed = time.perf_counter() - started
+    listener.close()
+
+    mb_s = size / (1024 * 1024) / elapsed
+    print(f"loopback transfer: {mb_s:.0f} MB/s")
+    assert dest.stat().st_size == size
+    assert mb_s > MIN_LOOPBACK_MB_S
+
+
+def test_agent_reports_capabilities(basic_config, tmp_path):
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text('#!/bin/sh\n'
+                      'case "$2" in\n'
+                      '  -version) echo "ffmpeg version 6.1.1 Copyright";;\n'
+                      '  -encoders) echo " V....D hevc_nvenc  NVIDIA NVENC hevc encoder";;\n'
+                      '  -hwaccels) printf "Hardware acceleration methods:\\ncuda\\n";;\n'
+                      'esac\n')
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IEXEC)
+    host, _ = _agent_host(basic_config, tmp_path, str(ffmpeg))
+
+    controller, agent = socket.socketpair()
+    runner = Runner(agent, "test", 1)
+    runner.start()
+    with patch.object(host, "open_connection", return_value=controller):
+        caps = host.discover()
+    runner.join(timeout=10)
+
+    assert caps.version == "6.1.1"
+    assert caps.encoders == ["hevc_nvenc"]
+    assert caps.hwaccels == ["cuda"]
+    assert caps.free_space > 0
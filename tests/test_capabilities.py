@@ -0,0 +1,111 @@
+import stat
+import time
+from unittest.mock import patch
+
+from wandarr.capabilities import (SECTION, Capabilities, CapabilityCache, local_capabilities, parse_report,
+                                  video_encoder)
+from wandarr.cluster import Cluster
+from wandarr.base import EncodeJob
+
+from .fixtures import basic_config, media_info
+
+VERSION = "ffmpeg version 6.1.1 Copyright (c) 2000-2023 the FFmpeg developers\nbuilt with gcc 13\n"
+ENCODERS = ("Encoders:\n"
+            " V..... = Video\n"
+            " A..... = Audio\n"
+            " ------\n"
+            " V....D libx264              libx264 H.264 / AVC / MPEG-4 AVC\n"
+            " V....D hevc_nvenc           NVIDIA NVENC hevc encoder (codec hevc)\n"
+            " A....D aac                  AAC (Advanced Audio Coding)\n")
+HWACCELS = "Hardware acceleration methods:\ncuda\nvaapi\n\n"
+
+
+def fake_ffmpeg(tmp_path):
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text('#!/bin/sh\n'
+                      'case "$2" in\n'
+                      f'  -version) printf "%s" "{VERSION}";;\n'
+                      f'  -encoders) printf "%s" "{ENCODERS}";;\n'
+                      f'  -hwaccels) printf "%s" "{HWACCELS}";;\n'
+                      'esac\n')
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IEXEC)
+    return str(ffmpeg)
+
+
+def test_parse_report():
+    df = "Filesystem 1024-blocks Used Available Capacity Mounted on\n/dev/sda1 1000 500 2048 50% /\n"
+    output = f"\n{SECTION}\n".join([VERSION, ENCODERS, HWACCELS, "8", df.splitlines()[1]])
+    caps = parse_report(output)
+
+    assert caps.version == "6.1.1"
+    assert caps.encoders == ["libx264", "hevc_nvenc"]
+    assert caps.hwaccels == ["cuda", "vaapi"]
+    assert caps.cores == 8
+    assert caps.free_space == 2048 * 1024
+
+    # a host without ffmpeg
+    assert parse_report(f"sh: ffmpeg: not found\n{SECTION}\n{SECTION}\n") is None
+
+
+def test_local_capabilities(tmp_path):
+    caps = local_capabilities(fake_ffmpeg(tmp_path), str(tmp_path))
+    assert caps.version == "6.1.1"
+    assert "hevc_nvenc" in caps.encoders
+    assert caps.free_space > 0
+
+    assert local_capabilities(str(tmp_path / "missing")) is None
+
+
+def test_check():
+    caps = Capabilities("6.1.1", ["libx264", "hevc_nvenc"], ["cuda"])
+    assert video_encoder("-c:v hevc_qsv -preset medium".split()) == "hevc_qsv"
+    assert caps.check("-c:v hevc_qsv -preset medium".split()) == "ffmpeg 6.1.1 has no hevc_qsv encoder"
+    assert caps.check("-c:v hevc_nvenc -preset medium".split()) is None
+    assert caps.check("-c:v copy -f matroska".split()) is None
+    assert caps.check([], ["-hwaccel", "qsv"]) == "ffmpeg 6.1.1 has no qsv hwaccel"
+    assert caps.check([], ["-hwaccel", "cuda"]) is None
+    # encoders could not be read, nothing is ruled out
+    assert Capabilities().check("-c:v hevc_qsv".split()) is None
+
+
+def test_cache_expires(tmp_path):
+    cache = CapabilityCache(str(tmp_path / "capabilities.db"), ttl=60)
+    cache.put("server", Capabilities("6.1.1", ["libx264"], free_space=1000))
+    assert cache.get("server").encoders == ["libx264"]
+    assert cache.get("other") is None
+
+    with patch("time.time", return_value=time.time() + 3600):
+        assert cache.get("server") is None
+
+
+def test_free_space_not_trusted_for_long(tmp_path):
+    cache = CapabilityCache(str(tmp_path / "capabilities.db"), ttl=86400)
+    cache.put("server", Capabilities("6.1.1", ["libx264"], free_space=1000, probed_at=time.time() - 3600))
+    caps = cache.get("server")
+    assert caps.encoders == ["libx264"]
+    assert caps.free_space is None
+
+
+@patch("wandarr.agenthost.AgentManagedHost.host_ok", return_value=True)
+@patch("wandarr.base.ManagedHost.host_ok", return_value=True)
+def test_cluster_skips_unsupported_engines(remote_host_ok_mock, agent_host_ok_mock, basic_config, media_info):
+    basic_config.settings["capability_ttl"] = 0
+    nvenc_only = Capabilities("6.1.1", ["libx264", "hevc_nvenc"], ["cuda"], free_space=10 * 1024 ** 3)
+
+    def discover(host):
+        return nvenc_only if host.hostname == "server3" else None
+
+    with patch("wandarr.base.ManagedHost.discover", discover), \
+            patch("wandarr.localhost.LocalHost.discover", discover), \
+            patch("wandarr.agenthost.AgentManagedHost.discover", discover):
+        c = Cluster(basic_config)
+
+    # server3 has no hevc_qsv, the only encoder of its qsv engine
+    assert sorted(host.hostname for host in c.hosts) == ["server2", "server4", "workstation"]
+
+    c.hosts[0].capabilities = Capabilities("6.1.1", ["hevc_qsv"], free_space=1024)
+    c.hosts[0].stages_sources = True
+    job = EncodeJob("/tmp/test.mkv", media_info, basic_config.templates["tv"])
+    assert not c.hosts[0].can_encode(job)
+    c.hosts[0].capabilities.free_space = None
+    assert c.hosts[0].can_encode(job)
@@ -1,3 +1,4 @@
+import time
 from unittest.mock import patch
 
 from wandarr.cluster import Cluster
@@ -19,6 +20,45 @@ def test_cluster_setup(remote_host_ok_mock, agent_host_ok_mock, basic_config, me
         ffmpeg.return_value = media_info
 
         c.enqueue("/tmp/test.mkv", "tv")
-        assert c.queues["medium"].qsize() == 1
+        assert c.dispatcher.pending_count() == 1
 
 
+
+@patch("wandarr.agenthost.AgentManagedHost.host_ok", return_value=True)
+@patch("wandarr.base.ManagedHost.host_ok", return_value=True)
+def test_enqueue_all_preserves_order(remote_host_ok_mock, agent_host_ok_mock, basic_config, media_info):
+    basic_config.settings["probe_workers"] = 4
+    c = Cluster(basic_config)
+
+    files = [f"/tmp/test{n}.mkv" for n in range(8)]
+
+    def slow_first(path):
+        # earlier files finish probing last
+        time.sleep((8 - int(path[9])) * 0.01)
+        return media_info
+
+    with patch("wandarr.ffmpeg.FFmpeg.fetch_details", side_effect=slow_first):
+        jobs = c.enqueue_all(files, "tv")
+
+    assert [job.in_path for job in jobs] == files
+    assert c.dispatcher.pending_count() == 8
+
+
+def test_check_hosts_concurrently_with_deadline():
+    class Probe:
+        def __init__(self, delay, ok=True):
+            self.delay = delay
+            self.ok = ok
+
+        def host_ok(self):
+            time.sleep(self.delay)
+            return self.ok
+
+    probes = [("fast", Probe(0.1)), ("slow", Probe(0.2)), ("down", Probe(0.1, ok=False)), ("hung", Probe(5))]
+    started = time.monotonic()
+    status = Cluster.check_hosts(probes, timeout=0.5)
+
+    assert time.monotonic() - started < 1
+    assert status["fast"][0] and status["slow"][0]
+    assert not status["down"][0]
+    assert status["hung"] == (False, 0.5)
@@ -0,0 +1,344 @@
+from threading import Thread
+from types import SimpleNamespace
+
+import pytest
+
+from wandarr.base import EncodeJob
+from wandarr.dispatch import Dispatcher
+from wandarr.history import SpeedHistory
+
+
+class FakeTemplate:
+    def __init__(self, quality):
+        self.quality = quality
+
+    def video_select(self):
+        return self.quality
+
+
+class FakeJob(EncodeJob):
+    def __init__(self, name, quality="medium", runtime=60, size=100, height=1080, vcodec="h264"):
+        media_info = SimpleNamespace(runtime=runtime, filesize_mb=size, res_width=height * 16 // 9,
+                                     res_height=height, fps=24, vcodec=vcodec)
+        super().__init__(f"/tmp/{name}.mkv", media_info, FakeTemplate(quality))
+        self.name = name
+
+
+class FakeSlot:
+    def __init__(self, hostname, qualities, engine_name="qsv"):
+        self.hostname = hostname
+        self.qualities = qualities
+        self.engine_name = engine_name
+        self.terminated = 0
+
+    def terminate(self):
+        self.terminated += 1
+
+    def can_encode(self, job):
+        return job.template.video_select() in self.qualities
+
+
+def test_next_job_blocks_until_closed():
+    d = Dispatcher()
+    received = []
+
+    def consumer(slot):
+        while (job := d.next_job(slot)) is not None:
+            received.append(job.name)
+            d.task_done(slot, job)
+
+    slots = [FakeSlot(f"host{n}", {"medium": ""}) for n in range(3)]
+    threads = [Thread(target=consumer, args=(slot,)) for slot in slots]
+    for t in threads:
+        t.start()
+
+    for n in range(10):
+        d.submit(FakeJob(n))
+    d.close()
+
+    for t in threads:
+        t.join(timeout=5)
+        assert not t.is_alive()
+    assert sorted(received) == list(range(10))
+    assert d.pending_count() == 0
+
+
+def test_slot_only_gets_supported_quality():
+    d = Dispatcher()
+    slot = FakeSlot("host", {"high": ""})
+    d.add_slot(slot)
+    d.submit(FakeJob("a", "medium"))
+    d.submit(FakeJob("b", "high"))
+    d.close()
+
+    assert d.qualities == {"high"}
+    assert d.next_job(slot).name == "b"
+    assert d.next_job(slot) is None
+    assert d.pending_count() == 1
+
+
+def test_max_jobs_per_host():
+    d = Dispatcher()
+    qsv = FakeSlot("host", {"medium": ""})
+    cuda = FakeSlot("host", {"medium": ""})
+    d.set_max_jobs("host", 1)
+    d.submit(FakeJob("a"))
+    d.submit(FakeJob("b"))
+    d.close()
+
+    job = d.next_job(qsv)
+    assert d.running_count("host") == 1
+
+    second = []
+    t = Thread(target=lambda: second.append(d.next_job(cuda)))
+    t.start()
+    t.join(timeout=0.2)
+    assert t.is_alive()   # waiting for the host to free up
+
+    d.task_done(qsv, job)
+    t.join(timeout=5)
+    assert second[0].name == "b"
+
+
+@pytest.mark.parametrize("order,expected", [
+    ("fifo", ["short", "4k", "big", "hevc"]),
+    ("longest-first", ["4k", "big", "hevc", "short"]),
+    ("smallest-first", ["short", "4k", "big", "hevc"]),
+    ("savings-first", ["big", "hevc", "4k", "short"]),
+])
+def test_order_policies(order, expected):
+    d = Dispatcher(order)
+    slot = FakeSlot("host", {"medium": ""})
+    d.submit(FakeJob("short", runtime=600, size=200))
+    d.submit(FakeJob("4k", runtime=3600, size=1000, height=2160))
+    d.submit(FakeJob("big", runtime=3000, size=3000))
+    d.submit(FakeJob("hevc", runtime=3000, size=4000, vcodec="hevc"))
+    d.close()
+
+    names = []
+    while (job := d.next_job(slot)) is not None:
+        names.append(job.name)
+        d.task_done(slot, job)
+    assert names == expected
+
+
+def test_job_left_for_faster_host():
+    history = SpeedHistory(":memory:")
+    d = Dispatcher()
+    d.history = history
+    fast = FakeSlot("gpu", {"medium": ""})
+    slow = FakeSlot("cpu", {"medium": ""})
+    fast.engine_name = "cuda"
+    slow.engine_name = "cpu"
+
+    media = SimpleNamespace(runtime=3600, filesize_mb=1000, res_width=1920, res_height=1080, fps=24, vcodec="h264")
+    history.record("gpu", "cuda", "medium", media, 10.0)
+    history.record("cpu", "cpu", "medium", media, 1.0)
+
+    first = EncodeJob("/tmp/a.mkv", media, FakeTemplate("medium"))
+    second = EncodeJob("/tmp/b.mkv", media, FakeTemplate("medium"))
+    d.submit(first)
+    assert d.next_job(fast) is first
+    # the fast host is nearly done with its current job
+    first.stats = {"time": 3000, "speed": "10.0"}
+
+    d.submit(second)
+    d.close()
+    taken = []
+    t = Thread(target=lambda: taken.append(d.next_job(slow)))
+    t.start()
+    t.join(timeout=0.2)
+    assert t.is_alive()     # slow host passes on the job
+
+    d.task_done(fast, first)
+    assert d.next_job(fast) is second
+    d.task_done(fast, second)
+    t.join(timeout=5)
+    assert taken == [None]
+    assert history.expected_speed("gpu", "cuda", "medium", media) == 10.0
+
+
+def test_slower_host_takes_work_from_backlog():
+    history = SpeedHistory(":memory:")
+    d = Dispatcher()
+    d.history = history
+    fast = FakeSlot("gpu", {"medium": ""}, engine_name="cuda")
+    slow = FakeSlot("cpu", {"medium": ""}, engine_name="cpu")
+
+    media = SimpleNamespace(runtime=3600, filesize_mb=1000, res_width=1920, res_height=1080, fps=24, vcodec="h264")
+    history.record("gpu", "cuda", "medium", media, 3.0)
+    history.record("cpu", "cpu", "medium", media, 1.0)
+
+    jobs = [EncodeJob(f"/tmp/{n}.mkv", media, FakeTemplate("medium")) for n in range(20)]
+    for job in jobs:
+        d.submit(job)
+    d.close()
+    assert d.next_job(fast) is jobs[0]
+    jobs[0].stats = {"time": 0, "speed": "3.0"}
+
+    # the fast host would get to the first pending job sooner, but not to all of them
+    taken = []
+    t = Thread(target=lambda: taken.append(d.next_job(slow)), daemon=True)
+    t.start()
+    t.join(timeout=5)
+    assert taken == [jobs[2]]
+    assert d.pending_count() == 18
+
+
+def test_failed_job_moves_to_another_host():
+    d = Dispatcher()
+    d.max_attempts = 2
+    d.retry_backoff = 0
+    a = FakeSlot("a", {"medium": ""})
+    b = FakeSlot("b", {"medium": ""})
+    d.submit(FakeJob("x"))
+    d.close()
+
+    job = d.next_job(a)
+    taken = []
+    t = Thread(target=lambda: taken.append(d.next_job(b)))
+    t.start()       # b is now waiting for work
+
+    job.status = "failed"
+    d.task_done(a, job)
+    t.join(timeout=5)
+    assert taken == [job]
+    assert job.attempts == 2
+
+    # a is not handed its own failure back, and the retry budget is spent
+    job.status = "failed"
+    d.task_done(b, job)
+    assert d.next_job(a) is None
+    assert d.pending_count() == 0
+
+
+def test_retry_on_same_host_after_backoff():
+    d = Dispatcher()
+    d.max_attempts = 3
+    d.retry_backoff = 0.1
+    a = FakeSlot("a", {"medium": ""})
+    d.submit(FakeJob("x"))
+    d.close()
+
+    job = d.next_job(a)
+    job.status = "failed"
+    d.task_done(a, job)
+    assert job.not_before > 0
+    assert d.next_job(a) is job     # waits out the backoff, no other host can take it
+
+
+def test_host_excluded_after_repeated_failures():
+    d = Dispatcher()
+    d.host_failure_limit = 2
+    a = FakeSlot("a", {"medium": ""})
+    for name in ("x", "y", "z"):
+        d.submit(FakeJob(name))
+    d.close()
+
+    for _ in range(2):
+        job = d.next_job(a)
+        job.status = "failed"
+        d.task_done(a, job)
+    assert d.next_job(a) is None
+    assert d.pending_count() == 1
+
+
+def test_straggler_copied_to_idle_faster_host():
+    history = SpeedHistory(":memory:")
+    d = Dispatcher()
+    d.history = history
+    d.speculate = True
+    slow = FakeSlot("cpu", {"medium": ""}, engine_name="cpu")
+    fast = FakeSlot("gpu", {"medium": ""}, engine_name="cuda")
+    job = FakeJob("x", runtime=3600)
+    history.record("gpu", "cuda", "medium", job.media_info, 10.0)
+
+    d.submit(job)
+    d.close()
+    assert d.next_job(slow) is job
+    job.stats = {"time": 600, "speed": "0.5"}
+
+    copy = d.next_job(fast)
+    assert copy is not job and copy.twin is job and job.twin is copy
+    assert copy.tmp_name("/tmp/x.mkv") == "/tmp/x.mkv.gpu.tmp"
+
+    # the copy finishes first, the original is stopped and not retried
+    assert d.claim(fast, copy)
+    assert slow.terminated == 1
+    copy.status = "done"
+    assert d.task_done(fast, copy)
+    assert not d.claim(slow, job)
+    job.status = "failed"
+    assert not d.task_done(slow, job)
+    assert d.next_job(slow) is None
+    assert d.pending_count() == 0
+
+
+def test_no_copy_without_gain():
+    history = SpeedHistory(":memory:")
+    d = Dispatcher()
+    d.history = history
+    d.speculate = True
+    d.REEVALUATE_SECS = 0.05
+    running = FakeSlot("a", {"medium": ""})
+    idle = FakeSlot("b", {"medium": ""})
+    job = FakeJob("x", runtime=3600)
+    history.record("b", "qsv", "medium", job.media_info, 1.0)
+
+    d.submit(job)
+    d.close()
+    d.next_job(running)
+    job.stats = {"time": 3000, "speed": "2.0"}
+
+    taken = []
+    t = Thread(target=lambda: taken.append(d.next_job(idle)))
+    t.start()
+    t.join(timeout=0.2)
+    assert t.is_alive()
+    job.status = "done"
+    d.task_done(running, job)
+    t.join(timeout=5)
+    assert taken == [None]
+
+
+def test_reserved_job_returned_to_its_slot():
+    d = Dispatcher()
+    a = FakeSlot("a", {"medium": ""})
+    for name in ("x", "y"):
+        d.submit(FakeJob(name))
+    d.close()
+
+    first = d.next_job(a)
+    reserved = d.reserve(a)
+    assert reserved.name == "y" and reserved.status == "queued"
+    assert d.pending_count() == 0
+
+    # a's encoder is free while it finishes the first job in the background
+    d.detach(a, first)
+    assert d.running_count("a") == 0
+    assert d.next_job(a) is reserved
+    first.status = "done"
+    assert d.task_done(a, first)
+    reserved.status = "done"
+    assert d.task_done(a, reserved)
+    assert d.running_count("a") == 0
+    assert d.next_job(a) is None
+
+
+def test_reserved_job_kept_when_speculating():
+    d = Dispatcher()
+    d.speculate = True
+    a = FakeSlot("a", {"medium": ""})
+    for name in ("x", "y"):
+        d.submit(FakeJob(name))
+    d.close()
+
+    first = d.next_job(a)
+    reserved = d.reserve(a)
+    first.status = "done"
+    assert d.task_done(a, first)
+    # nothing is pending at the end of the batch, but the reserved job still runs
+    assert d.next_job(a) is reserved
+    reserved.status = "done"
+    assert d.task_done(a, reserved)
+    assert d.next_job(a) is None
@@ -0,0 +1,98 @@
+from threading import Thread
+from types import SimpleNamespace
+
+from wandarr.dispatch import Dispatcher
+from wandarr.health import HealthMonitor
+from .test_dispatch import FakeJob, FakeSlot
+
+
+class FakeHost(FakeSlot):
+    def __init__(self, hostname, host_type="mounted"):
+        super().__init__(hostname, {"medium": ""})
+        self.props = SimpleNamespace(host_type=host_type)
+        self.healthy = True
+        self.terminated = 0
+
+    def host_ok(self):
+        return self.healthy
+
+    def terminate(self):
+        self.terminated += 1
+
+    def log(self, message, style=None):
+        pass
+
+
+def test_host_down_reclaims_running_job():
+    d = Dispatcher()
+    down, other = FakeSlot("down", {"medium": ""}), FakeSlot("other", {"medium": ""})
+    d.submit(FakeJob("a"))
+    job = d.next_job(down)
+
+    assert d.host_down("down") == [down]
+    assert d.pending_count() == 1
+    assert d.running_count("down") == 0
+
+    # the aborted run reporting back must not count as a failure or finish the job
+    job.status = "failed"
+    d.task_done(down, job)
+    assert d.pending_count() == 1
+
+    retry = d.next_job(other)
+    assert retry.name == "a" and retry is not job
+    assert retry.status == "running"
+
+
+def test_late_result_of_reclaimed_job_discarded():
+    d = Dispatcher()
+    down, other = FakeSlot("down", {"medium": ""}), FakeSlot("other", {"medium": ""})
+    d.submit(FakeJob("a"))
+    job = d.next_job(down)
+    d.host_down("down")
+
+    # the encode exited cleanly just before it was aborted, the queued copy owns the source now
+    assert not d.claim(down, job)
+    retry = d.next_job(other)
+    assert d.claim(other, retry)
+
+
+def test_down_host_gets_no_work_until_up():
+    d = Dispatcher()
+    d.REEVALUATE_SECS = 0.05
+    slot = FakeSlot("flaky", {"medium": ""})
+    d.host_down("flaky")
+    d.submit(FakeJob("a"))
+    d.close()
+
+    received = []
+    t = Thread(target=lambda: received.append(d.next_job(slot)))
+    t.start()
+    t.join(timeout=0.3)
+    assert t.is_alive() and not received
+
+    d.host_up("flaky")
+    t.join(timeout=5)
+    assert received[0].name == "a"
+
+
+def test_monitor_trips_after_consecutive_failures():
+    d = Dispatcher()
+    hosts = [FakeHost("remote"), FakeHost("remote"), FakeHost("localhost", host_type="local")]
+    monitor = HealthMonitor(d, hosts, interval=60, failures_to_trip=2)
+    assert list(monitor.probes) == ["remote"]
+
+    d.submit(FakeJob("a"))
+    d.next_job(hosts[1])
+    hosts[0].healthy = False
+
+    monitor.check_all()
+    assert "remote" not in monitor.down
+    monitor.check_all()
+    assert "remote" in monitor.down
+    assert hosts[1].terminated == 1
+    assert d.pending_count() == 1
+
+    hosts[0].healthy = True
+    monitor.check_all()
+    assert "remote" not in monitor.down
+    assert d.next_job(hosts[0]).name == "a"
@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+
+from wandarr.history import SpeedHistory, resolution_class
+
+
+def _media(vcodec="h264", height=1080):
+    return SimpleNamespace(vcodec=vcodec, res_height=height)
+
+
+def test_resolution_class():
+    assert resolution_class(576) == 720
+    assert resolution_class(1080) == 1080
+    assert resolution_class(1608) == 2160
+
+
+def test_moving_average_and_persistence(tmp_path):
+    path = str(tmp_path / "history.db")
+    history = SpeedHistory(path)
+    history.record("server", "qsv", "medium", _media(), 2.0)
+    history.record("server", "qsv", "medium", _media(), 4.0)
+    assert history.expected_speed("server", "qsv", "medium", _media()) == 2.0 * 0.7 + 4.0 * 0.3
+    history.close()
+
+    reopened = SpeedHistory(path)
+    assert reopened.expected_speed("server", "qsv", "medium", _media()) == 2.0 * 0.7 + 4.0 * 0.3
+
+
+def test_fallback_to_related_samples():
+    history = SpeedHistory(":memory:")
+    history.record("server", "qsv", "medium", _media("h264", 1080), 3.0)
+    history.record("server", "qsv", "medium", _media("mpeg2video", 480), 5.0)
+
+    assert history.expected_speed("server", "qsv", "medium", _media("vc1", 720)) == 4.0
+    assert history.expected_speed("server", "cuda", "medium", _media()) is None
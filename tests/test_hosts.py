@@ -1,11 +1,13 @@
-from queue import Queue
-from threading import Thread
-from unittest.mock import patch
+import os
+from concurrent.futures import Future
+from threading import Event, Thread
+from unittest.mock import MagicMock, patch
 
 import pytest
 
 from wandarr.agenthost import AgentManagedHost
 from wandarr.base import RemoteHostProperties, EncodeJob
+from wandarr.dispatch import Dispatcher
 from wandarr.localhost import LocalHost
 from wandarr.mountedhost import MountedManagedHost
 from wandarr.streaminghost import StreamingManagedHost
@@ -27,14 +29,15 @@ def test_localhost_job(rename_mock, remove_mock, ffmpeg_mock, getsize_mock, medi
     config = basic_config
     props = config.hosts["workstation"]
     host_props = RemoteHostProperties("workstation", props)
-    q = Queue()
+    q = Dispatcher()
     mi = media_info
 
     # deactivate threshold check
     config.templates["tv"].template["threshold"] = 0
 
     job = EncodeJob("/tmp/test.mkv", mi, config.templates["tv"])
-    q.put(job)
+    q.submit(job)
+    q.close()
 
     host = LocalHost("workstation", host_props, q)
 
@@ -44,7 +47,7 @@ def test_localhost_job(rename_mock, remove_mock, ffmpeg_mock, getsize_mock, medi
     if ffmpeg_return == 0:
         assert remove_mock.call_args.args[0] == "/tmp/test.mkv"
         assert rename_mock.call_args.args == ("/tmp/test.mkv.tmp", "/tmp/test.mkv")
-    assert q.empty() is True
+    assert q.pending_count() == 0
 
 
 @pytest.mark.parametrize("ffmpeg_return", [0, -1])
@@ -60,14 +63,15 @@ def test_mountedhost_job(rename_mock, remove_mock, ffmpeg_mock, getsize_mock, me
     config = basic_config
     props = config.hosts["server"]
     host_props = RemoteHostProperties("server", props)
-    q = Queue()
+    q = Dispatcher()
     mi = media_info
 
     # "fix" the template to not think threshold was met
     config.templates["tv"].template["threshold"] = 0
 
     job = EncodeJob("/Volumes/media/test.mkv", mi, config.templates["tv"])
-    q.put(job)
+    q.submit(job)
+    q.close()
 
     host = MountedManagedHost("server", host_props, q)
 
@@ -77,7 +81,7 @@ def test_mountedhost_job(rename_mock, remove_mock, ffmpeg_mock, getsize_mock, me
     if ffmpeg_return == 0:
         assert remove_mock.call_args.args[0] == "/Volumes/media/test.mkv"
         assert rename_mock.call_args.args == ("/Volumes/media/test.mkv.tmp", "/Volumes/media/test.mkv")
-        assert q.empty() is True
+        assert q.pending_count() == 0
     else:
         assert remove_mock.call_args.args[0] == "/Volumes/media/test.mkv.tmp"
 
@@ -103,14 +107,15 @@ def test_streaming_job(run_process_mock, move_mock, run_mock, rename_mock, remov
     config = basic_config
     props = config.hosts["server"]
     host_props = RemoteHostProperties("server", props)
-    q = Queue()
+    q = Dispatcher()
     mi = media_info
 
     # "fix" the template to not think threshold was met
     config.templates["tv"].template["threshold"] = 0
 
     job = EncodeJob("/tmp/test.mkv", mi, config.templates["tv"])
-    q.put(job)
+    q.submit(job)
+    q.close()
 
     host = StreamingManagedHost("server", host_props, q)
 
@@ -119,7 +124,7 @@ def test_streaming_job(run_process_mock, move_mock, run_mock, rename_mock, remov
 
     assert run_process_mock.call_args.args[0] == ["/usr/bin/ssh", "me@192.168.1.100", '"rm /tmp/test.mkv.tmp"']
     assert len(run_mock.call_args) == 2
-    assert q.empty() is True
+    assert q.pending_count() == 0
 
 
 @patch("os.path.getsize")
@@ -132,7 +137,8 @@ def test_streaming_job(run_process_mock, move_mock, run_mock, rename_mock, remov
 @patch("wandarr.agenthost.AgentManagedHost.sendfile", return_value=True)
 @patch("wandarr.agenthost.AgentManagedHost.recvfile", return_value=True)
 @patch("wandarr.agenthost.AgentManagedHost.ack", return_value=True)
-def test_agent_job(ack_mock, recv_mock, send_mock, handshake_mock, connect_mock,
+@patch("wandarr.agenthost.AgentManagedHost.encode_v2", return_value=False)
+def test_agent_job(encode_v2_mock, ack_mock, recv_mock, send_mock, handshake_mock, connect_mock,
                    unlink_mock, rename_mock, remove_mock, ffmpeg_mock, getsize_mock, media_info, basic_config):
 
     getsize_mock.return_value = 1_500_000_000
@@ -141,16 +147,124 @@ def test_agent_job(ack_mock, recv_mock, send_mock, handshake_mock, connect_mock,
     config = basic_config
     props = config.hosts["server4"]
     host_props = RemoteHostProperties("server", props)
-    q = Queue()
+    q = Dispatcher()
     mi = media_info
 
     # "fix" the template to not think threshold was met
     config.templates["tv"].template["threshold"] = 0
 
     job = EncodeJob("/tmp/test.mkv", mi, config.templates["tv"])
-    q.put(job)
+    q.submit(job)
+    q.close()
 
     host = AgentManagedHost("server", host_props, q)
 
     host.video_cli = "-c:v copy"
     host.testrun()
+
+
+@patch("os.path.getsize")
+@patch("wandarr.ffmpeg.FFmpeg.run_remote")
+@patch("wandarr.streaminghost.run")
+@patch("shutil.move")
+@patch("wandarr.streaminghost.StreamingManagedHost.run_process")
+def test_streaming_prefetch(run_process_mock, move_mock, run_mock, ffmpeg_mock, getsize_mock, media_info, basic_config):
+    getsize_mock.return_value = 1_500_000_000
+    events = []
+    second_uploaded = Event()
+
+    def transfer(cmd):
+        events.append((cmd[0], cmd[-2] if cmd[0] == "rsync" else cmd[-1]))
+        if cmd[0] == "rsync" and cmd[-2] == "/tmp/second.mkv":
+            second_uploaded.set()
+        return 0, ""
+
+    def encode(*args):
+        events.append(("encode", os.path.basename(args[3][-1]).split('.')[0]))
+        # the next source is uploaded while this one encodes
+        assert second_uploaded.wait(timeout=5)
+        return 0
+
+    run_mock.side_effect = transfer
+    ffmpeg_mock.side_effect = encode
+    config = basic_config
+    config.templates["tv"].template["threshold"] = 0
+    props = dict(config.hosts["server"], prefetch=1)
+    q = Dispatcher()
+    jobs = [EncodeJob(f"/tmp/{name}.mkv", media_info, config.templates["tv"]) for name in ("first", "second")]
+    for job in jobs:
+        q.submit(job)
+    q.close()
+
+    host = StreamingManagedHost("server", RemoteHostProperties("server", props), q)
+    host.video_cli = "-c:v copy"
+    host.testrun()
+
+    assert events.index(("rsync", "/tmp/second.mkv")) < events.index(("encode", "second"))
+    assert [job.status for job in jobs] == ["done", "done"]
+    assert q.pending_count() == 0
+
+
+@patch("os.path.getsize")
+@patch("wandarr.ffmpeg.FFmpeg.run_remote", return_value=0)
+@patch("wandarr.streaminghost.run", return_value=(0, ""))
+@patch("shutil.move")
+@patch("wandarr.streaminghost.StreamingManagedHost.run_process")
+def test_streaming_prefetch_same_name(run_process_mock, move_mock, run_mock, ffmpeg_mock, getsize_mock, media_info,
+                                      basic_config):
+    getsize_mock.return_value = 1_500_000_000
+    config = basic_config
+    config.templates["tv"].template["threshold"] = 0
+    props = dict(config.hosts["server"], prefetch=1)
+    q = Dispatcher()
+    for folder in ("/a/S01", "/b/S02"):
+        q.submit(EncodeJob(f"{folder}/ep1.mkv", media_info, config.templates["tv"]))
+    q.close()
+
+    host = StreamingManagedHost("server", RemoteHostProperties("server", props), q)
+    host.video_cli = "-c:v copy"
+    host.testrun()
+
+    # each source is staged under its own name, and removed with its output afterwards
+    uploads = [call.args[0] for call in run_mock.call_args_list if call.args[0][-2].startswith("/a/") or
+               call.args[0][-2].startswith("/b/")]
+    staged = [cmd[-1].split(':', 1)[1] for cmd in uploads]
+    assert len(set(staged)) == 2
+    assert all(os.path.basename(path).startswith("ep1.") for path in staged)
+    removed = [call.args[0][-1] for call in run_process_mock.call_args_list]
+    assert all(any(path in cmd for cmd in removed) for path in staged)
+
+
+def test_streaming_released_upload_removed(basic_config, media_info):
+    q = Dispatcher()
+    host = StreamingManagedHost("server", RemoteHostProperties("server", basic_config.hosts["server"]), q)
+    host.video_cli = "-c:v copy"
+    job = EncodeJob("/tmp/test.mkv", media_info, basic_config.templates["tv"])
+    task = host.prepare(job, announce=False)
+    task.upload = Future()
+    tasks = {job: task}
+    uploader = MagicMock()
+
+    # the dispatcher no longer lists the job as reserved for this slot, e.g. after the host went down
+    host.drop_released(tasks, None, uploader)
+
+    assert not tasks
+    uploader.submit.assert_called_once_with(host.remove_remote, task.remote_in_path)
+
+
+@patch("time.sleep")
+@patch("wandarr.streaminghost.run")
+def test_streaming_transfer_resumed(run_mock, sleep_mock, basic_config):
+    host = StreamingManagedHost("server", RemoteHostProperties("server", basic_config.hosts["server"]), Dispatcher())
+
+    # connection dropped, then the next attempt completes the partial copy
+    run_mock.side_effect = [(255, "Connection reset"), (0, "")]
+    assert host.transfer("/tmp/test.mkv", "me@192.168.1.100:/tmp/test.mkv")
+    assert run_mock.call_count == 2
+    assert "--partial" in run_mock.call_args.args[0]
+
+    # not worth retrying, such as a usage error
+    run_mock.reset_mock()
+    run_mock.side_effect = [(1, "")]
+    assert not host.transfer("/tmp/test.mkv", "me@192.168.1.100:/tmp/test.mkv")
+    assert run_mock.call_count == 1
@@ -0,0 +1,53 @@
+from wandarr.base import EncodeJob
+from wandarr.dispatch import Dispatcher
+from wandarr.journal import JobJournal
+from .fixtures import media_info, basic_config
+
+
+class FakeSlot:
+    hostname = "server"
+    engine_name = "qsv"
+    qualities = None
+
+    def can_encode(self, job):
+        return True
+
+
+def test_states_and_resume(tmp_path, media_info, basic_config):
+    path = str(tmp_path / "journal.db")
+    journal = JobJournal(path)
+    batch = journal.new_batch("tv")
+
+    d = Dispatcher()
+    d.journal = journal
+    template = basic_config.templates["tv"]
+    jobs = [EncodeJob(f"/tmp/{name}.mkv", media_info, template) for name in ("a", "b", "c")]
+    for job in jobs:
+        d.submit(job)
+
+    slot = FakeSlot()
+    first = d.next_job(slot)
+    first.status = "done"
+    d.task_done(slot, first)
+    d.next_job(slot)    # left running, as if the controller died here
+
+    assert journal.summary(batch) == {"done": 1, "running": 1, "queued": 1}
+    journal.close()
+
+    reopened = JobJournal(path)
+    assert reopened.last_batch() == (batch, "tv")
+    unfinished = reopened.unfinished(batch)
+    assert [p for p, _ in unfinished] == ["/tmp/b.mkv", "/tmp/c.mkv"]
+    assert unfinished[0][1].to_dict() == media_info.to_dict()
+
+
+def test_job_without_outcome_is_failed(media_info, basic_config):
+    journal = JobJournal(":memory:")
+    batch = journal.new_batch("tv")
+    d = Dispatcher()
+    d.journal = journal
+    d.submit(EncodeJob("/tmp/a.mkv", media_info, basic_config.templates["tv"]))
+
+    slot = FakeSlot()
+    d.task_done(slot, d.next_job(slot))
+    assert journal.summary(batch) == {"failed": 1}
@@ -2,6 +2,7 @@ import json
 from unittest.mock import patch
 
 from wandarr.config import ConfigFile
+from wandarr.ffmpeg import ProgressParser
 from wandarr.media import MediaInfo
 from .fixtures import media_info
 
@@ -53,3 +54,25 @@ def test_stream_map(media_info):
     stream_map = template.stream_map(media_info.stream, media_info.audio, media_info.subtitle)
     assert stream_map == ['-map', '0:0', '-map', '0:1', '-map', '0:2', '-map', '0:3', '-map', '0:4']
 
+
+
+def test_parse_progress():
+    output = ("Input #0, matroska,webm, from 'in.mkv':\n"
+              "frame=1200\nfps=47.95\nstream_0_0_q=28.0\nbitrate=1843.2kbits/s\ntotal_size=11534336\n"
+              "out_time_us=50050000\nout_time_ms=50050000\nout_time=00:00:50.050000\ndup_frames=0\ndrop_frames=2\n"
+              "speed=1.99x\nprogress=continue\n"
+              "frame=1300\nfps=N/A\nout_time_us=N/A\nprogress=end\n")
+    parser = ProgressParser()
+    blocks = [stats for stats in map(parser.feed, output.splitlines(keepends=True)) if stats is not None]
+
+    assert len(blocks) == 2
+    stats = blocks[0]
+    assert stats["frame"] == 1200
+    assert stats["q"] == "28.0"
+    assert stats["time"] == 50.05
+    assert stats["size"] == stats["total_size"] == 11534336
+    assert stats["drop_frames"] == 2
+    assert stats["speed"] == "1.99"
+    # values ffmpeg does not know yet
+    assert blocks[1]["time"] == 0
+    assert blocks[1]["progress"] == "end"
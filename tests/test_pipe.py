@@ -0,0 +1,91 @@
+import os
+import stat
+import time
+
+from wandarr.base import RemoteHostProperties, EncodeJob
+from wandarr.dispatch import Dispatcher
+from wandarr.ffmpeg import FFmpeg
+from wandarr.streaminghost import StreamingManagedHost
+from .fixtures import media_info, basic_config
+
+
+def _fake_ssh(tmp_path):
+    # runs the "remote" command locally, dropping the user@host argument
+    ssh = tmp_path / "ssh"
+    ssh.write_text('#!/bin/sh\nshift\nexec "$@"\n')
+    ssh.chmod(ssh.stat().st_mode | stat.S_IEXEC)
+    return str(ssh)
+
+
+def _fake_ffmpeg(tmp_path, then):
+    # logs a line and reports progress on stderr, as asked with -progress pipe:2, then runs the given command
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text('#!/bin/sh\n'
+                      'echo "Input #0, matroska,webm, from \'pipe:0\':" >&2\n'
+                      'printf "frame=24\\nout_time_us=1500000\\ntotal_size=4096\\nspeed=2.0x\\nprogress=end\\n" >&2\n'
+                      f'{then}\n')
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IEXEC)
+    return str(ffmpeg)
+
+
+def test_run_remote_piped(tmp_path):
+    src = tmp_path / "in.mkv"
+    src.write_bytes(os.urandom(3 * 1024 * 1024 + 17))
+    out = tmp_path / "out.mkv"
+
+    ffmpeg = FFmpeg(_fake_ffmpeg(tmp_path, "cat"))
+    params = ['-i', 'pipe:0', '-f', 'matroska', 'pipe:1']
+    seen = []
+    code = ffmpeg.run_remote_piped(_fake_ssh(tmp_path), "me", "192.168.1.101", params, str(src), str(out),
+                                   lambda stats: seen.append(stats) and False)
+
+    assert code == 0
+    assert out.read_bytes() == src.read_bytes()
+    assert seen[-1]["speed"] == "2.0"
+    assert seen[-1]["time"] == 1.5
+    assert seen[-1]["size"] == 4096
+    # the log is only kept when ffmpeg fails
+    assert ffmpeg.log_path is None
+
+
+def test_run_remote_piped_failed(tmp_path):
+    src = tmp_path / "in.mkv"
+    src.write_bytes(os.urandom(1024))
+
+    ffmpeg = FFmpeg(_fake_ffmpeg(tmp_path, "cat > /dev/null; exit 1"))
+    code = ffmpeg.run_remote_piped(_fake_ssh(tmp_path), "me", "192.168.1.101", [], str(src),
+                                   str(tmp_path / "out.mkv"), None)
+
+    assert code == 1
+    # the log has ffmpeg's messages but not its progress reports
+    with open(ffmpeg.log_path, encoding="utf8") as log:
+        assert log.read() == "Input #0, matroska,webm, from 'pipe:0':\n"
+
+
+def test_run_remote_piped_interrupted(tmp_path):
+    src = tmp_path / "in.mkv"
+    src.write_bytes(os.urandom(1024))
+
+    def interrupt(stats):
+        raise KeyboardInterrupt()
+
+    ffmpeg = FFmpeg(_fake_ffmpeg(tmp_path, "exec sleep 30"))
+    ffmpeg.monitor_interval = 0
+    started = time.monotonic()
+    code = ffmpeg.run_remote_piped(_fake_ssh(tmp_path), "me", "192.168.1.101", [], str(src),
+                                   str(tmp_path / "out.mkv"), interrupt)
+
+    assert code is None
+    assert time.monotonic() - started < 10
+
+
+def test_can_pipe(media_info, basic_config):
+    props = dict(basic_config.hosts["server3"], pipe=True)
+    host = StreamingManagedHost("server3", RemoteHostProperties("server3", props), Dispatcher())
+    template = basic_config.templates["tv"]
+
+    assert host.can_pipe(EncodeJob("/tmp/test.mkv", media_info, template))
+    assert not host.can_pipe(EncodeJob("/tmp/test.mp4", media_info, template))
+
+    props["pipe"] = False
+    assert not host.can_pipe(EncodeJob("/tmp/test.mkv", media_info, template))
@@ -0,0 +1,71 @@
+import os
+from unittest.mock import patch
+
+from wandarr.ffmpeg import FFmpeg
+from wandarr.probecache import ProbeCache
+from .fixtures import media_info
+
+
+def _touch(path, size):
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    return str(path)
+
+
+def test_roundtrip(tmp_path, media_info):
+    cache = ProbeCache(str(tmp_path / "probe.db"))
+    src = _touch(tmp_path / "test.mkv", 10)
+
+    assert cache.get(src) is None
+    cache.put(src, media_info)
+    mi = cache.get(src)
+
+    assert mi.valid
+    assert mi.to_dict() == media_info.to_dict()
+    assert mi.audio[0].lang == "eng"
+    assert len(mi.subtitle) == 3
+
+
+def test_invalidated_when_file_changes(tmp_path, media_info):
+    cache = ProbeCache(str(tmp_path / "probe.db"))
+    src = _touch(tmp_path / "test.mkv", 10)
+    cache.put(src, media_info)
+
+    _touch(tmp_path / "test.mkv", 20)
+    assert cache.get(src) is None
+    assert len(cache) == 0
+
+
+def test_hash_memo(tmp_path):
+    cache = ProbeCache(str(tmp_path / "probe.db"))
+    src = _touch(tmp_path / "test.mkv", 10)
+
+    assert cache.get_hash(src) is None
+    cache.put_hash(src, "abc")
+    assert cache.get_hash(src) == "abc"
+
+    _touch(tmp_path / "test.mkv", 20)
+    assert cache.get_hash(src) is None
+
+
+def test_eviction(tmp_path, media_info):
+    cache = ProbeCache(str(tmp_path / "probe.db"), max_entries=2)
+    files = [_touch(tmp_path / f"{n}.mkv", 10) for n in range(3)]
+    for f in files:
+        cache.put(f, media_info)
+
+    assert len(cache) == 2
+    assert cache.get(files[0]) is None
+    assert cache.get(files[2]) is not None
+
+
+def test_fetch_details_uses_cache(tmp_path, media_info):
+    ffmpeg = FFmpeg("/usr/bin/ffmpeg")
+    ffmpeg.probe_cache = ProbeCache(str(tmp_path / "probe.db"))
+    src = _touch(tmp_path / "test.mkv", 10)
+
+    with patch("wandarr.ffmpeg.FFmpeg.fetch_details_ffprobe", return_value=media_info) as probe:
+        ffmpeg.fetch_details(src)
+        ffmpeg.fetch_details(src)
+        assert probe.call_count == 1
+    assert os.path.exists(tmp_path / "probe.db")
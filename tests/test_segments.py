@@ -0,0 +1,95 @@
+from unittest.mock import MagicMock, patch
+
+from wandarr.base import RemoteHostProperties, EncodeJob
+from wandarr.dispatch import Dispatcher
+from wandarr.localhost import LocalHost
+from wandarr.segments import SegmentedEncode, concat_stream_map, split_points
+from wandarr.streaminghost import StreamingManagedHost
+from .fixtures import media_info, basic_config
+
+
+def test_split_points_snap_to_keyframes():
+    assert split_points(3600, 1000) == [900, 1800, 2700]
+    assert split_points(3600, 1000, [0, 905.2, 1799, 1802.5, 2710]) == [905.2, 1802.5, 2710]
+    assert split_points(1500, 1000, [0, 1499.5]) == [1499.5]
+    assert split_points(900, 1000) == []
+
+
+def test_concat_stream_map():
+    assert concat_stream_map(['-map', '0']) == ['-map', '0:v:0', '-map', '1', '-map', '-1:v']
+    assert concat_stream_map(['-map', '0:0', '-map', '0:2', '-disposition:a:0', 'default']) == \
+        ['-map', '0:v:0', '-map', '1:2', '-disposition:a:0', 'default']
+
+
+def test_segment_jobs(media_info, basic_config):
+    job = EncodeJob("/tmp/test.mkv", media_info, basic_config.templates["tv"])
+    group = SegmentedEncode(job, [1000.5, 2000], "/usr/bin/ffmpeg")
+
+    assert [s.input_options() for s in group.segments] == [
+        ['-ss', '0.000', '-t', '1000.500'], ['-ss', '1000.500', '-t', '999.500'], ['-ss', '2000.000']]
+    assert group.segments[2].media_info.runtime == media_info.runtime - 2000
+    assert group.segments[1].out_path == "/tmp/test.seg001.mkv"
+
+    props = basic_config.hosts["workstation"]
+    local = LocalHost("workstation", RemoteHostProperties("workstation", props), Dispatcher())
+    streaming = StreamingManagedHost("workstation", RemoteHostProperties("workstation", props), Dispatcher())
+    assert local.can_encode(group.segments[0])
+    assert not streaming.can_encode(group.segments[0])
+
+
+@patch("wandarr.KEEP_SOURCE", True, create=True)
+@patch("os.path.getsize", return_value=1_500_000_000)
+@patch("wandarr.ffmpeg.FFmpeg.run", return_value=0)
+@patch("os.remove")
+def test_segments_assembled_after_last(remove_mock, ffmpeg_mock, getsize_mock, media_info, basic_config, tmp_path):
+    basic_config.templates["tv"].template["threshold"] = 0
+    job = EncodeJob(str(tmp_path / "test.mkv"), media_info, basic_config.templates["tv"])
+    group = SegmentedEncode(job, [1600], "/usr/bin/ffmpeg")
+
+    q = Dispatcher()
+    for segment in group.segments:
+        q.submit(segment)
+    q.close()
+
+    host = LocalHost("workstation", RemoteHostProperties("workstation", basic_config.hosts["workstation"]), q)
+    host.video_cli = "-c:v libx265"
+    host.testrun()
+
+    assert ffmpeg_mock.call_count == 3
+    segment_cli = ffmpeg_mock.call_args_list[1].args[0]
+    assert segment_cli[segment_cli.index('-ss') + 1] == '1600.000'
+    assert segment_cli[-1] == str(tmp_path / "test.seg001.mkv")
+
+    assemble_cli = ffmpeg_mock.call_args_list[2].args[0]
+    assert assemble_cli[1:7] == ['-f', 'concat', '-safe', '0', '-i', str(tmp_path / "test.segments.txt")]
+    assert job.status == "done"
+    removed = [call.args[0] for call in remove_mock.call_args_list]
+    assert str(tmp_path / "test.seg000.mkv") in removed
+
+
+def test_reclaimed_segment_assembled_from_retry(media_info, basic_config):
+    job = EncodeJob("/tmp/test.mkv", media_info, basic_config.templates["tv"])
+    group = SegmentedEncode(job, [1600], "/usr/bin/ffmpeg")
+    d = Dispatcher()
+    for segment in group.segments:
+        d.submit(segment)
+    d.close()
+
+    props = basic_config.hosts["workstation"]
+    lost = LocalHost("lost", RemoteHostProperties("lost", props), d)
+    other = LocalHost("other", RemoteHostProperties("other", props), d)
+    lost.video_cli = other.video_cli = "-c:v libx265"
+    assert d.next_job(lost) is group.segments[0]
+    assert d.host_down("lost") == [lost]
+    # the original ends as failed when its slot is aborted, a copy of it was queued again
+    group.segments[0].status = "failed"
+    assert not d.task_done(lost, group.segments[0])
+
+    with patch.object(group, "assemble", return_value="done") as assemble_mock, patch.object(group, "cleanup"):
+        while (segment := d.next_job(other)) is not None:
+            segment.status = "done"
+            if d.task_done(other, segment):
+                segment.finalize(MagicMock())
+
+    assemble_mock.assert_called_once()
+    assert job.status == "done"
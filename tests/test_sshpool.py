@@ -0,0 +1,36 @@
+import subprocess
+from unittest.mock import patch
+
+import wandarr
+from wandarr import sshpool
+
+
+def _ok(*args, **kwargs):
+    return subprocess.CompletedProcess(args[0], 0)
+
+
+@patch("wandarr.SSH_MULTIPLEX", True)
+@patch("subprocess.run", side_effect=_ok)
+def test_master_shared_and_closed(run_mock):
+    assert sshpool.ensure_master("me", "192.168.1.100")
+    master = run_mock.call_args.args[0]
+    assert master[:4] == [wandarr.SSH, "-M", "-N", "-f"]
+
+    opts = sshpool.ssh_options("me", "192.168.1.100")
+    assert opts[0] == "-o" and opts[1].startswith("ControlPath=")
+    assert sshpool.rsync_options("me", "192.168.1.100") == ["-e", " ".join([wandarr.SSH, *opts])]
+
+    # an existing master is only checked, not started again
+    assert sshpool.ensure_master("me", "192.168.1.100")
+    assert run_mock.call_args.args[0][-3:] == ["-O", "check", "me@192.168.1.100"]
+
+    sshpool.close_all()
+    assert run_mock.call_args.args[0][-3:] == ["-O", "exit", "me@192.168.1.100"]
+    assert sshpool.ssh_options("me", "192.168.1.100") == []
+
+
+@patch("subprocess.run", side_effect=_ok)
+def test_disabled(run_mock):
+    assert not sshpool.ensure_master("me", "192.168.1.100")
+    assert sshpool.ssh_options("me", "192.168.1.100") == []
+    run_mock.assert_not_called()
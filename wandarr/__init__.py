@@ -17,6 +17,9 @@ COPY_METADATA = False
 SKIP_EXISTING = True
 OUTPUT_FOLDER = None
 OVERWRITE_SOURCE = False
+PROBE_CACHE = True
+JOB_ORDER = "fifo"
+SSH_MULTIPLEX = False
 console = None
 
 status_queue = Queue()
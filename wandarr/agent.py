@@ -1,148 +1,765 @@
+import hashlib
+import io
 import socket
 import os
 import subprocess
 import time
-from threading import Thread
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from queue import Queue
+from threading import BoundedSemaphore, Condition, Event, Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+from wandarr import protocol
+from wandarr.capabilities import local_capabilities, video_encoder
+from wandarr.ffmpeg import PROGRESS_OPTIONS, ProgressParser
+
+# lines of ffmpeg output returned to the controller when an encode fails
+LOG_TAIL = 50
+# seconds between reports of a waiting job's place in the queue, which also keep the connection alive
+QUEUE_REPORT_INTERVAL = 30
+# jobs run at once per encoder or encoder family, "*" covers all others. Consumer nVidia cards only run a few
+# NVENC sessions and fail the rest.
+DEFAULT_SLOTS = {'nvenc': 3, '*': 2}
+# seconds between looks at an output being returned while ffmpeg writes it, and the least new output worth sending
+TAIL_INTERVAL = 1
+TAIL_MIN = 1024 * 1024
+# size of the parts of a returned output checked for changes once ffmpeg is done
+TAIL_BLOCK = 256 * 1024
+
+
+def parse_slots(spec: str) -> Dict[str, int]:
+    """Parse slot limits given as encoder=count[,encoder=count...], for example "nvenc=2,libx265=1,*=2" """
+    limits = {}
+    for part in spec.split(','):
+        name, _, count = part.partition('=')
+        if not name.strip() or not count.strip().isdigit() or int(count) < 1:
+            raise ValueError(f"invalid slot limit '{part}', expected encoder=count")
+        limits[name.strip()] = int(count)
+    return limits
+
+
+class EncoderSlots:
+    """Limits how many jobs run at once for each encoder, across all sessions of the agent.
+
+       A job is counted against the first limit found for its video encoder ("hevc_nvenc"), the encoder's
+       family ("nvenc", the part after the last underscore) or "*". Jobs over the limit wait their turn in
+       the order they became ready.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None):
+        self.limits = limits or {}
+        self._running: Dict[str, int] = defaultdict(int)
+        self._waiting: List[List] = []  # [key, ticket] in arrival order
+        self._cond = Condition()
+
+    def key(self, cli: List[str]) -> str:
+        encoder = video_encoder(cli)
+        if encoder is None:
+            return '*'
+        if encoder in self.limits:
+            return encoder
+        family = encoder.rsplit('_', 1)[-1]
+        if family in self.limits:
+            return family
+        return '*'
+
+    def _position(self, key: str, ticket) -> int:
+        """Number of jobs of the same key waiting ahead of this one"""
+        ahead = [t for k, t in self._waiting if k == key]
+        return ahead.index(ticket)
+
+    def acquire(self, key: str, report: Optional[Callable[[int], None]] = None,
+                cancelled: Optional[Callable[[], bool]] = None) -> bool:
+        """Wait for a slot, calling report with the job's place in the queue (1 runs next) while it waits.
+           False if cancelled returned True first."""
+        ticket = object()
+        limit = self.limits.get(key, self.limits.get('*'))
+        reported = None
+        last_report = 0.0
+        with self._cond:
+            self._waiting.append([key, ticket])
+        try:
+            while True:
+                with self._cond:
+                    if cancelled is not None and cancelled():
+                        return False
+                    position = self._position(key, ticket)
+                    if position == 0 and (limit is None or self._running[key] < limit):
+                        self._running[key] += 1
+                        return True
+                    due = position != reported or time.monotonic() - last_report >= QUEUE_REPORT_INTERVAL
+                    if report is None or not due:
+                        self._cond.wait(QUEUE_REPORT_INTERVAL)
+                        continue
+                # not holding the lock while sending
+                report(position + 1)
+                reported = position
+                last_report = time.monotonic()
+        finally:
+            with self._cond:
+                self._waiting.remove([key, ticket])
+                self._cond.notify_all()
+
+    def release(self, key: str):
+        with self._cond:
+            self._running[key] -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def hold(self, key: str):
+        """A slot for the duration of the with block"""
+        self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    def wake(self):
+        """Have waiting jobs check whether they were cancelled"""
+        with self._cond:
+            self._cond.notify_all()
+
+
+class HashingWriter:
+    """File a source is received into, hashed on the way so it can be checked before going in the cache"""
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+        self.position = 0
+        self.in_order = True    # the hash only covers the file if it arrived front to back
+
+    def seek(self, offset: int):
+        if offset != self.position:
+            self.in_order = False
+        self.f.seek(offset)
+        self.position = offset
+
+    def write(self, data):
+        self.digest.update(data)
+        self.f.write(data)
+        self.position += len(data)
+
+    def hexdigest(self) -> Optional[str]:
+        """Hash of the received file, None if it did not arrive front to back"""
+        return self.digest.hexdigest() if self.in_order else None
+
+    def close(self):
+        self.f.close()
+
+
+class PipeSink:
+    """Target for received DATA frames that feeds a process's stdin, which only takes data in order"""
+
+    def __init__(self, pipe, copy: Optional[HashingWriter] = None):
+        self.pipe = pipe
+        self.copy = copy    # also written to, to keep the source in the cache
+        self.position = 0
+        self.broken = False
+
+    def seek(self, offset: int):
+        if offset != self.position:
+            raise protocol.ProtocolError(f"data for offset {offset} while expecting {self.position}")
+
+    def write(self, data):
+        self.position += len(data)
+        if self.copy is not None:
+            self.copy.write(data)
+        if self.broken:
+            return
+        try:
+            self.pipe.write(data)
+        except OSError:
+            # ffmpeg stopped reading, its exit code tells why. The rest of the upload is read and dropped.
+            self.broken = True
+
+    def close(self):
+        try:
+            self.pipe.close()
+        except OSError:
+            pass
+        if self.copy is not None:
+            self.copy.close()
+
+
+class InputCache:
+    """Sources kept in the working dir after their jobs, named by the hash of their contents, so a later job
+       on the same source needs no upload. Once the cache grows over its quota the least recently used
+       sources are removed, except those a job is still using.
+    """
+
+    DIRNAME = "wandarr-cache"
+
+    def __init__(self):
+        self._lock = Lock()
+        self._in_use: Dict[str, int] = defaultdict(int)
+
+    def path(self, tempdir: str, digest: str, ext: str) -> str:
+        return os.path.join(tempdir, self.DIRNAME, digest + ext)
+
+    def lookup(self, tempdir: str, digest: str, ext: str) -> Optional[str]:
+        """Path of a cached source, held for the caller until release(), or None"""
+        path = self.path(tempdir, digest, ext)
+        with self._lock:
+            if not os.path.exists(path):
+                return None
+            # modification time orders the cache by last use
+            os.utime(path)
+            self._in_use[path] += 1
+        return path
+
+    def store(self, source: str, tempdir: str, digest: str, ext: str, quota: int) -> str:
+        """Move a received source into the cache, held for the caller until release()"""
+        path = self.path(tempdir, digest, ext)
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(source, path)
+            os.utime(path)
+            self._in_use[path] += 1
+            self._evict(os.path.dirname(path), quota)
+        return path
+
+    def release(self, path: str):
+        with self._lock:
+            self._in_use[path] -= 1
+            if self._in_use[path] <= 0:
+                del self._in_use[path]
+
+    def _evict(self, directory: str, quota: int):
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= quota:
+                break
+            if path in self._in_use:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+class AgentJob:
+    """A job received on a session, from its JOB frame until its output is returned or discarded"""
+
+    def __init__(self, job_id: int, fields: Dict, name: str):
+        self.job_id = job_id
+        self.cli = fields['cli']
+        self.size = fields['size']
+        self.stream = fields.get('stream', False)
+        self.progress_interval = fields.get('progress_interval', 10)
+        self.tempdir = fields['tempdir']
+        self.ext = os.path.splitext(fields['filename'])[1]
+        # with the input cache in use, the cache size limit in bytes and the hash of the source if known
+        self.hash = fields.get('hash')
+        self.cache_quota = fields.get('cache_quota', 0)
+        self.progressive = fields.get('progressive', False)  # output may be returned while it is written
+        self.copy: Optional[HashingWriter] = None  # received source on its way to the cache
+        self.cached: Optional[str] = None  # source in the cache, held until the job is done
+        self.done = False
+        # jobs of all sessions share the working dir, and sources from different folders may share a name
+        self.in_path = os.path.join(self.tempdir, name)
+        self.tmp_path = self.in_path + ".tmp"
+        self.received = 0
+        self.sink = None            # where the DATA frames of the source go
+        self.started = Event()      # set once the sink of a streamed source is open
+        self.replies = Queue()      # the controller's DONE or VETO once the encode finished
+        self.proc = None
+        self.vetoed = False
+        self.lock = Lock()
+
+    def veto(self):
+        """Stop the job wherever it is, the reader thread calls this when the controller sends VETO"""
+        with self.lock:
+            self.vetoed = True
+            if self.proc is not None and self.proc.poll() is None:
+                self.proc.kill()
+        self.replies.put(protocol.VETO)
+
+    def abandon(self):
+        """Stop taking the job's source after it failed here, releasing the reader if it waits for a sink"""
+        with self.lock:
+            self.vetoed = True
+        self.started.set()
+
+    def close_sink(self):
+        for sink in (self.sink, self.copy):
+            if sink is not None:
+                sink.close()
+
+    def cleanup(self):
+        for path in (self.tmp_path, self.in_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class OutputTail(Thread):
+    """Sends an output file to the controller while ffmpeg writes it. Parts ffmpeg rewrote after they were
+       sent, such as the header of a matroska file, are found by their digests once it is done."""
+
+    def __init__(self, sock: socket.socket, lock: Lock, job: AgentJob):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.lock = lock
+        self.job = job
+        self.blocks: List[Tuple[int, int, bytes]] = []  # offset, length and digest of each part sent
+        self.position = 0
+        self.finished = Event()
+
+    def run(self):
+        try:
+            while not self.finished.wait(TAIL_INTERVAL):
+                self.send_new(TAIL_MIN)
+        except OSError:
+            # the session is gone, the reader thread winds it up
+            pass
+
+    def send_new(self, least: int):
+        try:
+            size = os.path.getsize(self.job.tmp_path)
+        except OSError:
+            return
+        if size - self.position < least:
+            return
+        with open(self.job.tmp_path, 'rb') as f:
+            f.seek(self.position)
+            while self.position < size and not self.job.vetoed:
+                data = f.read(min(protocol.CHUNK_SIZE, size - self.position))
+                if not data:
+                    break
+                for start in range(0, len(data), TAIL_BLOCK):
+                    block = data[start:start + TAIL_BLOCK]
+                    self.blocks.append((self.position + start, len(block), hashlib.blake2b(block).digest()))
+                protocol.send_data(self.sock, self.job.job_id, self.position, data, self.lock)
+                self.position += len(data)
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+
+    def remaining(self) -> List[Tuple[int, int]]:
+        """Parts of the finished output still to be sent, as (offset, length): those changed since they were
+           sent, and whatever was added"""
+        size = os.path.getsize(self.job.tmp_path)
+        parts = []
+        with open(self.job.tmp_path, 'rb') as f:
+            for offset, length, digest in self.blocks:
+                if offset >= size:
+                    break
+                f.seek(offset)
+                if hashlib.blake2b(f.read(length)).digest() != digest:
+                    parts.append((offset, min(length, size - offset)))
+        if size > self.position:
+            parts.append((self.position, size - self.position))
+        return parts
 
 
 class Runner(Thread):
-    def __init__(self, c, addr, thread_id: int):
+    def __init__(self, c, addr, thread_id: int, slots: Optional[EncoderSlots] = None,
+                 sessions: Optional[BoundedSemaphore] = None, cache: Optional[InputCache] = None):
         super().__init__(name=f"Runner {thread_id}", daemon=True)
         self.c = c
         self.addr = addr
         self.thread_id = thread_id
+        self.slots = slots or EncoderSlots()
+        self.cache = cache or InputCache()
+        self.sessions = sessions    # released when the connection ends
+        self.send_lock = Lock()     # the reader and the encoder both send on the connection
+        self.jobs: Dict[int, AgentJob] = {}
+        self.queue = Queue()        # jobs ready to encode, in the order announced
 
     def run(self):
         c = self.c
         try:
             print(f'[{self.thread_id}]: got connection from addr', self.addr)
-            hello = c.recv(2048).decode()
-            print(f"[{self.thread_id}]", hello)
-            if hello.startswith("PING"):
-                c.send(bytes("PONG".encode()))
+            opening = protocol.recv_exact(c, len(protocol.MAGIC))
+            if opening == protocol.MAGIC:
+                self.run_v2()
+            elif opening == b"PING":
+                self.run_v1(opening)
+            else:
+                self.run_v1(opening + c.recv(2048))
+        except Exception as ex:
+            print(str(ex))
+
+        c.close()
+        if self.sessions is not None:
+            self.sessions.release()
+
+    def send(self, kind: int, job_id: int, **fields):
+        protocol.send_message(self.c, kind, job_id, lock=self.send_lock, **fields)
+
+    def run_v2(self):
+        """Serve a session over the framed protocol, see wandarr.protocol"""
+        c = self.c
+        kind, _, hello = protocol.recv_message(c)
+        if kind != protocol.HELLO:
+            raise protocol.ProtocolError(f"expected HELLO, got {protocol.FRAME_NAMES[kind]}")
+        version = min(protocol.VERSION, hello.get('version', protocol.VERSION))
+        print(f"[{self.thread_id}] session open, protocol version {version}")
+        self.send(protocol.HELLO, 0, version=version)
+
+        encoder = Thread(target=self.encode_jobs, name=f"Encoder {self.thread_id}", daemon=True)
+        encoder.start()
+        try:
+            self.read_frames()
+        except protocol.PeerClosed:
+            # a ping, or the controller has no more work
+            print(f"[{self.thread_id}] session closed")
+        finally:
+            # the encoder removes jobs as it finishes them
+            for job in list(self.jobs.values()):
+                job.veto()
+                job.close_sink()
+            self.slots.wake()
+            self.queue.put(None)
+            encoder.join()
+            for job in list(self.jobs.values()):
+                job.cleanup()
+
+    def read_frames(self):
+        """Take the controller's frames for all jobs of the session until it closes the connection"""
+        c = self.c
+        buffer = memoryview(bytearray(protocol.RECV_BUFFER))
+        while True:
+            kind, job_id, size = protocol.recv_header(c)
+            job = self.jobs.get(job_id)
+            if kind == protocol.DATA:
+                if job is not None and not job.vetoed:
+                    job.started.wait()
+                if job is None or job.vetoed:
+                    # sent before the controller's VETO arrived, or for a job that failed here
+                    protocol.skip_data(c, size, buffer)
+                    continue
+                job.received += protocol.recv_data(c, size, job.sink, buffer)
+                if job.received >= job.size:
+                    self.upload_finished(job)
+                continue
+
+            fields = protocol.recv_fields(c, kind, size)
+            if kind == protocol.JOB:
+                self.start_job(job_id, fields)
+            elif kind == protocol.INFO:
+                capabilities = local_capabilities(fields['ffmpeg'], fields.get('tempdir'))
+                self.send(protocol.INFO, job_id, **(capabilities.to_dict() if capabilities else {}))
+            elif kind in (protocol.DONE, protocol.VETO) and job is not None:
+                if kind == protocol.VETO:
+                    print(f"[{self.thread_id}] job {job_id}: vetoed by client")
+                    job.veto()
+                    self.slots.wake()
+                    if job.received < job.size:
+                        job.close_sink()
+                        job.cleanup()
+                else:
+                    job.replies.put(kind)
+            elif job is None and kind in (protocol.DONE, protocol.VETO):
+                # about a job that already ended here
+                pass
+            else:
+                raise protocol.ProtocolError(f"unexpected {protocol.FRAME_NAMES[kind]} frame")
+
+    def start_job(self, job_id: int, fields: Dict):
+        job = AgentJob(job_id, fields, f"{self.thread_id}-{job_id}-{fields['filename']}")
+        self.jobs[job_id] = job
+        print(f"[{self.thread_id}] job {job_id}: {fields['filename']}, {job.size} bytes")
+        if job.hash:
+            job.cached = self.cache.lookup(job.tempdir, job.hash, job.ext)
+            self.send(protocol.HAVE, job_id, cached=job.cached is not None)
+            if job.cached is not None:
+                print(f"[{self.thread_id}] job {job_id}: source found in the input cache")
+                job.stream = False
+                job.started.set()
+                self.queue.put(job)
+                return
+        if job.cache_quota > 0:
+            # without a hash from the controller, the source is cached under the hash of what arrives
+            job.copy = HashingWriter(open(job.in_path, "wb"))
+        if job.stream:
+            # the controller streams only to an idle session, the encoder opens ffmpeg's stdin as the sink
+            self.queue.put(job)
+        else:
+            job.sink = job.copy or open(job.in_path, "wb")
+            job.started.set()
+            if job.size == 0:
+                self.upload_finished(job)
+
+    def upload_finished(self, job: AgentJob):
+        job.sink.close()
+        if job.copy is not None:
+            self.cache_source(job)
+        if not job.stream:
+            print(f"[{self.thread_id}] job {job.job_id}: receive complete")
+            self.queue.put(job)
+
+    def cache_source(self, job: AgentJob):
+        digest = job.copy.hexdigest()
+        if digest is None or (job.hash and digest != job.hash):
+            print(f"[{self.thread_id}] job {job.job_id}: source does not match its hash, not cached")
+            return
+        path = self.cache.store(job.in_path, job.tempdir, digest, job.ext, job.cache_quota)
+        with job.lock:
+            if not job.done:
+                job.cached = path
+                return
+        # a streamed job can end before its upload does
+        self.cache.release(path)
+
+    def finish_job(self, job: AgentJob):
+        with job.lock:
+            job.done = True
+            cached, job.cached = job.cached, None
+        if cached is not None:
+            self.cache.release(cached)
+        job.cleanup()
+        self.jobs.pop(job.job_id, None)
+
+    def encode_jobs(self):
+        """Encode the jobs of the session one at a time, until the session closes"""
+        while (job := self.queue.get()) is not None:
+            try:
+                key = self.slots.key(job.cli)
+                if self.slots.acquire(key, lambda position: self.report_queued(job.job_id, position),
+                                      lambda: job.vetoed):
+                    try:
+                        self.encode(job)
+                    finally:
+                        self.slots.release(key)
+            except Exception as ex:
+                print(f"[{self.thread_id}] job {job.job_id}: {ex}")
+                job.abandon()
+                try:
+                    self.send(protocol.ERROR, job.job_id, code=-1, log=[f"wandarr agent: {ex}"])
+                except OSError:
+                    # the session is gone, the reader winds it up
+                    pass
+            finally:
+                self.finish_job(job)
+
+    def report_queued(self, job_id: int, position: int):
+        print(f"[{self.thread_id}] job {job_id}: waiting for an encoder, position {position}")
+        self.send(protocol.QUEUED, job_id, position=position)
+
+    @staticmethod
+    def collect_log(pipe, tail: deque):
+        """Keep the last lines of ffmpeg's log, returned to the controller if the encode fails"""
+        for line in io.TextIOWrapper(pipe, encoding='utf8', errors='replace'):
+            tail.append(line.rstrip())
+
+    def report_progress(self, job: AgentJob, output):
+        """Follow ffmpeg's -progress output, sending the latest statistics at most once per interval"""
+        next_progress = 0.0
+        stats = None
+        parser = ProgressParser()
+        for line in output:
+            info = parser.feed(line)
+            if info is None:
+                continue
+            stats = info
+            # no acknowledgements, so ffmpeg's output never waits on the network
+            if time.monotonic() >= next_progress:
+                self.send(protocol.PROGRESS, job.job_id, **info)
+                next_progress = time.monotonic() + job.progress_interval
+        return stats
+
+    def encode(self, job: AgentJob):
+        """Run ffmpeg and report back. A streamed source is fed to ffmpeg's stdin by the reader as it
+           arrives."""
+        source = "pipe:0" if job.stream else job.cached or job.in_path
+        cli = [part.replace(r"{FILENAME}", source) for part in job.cli]
+        cli.append(job.tmp_path)
+        print(f"[{self.thread_id}] job {job.job_id}: executing " + " ".join(cli))
+        tail = deque(maxlen=LOG_TAIL)
+        returning = OutputTail(self.c, self.send_lock, job) if job.progressive else None
+        with subprocess.Popen([cli[0], *PROGRESS_OPTIONS, *cli[1:]],
+                              stdin=subprocess.PIPE if job.stream else subprocess.DEVNULL,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              shell=False) as proc:
+            with job.lock:
+                job.proc = proc
+                if job.vetoed:
+                    proc.kill()
+            if job.stream:
+                job.sink = PipeSink(proc.stdin, job.copy)
+                job.started.set()
+            if returning is not None:
+                returning.start()
+            log = Thread(target=self.collect_log, args=(proc.stderr, tail), daemon=True)
+            log.start()
+            output = io.TextIOWrapper(proc.stdout, encoding='utf8', errors='replace')
+            stats = self.report_progress(job, output)
+            proc.wait()
+            log.join()
+
+        if returning is not None:
+            returning.stop()
+        if job.vetoed:
+            print(f"[{self.thread_id}] Client vetoed the transcode, cleaning up")
+            return
+        if proc.returncode != 0:
+            print(f"[{self.thread_id}] > ERROR")
+            self.send(protocol.ERROR, job.job_id, code=proc.returncode, log=list(tail))
+            return
+
+        print(f"[{self.thread_id}] > DONE")
+        size = os.path.getsize(job.tmp_path)
+        parts = returning.remaining() if returning is not None else [(0, size)]
+        follow = sum(length for _, length in parts)
+        self.send(protocol.DONE, job.job_id, code=0, size=size, follow=follow, stats=stats)
+        if job.replies.get() == protocol.DONE:
+            print(f"[{self.thread_id}] sending {follow} of {size} bytes of the transcoded file")
+            for offset, length in parts:
+                protocol.send_file(self.c, job.job_id, job.tmp_path, offset, length, lock=self.send_lock)
+            print(f"[{self.thread_id}] done")
+        else:
+            print(f"[{self.thread_id}] output discarded by client")
+
+    def run_v1(self, opening: bytes):
+        """Serve one job over the original line protocol, for controllers older than protocol version 2"""
+        c = self.c
+        hello = opening.decode()
+        print(f"[{self.thread_id}]", hello)
+        if hello.startswith("PING"):
+            c.send(bytes("PONG".encode()))
+            c.close()
+            return
+
+        if hello.startswith("HELLO|"):
+
+            parts = hello.split("|")
+            if len(parts) < 5:
+                print(f"[{self.thread_id}] Not enough values in HELLO packet: " + hello)
                 c.close()
                 return
 
-            if hello.startswith("HELLO|"):
-
-                parts = hello.split("|")
-                if len(parts) < 5:
-                    print(f"[{self.thread_id}] Not enough values in HELLO packet: " + hello)
-                    c.close()
-                    return
-
-                filesize = int(parts[1])
-                tempdir = parts[2]
-                filename = parts[3]
-                cli = parts[4]
-
-                print(f"[{self.thread_id}] echoing back hello")
-                c.send(bytes(hello.encode()))
-
-                print(f"[{self.thread_id}] receiving {filesize} bytes to {filename}...")
-                output_filename = os.path.join(tempdir, filename)
-                tmp_filename = os.path.join(tempdir, filename + ".tmp")
-
-                with open(output_filename, "wb") as f:
-                    while filesize > 0:
-                        chunk = c.recv(min(4096, filesize))
-                        if len(chunk) == 0:
-                            break
-                        filesize -= len(chunk)
-                        f.write(chunk)
-
-                cli = cli.replace(r"{FILENAME}", output_filename)
-                cli_parts = cli.split(r"$")
-                print(f"[{self.thread_id}] receive complete - executing " + " ".join(cli_parts))
-                cli_parts.append(tmp_filename)
-
-                vetoed = False
-                with subprocess.Popen(cli_parts,
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.STDOUT,
-                                      universal_newlines=True,
-                                      shell=False) as proc:
-                    while proc.poll() is None:
-                        line = proc.stdout.readline()
-                        if "video:" in line:
-                            print("video: trigger detected")
-                            # transcode complete
-                            break
-
-                        c.send(bytes(line.encode()))
-
-                        response = c.recv(20)
-                        confirmation = response.decode()
-                        if confirmation == "PING":
-                            # ping received out of context, ignore
-                            continue
-                        elif confirmation == "STOP":
-                            proc.kill()
-                            print(f"[{self.thread_id}] Client stopped the transcode, cleaning up")
-                            vetoed = True
-                            break
-                        elif confirmation == "VETO":
-                            proc.kill()
-                            print(f"[{self.thread_id}] Client vetoed the transcode, cleaning up")
-                            vetoed = True
-                            break
-                        elif confirmation != "ACK!":
-                            proc.kill()
-                            print(f"[{self.thread_id}] Protocol error - expected ACK from client, got {confirmation}")
-                            print("Cleaning up")
-                            vetoed = True
-                            break
-
-                    # wait for process to end
-                    while proc.poll() is None:
-                        time.sleep(1)
-
-                    if not vetoed:
-                        if proc.returncode != 0:
-                            print(f"[{self.thread_id}] > ERR")
-                            c.send(bytes(f"ERR|{proc.returncode}".encode()))
-                            print(f"[{self.thread_id}] Cleaning up")
-                        else:
-                            print(f"[{self.thread_id}] > DONE")
-                            filesize = os.path.getsize(tmp_filename)
-                            c.send(bytes(f"DONE|{proc.returncode}|{filesize}".encode()))
-                            # wait for response, then send file
-                            response = c.recv(4).decode()
-                            if response == "ACK!":
-                                # send the file back
-                                print(f"[{self.thread_id}] sending transcoded file")
-                                with open(tmp_filename, "rb") as input_file:
-                                    blk = input_file.read(1_000_000)
-                                    while len(blk) > 0:
-                                        c.send(blk)
-                                        blk = input_file.read(1_000_000)
-                                print(f"[{self.thread_id}] done")
-                            else:
-                                print(f"[{self.thread_id}] expected ACK, got {response}")
-                    else:
-                        print(f"[{self.thread_id}] veto")
+            filesize = int(parts[1])
+            tempdir = parts[2]
+            filename = parts[3]
+            cli = parts[4]
 
-                    os.remove(tmp_filename)
-                    os.remove(output_filename)
+            print(f"[{self.thread_id}] echoing back hello")
+            c.send(bytes(hello.encode()))
 
-        except Exception as ex:
-            print(str(ex))
+            print(f"[{self.thread_id}] receiving {filesize} bytes to {filename}...")
+            output_filename = os.path.join(tempdir, filename)
+            tmp_filename = os.path.join(tempdir, filename + ".tmp")
 
-        c.close()
+            buffer = memoryview(bytearray(protocol.RECV_BUFFER))
+            with open(output_filename, "wb") as f:
+                while filesize > 0:
+                    n = c.recv_into(buffer, min(len(buffer), filesize))
+                    if n == 0:
+                        break
+                    filesize -= n
+                    f.write(buffer[:n])
+
+            cli = cli.replace(r"{FILENAME}", output_filename)
+            cli_parts = cli.split(r"$")
+            print(f"[{self.thread_id}] receive complete - executing " + " ".join(cli_parts))
+            cli_parts.append(tmp_filename)
+
+            vetoed = False
+            # no queue reports in this protocol, the controller just sees the encode start late
+            with self.slots.hold(self.slots.key(cli_parts)), \
+                    subprocess.Popen(cli_parts,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT,
+                                     universal_newlines=True,
+                                     shell=False) as proc:
+                while proc.poll() is None:
+                    line = proc.stdout.readline()
+                    if "video:" in line:
+                        print("video: trigger detected")
+                        # transcode complete
+                        break
+
+                    c.send(bytes(line.encode()))
+
+                    response = c.recv(20)
+                    confirmation = response.decode()
+                    if confirmation == "PING":
+                        # ping received out of context, ignore
+                        continue
+                    elif confirmation == "STOP":
+                        proc.kill()
+                        print(f"[{self.thread_id}] Client stopped the transcode, cleaning up")
+                        vetoed = True
+                        break
+                    elif confirmation == "VETO":
+                        proc.kill()
+                        print(f"[{self.thread_id}] Client vetoed the transcode, cleaning up")
+                        vetoed = True
+                        break
+                    elif confirmation != "ACK!":
+                        proc.kill()
+                        print(f"[{self.thread_id}] Protocol error - expected ACK from client, got {confirmation}")
+                        print("Cleaning up")
+                        vetoed = True
+                        break
+
+                # wait for process to end
+                while proc.poll() is None:
+                    time.sleep(1)
+
+                if not vetoed:
+                    if proc.returncode != 0:
+                        print(f"[{self.thread_id}] > ERR")
+                        c.send(bytes(f"ERR|{proc.returncode}".encode()))
+                        print(f"[{self.thread_id}] Cleaning up")
+                    else:
+                        print(f"[{self.thread_id}] > DONE")
+                        filesize = os.path.getsize(tmp_filename)
+                        c.send(bytes(f"DONE|{proc.returncode}|{filesize}".encode()))
+                        # wait for response, then send file
+                        response = c.recv(4).decode()
+                        if response == "ACK!":
+                            # send the file back
+                            print(f"[{self.thread_id}] sending transcoded file")
+                            with open(tmp_filename, "rb") as input_file:
+                                c.sendfile(input_file)
+                            print(f"[{self.thread_id}] done")
+                        else:
+                            print(f"[{self.thread_id}] expected ACK, got {response}")
+                else:
+                    print(f"[{self.thread_id}] veto")
+
+                os.remove(tmp_filename)
+                os.remove(output_filename)
 
 
 class Agent:
     PORT = 9567
+    # connections served at once, further controllers wait to be accepted
+    MAX_SESSIONS = 16
+
+    def __init__(self, slots: Optional[Dict[str, int]] = None):
+        self.slots = EncoderSlots(DEFAULT_SLOTS if slots is None else slots)
+        self.cache = InputCache()
 
     def serve(self):
         s = socket.socket()
+        # accepted connections inherit the buffer sizes
+        protocol.tune_socket(s)
         s.bind(("", self.PORT))
         s.listen(10)
         thread_count = 1
+        sessions = BoundedSemaphore(self.MAX_SESSIONS)
+        print("encoder slots: " + ", ".join(f"{name}={count}" for name, count in self.slots.limits.items()))
 
         while True:
+            sessions.acquire()
             print(f"listening on port {self.PORT}...")
             c, addr = s.accept()
+            protocol.tune_socket(c)
             print(f"thread {thread_count} start")
-            Runner(c, addr, thread_count).start()
+            Runner(c, addr, thread_count, self.slots, sessions, self.cache).start()
             thread_count += 1
@@ -1,19 +1,64 @@
 import datetime
+import hashlib
 import os
 import traceback
-from queue import Queue
 import socket
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import PurePath
+from random import randint
+from tempfile import gettempdir
+from threading import Event, Lock
+from typing import Dict, List, Optional, Tuple
 
 import wandarr
+from wandarr import protocol
 from wandarr.agent import Agent
 from wandarr.base import ManagedHost, RemoteHostProperties, EncodeJob
+from wandarr.capabilities import Capabilities, option_value
+from wandarr.dispatch import Dispatcher
+from wandarr.ffmpeg import PIPE_INPUTS, PIPE_MUXERS
+
+# seconds without a frame from the agent before a job is given up, progress normally arrives far more often
+AGENT_TIMEOUT = 300
+
+
+class AgentUpload:
+    """A job sent to the agent, or queued for sending, with the upload of its source"""
+
+    def __init__(self, job: EncodeJob, job_id: int, cmd: List[str], stream: bool):
+        self.job = job
+        self.job_id = job_id
+        self.cmd = cmd
+        self.stream = stream
+        # the muxer never seeks back far, so the agent may return the output while it is written
+        self.progressive = option_value(cmd, ('-f',)) in PIPE_MUXERS.values()
+        self.out = None  # where the output goes, opened when its first part arrives
+        self.cancelled = Event()
+        self.future: Optional[Future] = None
+        self.answered = Event()     # set when the agent said whether it has the source cached
+        self.cached = False
 
 
 class AgentManagedHost(ManagedHost):
     """Implementation of an agent host worker thread"""
 
-    def __init__(self, hostname, props: RemoteHostProperties, queue: Queue):
-        super().__init__(hostname, props, queue)
+    stages_sources = True
+
+    def __init__(self, hostname, props: RemoteHostProperties, dispatcher: Dispatcher):
+        super().__init__(hostname, props, dispatcher)
+        self.sock: Optional[socket.socket] = None  # session with the agent, or connection of a version 1 job
+        self.protocol = protocol.VERSION  # lowered to 1 once the agent turns out to be an older release
+        self.send_lock = Lock()  # the upload thread shares the session with the job being monitored
+        self.last_job_id = 0
+        self.asking: Dict[int, AgentUpload] = {}  # uploads waiting to hear if the agent has their source
+
+    def terminate(self):
+        s = self.sock
+        if s is not None:
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
     #
     # override the standard ssh-based host_ok for agent verification
@@ -41,6 +86,21 @@ class AgentManagedHost(ManagedHost):
                 print(f"Agent not running on {self.props.ip}")
         return False
 
+    def discover(self) -> Optional[Capabilities]:
+        """Ask the agent what its ffmpeg supports, None if it did not answer or predates the INFO frame"""
+        try:
+            with self.open_connection() as s:
+                s.settimeout(30)
+                s.sendall(protocol.MAGIC)
+                protocol.send_message(s, protocol.HELLO, version=protocol.VERSION)
+                protocol.expect(s, protocol.HELLO)
+                protocol.send_message(s, protocol.INFO, ffmpeg=self.props.ffmpeg_path,
+                                      tempdir=self.props.working_dir)
+                fields = protocol.expect(s, protocol.INFO)
+        except (OSError, protocol.ProtocolError):
+            return None
+        return Capabilities.from_dict(fields) if fields else None
+
     #
     # initiate tests through here to avoid a new thread
     #
@@ -68,18 +128,17 @@ class AgentManagedHost(ManagedHost):
 
     def sendfile(self, s: socket.socket, in_path: str):
         with open(in_path, "rb") as f:
-            while True:
-                buf = f.read(4096)
-                s.send(buf)
-                if len(buf) < 4096:
-                    break
+            s.sendfile(f)
 
     def recvfile(self, s: socket.socket, filesize: int, tmp_file: str):
+        buffer = memoryview(bytearray(protocol.RECV_BUFFER))
         with open(tmp_file, "wb") as out:
             while filesize > 0:
-                blk = s.recv(1_000_000)
-                out.write(blk)
-                filesize -= len(blk)
+                n = s.recv_into(buffer, min(len(buffer), filesize))
+                if n == 0:
+                    raise protocol.PeerClosed("agent closed the connection during transfer")
+                out.write(buffer[:n])
+                filesize -= n
 
     def connect(self, s: socket.socket):
         s.connect((self.props.ip, Agent.PORT))
@@ -87,111 +146,406 @@ class AgentManagedHost(ManagedHost):
     def ack(self, s:socket.socket):
         s.send(bytes("ACK!".encode()))
 
-    def go(self):
-
-        while not self.queue.empty():
+    def open_connection(self) -> socket.socket:
+        s = socket.socket()
+        # buffer sizes must be set before connecting to take effect on the TCP window
+        protocol.tune_socket(s)
+        s.settimeout(AGENT_TIMEOUT)
+        s.connect((self.props.ip, Agent.PORT))
+        return s
+
+    def store_result(self, job: EncodeJob, tmp_file: str, orig_file_size_mb: int):
+        """Put the output received from the agent in place of the source"""
+        job.status = "done"
+        if not wandarr.KEEP_SOURCE:
+            in_path = job.in_path
+            os.unlink(in_path)
+            os.rename(tmp_file, in_path)
+            new_filesize_mb = int(os.path.getsize(in_path) / (1024 * 1024))
+
+            wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                      'file': os.path.basename(in_path),
+                                      'completed': 100,
+                                      'status': f'{orig_file_size_mb}mb -> {new_filesize_mb}mb'})
+
+    def can_stream(self, job: EncodeJob) -> bool:
+        """True if the agent may start encoding while the source is still arriving"""
+        return os.path.splitext(job.in_path)[1].lower() in PIPE_INPUTS
+
+    def command(self, job: EncodeJob) -> List[str]:
+        """ffmpeg command line of a job, {FILENAME} stands for the source as the agent receives it"""
+        video_cli = self.qualities[job.template.video_select()] if self.qualities else self.video_cli
+        return [self.props.ffmpeg_path, '-y', *job.template.input_options_list(), '-i', '{FILENAME}',
+                *video_cli.split(" "), *job.template.output_options_list(), *super().map_streams(job)]
+
+    def open_session(self) -> Optional[socket.socket]:
+        """The connection to the agent carrying this slot's jobs, opened on first use. None if the agent
+           only speaks the original protocol."""
+        if self.sock is not None:
+            return self.sock
+        s = self.open_connection()
+        self.sock = s
+        try:
+            s.sendall(protocol.MAGIC)
+            protocol.send_message(s, protocol.HELLO, version=protocol.VERSION)
+            protocol.expect(s, protocol.HELLO)
+        except ConnectionError:
+            # an agent from before protocol version 2 hangs up on an opening it does not recognize. Current
+            # agents also speak version 1, so falling back is safe even if this was a network error.
+            self.log(f"agent at {self.props.ip} only speaks protocol version 1")
+            self.protocol = 1
+            self.close_session({})
+            return None
+        return s
+
+    def close_session(self, uploads: Dict[EncodeJob, AgentUpload]):
+        """Close the connection, the agent drops whatever it still holds of this slot's jobs"""
+        for upload in [*uploads.values(), *self.asking.values()]:
+            upload.cancelled.set()
+            upload.answered.set()
+        uploads.clear()
+        s = self.sock
+        self.sock = None
+        if s is not None:
             try:
-                job: EncodeJob = self.queue.get()
-                in_path = job.in_path
-                orig_file_size_mb = int(os.path.getsize(in_path) / (1024 * 1024))
-
-                #
-                # build command line
-                #
-                video_options = self.video_cli.split(" ")
-                stream_map = super().map_streams(job)
+                # wakes the upload thread if it is blocked sending
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            s.close()
+
+    def announce(self, s: socket.socket, job: EncodeJob, cmd: List[str], stream: bool,
+                 uploader: ThreadPoolExecutor) -> AgentUpload:
+        """Queue a job and its source for sending to the agent"""
+        self.last_job_id += 1
+        upload = AgentUpload(job, self.last_job_id, cmd, stream)
+        upload.future = uploader.submit(self.upload_v2, s, upload)
+        return upload
+
+    def upload_v2(self, s: socket.socket, upload: AgentUpload) -> bool:
+        """Send a job and its source, on the upload thread. False if it was cancelled first."""
+        in_path = upload.job.in_path
+        cache = {}
+        digest = None
+        if self.props.input_cache > 0:
+            cache['cache_quota'] = self.props.input_cache * 1024 ** 3
+            known = self.ffmpeg.probe_cache
+            if known is None:
+                # nowhere to remember the hash, read the whole source for it first
+                cache['hash'] = protocol.file_hash(in_path)
+            elif source_hash := known.get_hash(in_path):
+                cache['hash'] = source_hash
+            else:
+                # hashed as it is sent, the agent caches it under the hash of what it received
+                digest = hashlib.sha256()
+        with self.send_lock:
+            if upload.cancelled.is_set():
+                return False
+            if 'hash' in cache:
+                self.asking[upload.job_id] = upload
+            protocol.send_message(s, protocol.JOB, upload.job_id, size=os.path.getsize(in_path),
+                                  tempdir=self.props.working_dir, filename=os.path.basename(in_path),
+                                  cli=upload.cmd, progress_interval=self.ffmpeg.monitor_interval,
+                                  stream=upload.stream, progressive=upload.progressive, **cache)
+        if 'hash' in cache:
+            # the thread reading the session passes on the answer
+            upload.answered.wait()
+            self.asking.pop(upload.job_id, None)
+            if upload.cancelled.is_set():
+                return False
+            if upload.cached:
+                if wandarr.VERBOSE:
+                    self.log(f"{os.path.basename(in_path)} is cached on the agent, not uploading")
+                return True
+        if not protocol.send_file(s, upload.job_id, in_path, lock=self.send_lock, cancelled=upload.cancelled,
+                                  digest=digest):
+            return False
+        if digest is not None:
+            self.ffmpeg.probe_cache.put_hash(in_path, digest.hexdigest())
+        return True
 
-                cmd = [self.props.ffmpeg_path, '-y', *job.template.input_options_list(), '-i', '{FILENAME}',
-                       *video_options,
-                       *job.template.output_options_list(), *stream_map]
+    def deliver(self, kind: int, job_id: int, fields: Dict):
+        """Act on a frame that is not about the job being monitored"""
+        upload = self.asking.get(job_id)
+        if kind == protocol.HAVE and upload is not None:
+            upload.cached = fields.get('cached', False)
+            upload.answered.set()
+        # anything else is about a job withdrawn while the agent was already working on it
+
+    def cancel_upload(self, s: socket.socket, upload: AgentUpload):
+        with self.send_lock:
+            # no frame of the job may follow the VETO
+            upload.cancelled.set()
+            upload.answered.set()
+            protocol.send_message(s, protocol.VETO, upload.job_id)
+
+    def prefetch(self, depth: int, s: socket.socket, uploads: Dict[EncodeJob, AgentUpload],
+                 uploader: ThreadPoolExecutor):
+        """Reserve the next jobs for this slot and send them behind the current one, so the agent starts on
+           the next as soon as the current one is done"""
+        while len(uploads) < depth:
+            job = self.dispatcher.reserve(self)
+            if job is None:
+                return
+            # streaming is only for a job the agent starts right away
+            uploads[job] = self.announce(s, job, self.command(job), False, uploader)
+
+    def drop_released(self, uploads: Dict[EncodeJob, AgentUpload], current: Optional[EncodeJob]):
+        """Withdraw jobs sent ahead that the dispatcher gave back to the pool"""
+        kept = self.dispatcher.reserved(self)
+        for job in [job for job in uploads if job is not current and job not in kept]:
+            upload = uploads.pop(job)
+            if self.sock is not None:
+                self.cancel_upload(self.sock, upload)
+
+    def monitor_v2(self, s: socket.socket, upload: AgentUpload, event_callback) -> Tuple[int, Dict]:
+        """Follow a running job until the agent reports its outcome. Returns (DONE, ERROR or VETO, fields)"""
+        running = False
+        buffer = memoryview(bytearray(protocol.RECV_BUFFER))
+        while True:
+            kind, job_id, size = protocol.recv_header(s)
+            if kind == protocol.DATA:
+                self.receive_output(s, upload, job_id, size, buffer)
+                continue
+            fields = protocol.recv_fields(s, kind, size)
+            if job_id != upload.job_id or kind == protocol.HAVE:
+                self.deliver(kind, job_id, fields)
+                continue
+            if kind == protocol.QUEUED:
+                # the agent's encoders are busy with other jobs
+                wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                          'file': os.path.basename(upload.job.in_path),
+                                          'status': f"Queued ({fields.get('position')})"})
+            elif kind == protocol.PROGRESS:
+                if not running:
+                    running = True
+                    wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                              'file': os.path.basename(upload.job.in_path),
+                                              'status': 'Running'})
+                if event_callback(fields):
+                    self.cancel_upload(s, upload)
+                    return protocol.VETO, fields
+            elif kind == protocol.DONE:
+                if fields.get('stats'):
+                    event_callback(fields['stats'])
+                return kind, fields
+            elif kind == protocol.ERROR:
+                # the rest of a source still uploading is of no use
+                upload.cancelled.set()
+                return kind, fields
+            else:
+                raise protocol.ProtocolError(f"unexpected {protocol.FRAME_NAMES[kind]} frame")
+
+    def receive_output(self, s: socket.socket, upload: AgentUpload, job_id: int, size: int, buffer: memoryview):
+        """Take part of the output of the job being monitored, sent while ffmpeg writes it. Output still in
+           flight when an earlier job was vetoed is dropped."""
+        if job_id != upload.job_id or not upload.progressive:
+            protocol.skip_data(s, size, buffer)
+            return
+        if upload.out is None:
+            upload.out = open(upload.job.tmp_name(upload.job.in_path), 'wb')
+        protocol.recv_data(s, size, upload.out, buffer)
+
+    def discard_output(self, upload: AgentUpload):
+        if upload.out is not None:
+            upload.out.close()
+            os.remove(upload.out.name)
+            upload.out = None
+
+    def write_log(self, lines: List[str]):
+        self.ffmpeg.log_path = PurePath(gettempdir(), f'wandarr-{self.name}-{randint(100, 999)}.log')
+        with open(str(self.ffmpeg.log_path), 'w', encoding='utf8') as logfile:
+            logfile.write('\n'.join(lines) + '\n')
+
+    def encode_v2(self, job: EncodeJob, cmd: List[str], uploads: Dict[EncodeJob, AgentUpload],
+                  uploader: ThreadPoolExecutor, depth: int = 0) -> bool:
+        """Run a job on the session over the framed protocol. Returns False, without having started it, if
+           the agent only speaks the original protocol."""
+        in_path = job.in_path
+        basename = os.path.basename(in_path)
+        orig_file_size_mb = int(os.path.getsize(in_path) / (1024 * 1024))
+
+        s = self.open_session()
+        if s is None:
+            return False
+        upload = uploads.pop(job, None)
+        if upload is None:
+            # nothing else is queued on the agent, so it can take the source as it arrives
+            upload = self.announce(s, job, cmd, self.can_stream(job), uploader)
+        wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                  'file': basename,
+                                  'status': 'Running' if upload.stream else 'Copying...'})
+
+        # sent behind this one, while it encodes
+        self.prefetch(depth, s, uploads, uploader)
+
+        # frames are read while the source goes out, the agent may have answers for the upload thread
+        job_start = datetime.datetime.now()
+        try:
+            outcome, fields = self.monitor_v2(s, upload, super().callback_wrapper(job))
+            # raises if the source did not get through
+            upload.future.result()
+        except Exception:
+            self.discard_output(upload)
+            raise
+        job_stop = datetime.datetime.now()
+
+        if outcome != protocol.DONE:
+            self.discard_output(upload)
+        if outcome == protocol.VETO:
+            # vetoed by threshold checker
+            job.status = "skipped"
+        elif outcome == protocol.ERROR:
+            job.status = "failed"
+            self.write_log(fields.get('log', []))
+            self.log(f"Agent returned process error code '{fields.get('code')}'")
+            self.log(f'Output can be found in {self.ffmpeg.log_path}')
+        elif not self.claim(job):
+            protocol.send_message(s, protocol.VETO, upload.job_id, lock=self.send_lock)
+            self.discard_output(upload)
+            self.log(f"{basename} finished first elsewhere, discarding this result")
+        else:
+            protocol.send_message(s, protocol.DONE, upload.job_id, lock=self.send_lock)
+            filesize = fields['size']
+            # what was not sent while encoding, older agents send it all now
+            follow = fields.get('follow', filesize)
+            tmp_file = job.tmp_name(in_path)
+            wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                      'file': basename,
+                                      'completed': 100,
+                                      'status': 'Retrieving'})
+            if wandarr.VERBOSE:
+                self.log(f"receiving ({follow} of {filesize} bytes)")
+            with upload.out or open(tmp_file, 'wb') as out:
+                upload.out = None
+                protocol.recv_file(s, upload.job_id, follow, out, self.deliver)
+                out.truncate(filesize)
+            self.store_result(job, tmp_file, orig_file_size_mb)
+        self.complete(in_path, (job_stop - job_start).seconds)
+        return True
 
-                basename = os.path.basename(job.in_path)
+    def encode_v1(self, job: EncodeJob, cmd: List[str]):
+        """Run a job over the original protocol, for agents older than protocol version 2"""
+        in_path = job.in_path
+        orig_file_size_mb = int(os.path.getsize(in_path) / (1024 * 1024))
+        basename = os.path.basename(job.in_path)
 
-                if super().dump_job_info(job, cmd):
-                    continue
+        s = socket.socket()
+        protocol.tune_socket(s)
+        self.sock = s
 
-                #
-                # Send to agent
-                #
-                s = socket.socket()
+        if wandarr.VERBOSE:
+            self.log(f"connect to '{self.props.ip}'", style="info")
 
-                opts_only = [*job.template.input_options_list(), *video_options,
-                             *job.template.output_options_list(), *stream_map]
-                print(f"{basename} -> ffmpeg {' '.join(opts_only)}")
+        self.connect(s)
 
-                wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
-                                          'file': basename,
-                                          'completed': 0,
-                                          'status': 'Connect'})
+        input_size = os.path.getsize(in_path)
+        tmpdir = self.props.working_dir
+        cmd_str = "$".join(cmd)
+        hello = f"HELLO|{input_size}|{tmpdir}|{basename}|{cmd_str}"
 
-                if wandarr.VERBOSE:
-                    self.log(f"connect to '{self.props.ip}'", style="info")
+        if not self.handshake(s, hello):
+            job.status = "failed"
+            return
 
-                self.connect(s)
+        # send the file
+        wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                  'file': basename,
+                                  'status': 'Copying...'})
 
-                input_size = os.path.getsize(in_path)
-                tmpdir = self.props.working_dir
-                cmd_str = "$".join(cmd)
-                hello = f"HELLO|{input_size}|{tmpdir}|{basename}|{cmd_str}"
+        self.sendfile(s, in_path)
 
-                if not self.handshake(s, hello):
-                    continue
+        wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                  'file': basename,
+                                  'status': 'Running'})
+        job_start = datetime.datetime.now()
+        finished, stats = self.ffmpeg.monitor_agent_ffmpeg(s, super().callback_wrapper(job),
+                                                           self.ffmpeg.monitor_agent)
+        job_stop = datetime.datetime.now()
 
-                # send the file
-                wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
-                                          'file': basename,
-                                          'status': 'Copying...'})
+        try:
+            if not finished:
+                # vetoed by threshold checker
+                job.status = "skipped"
+            else:
+                parts = stats.split(r"|")
+                if parts[0] == "DONE" and not self.claim(job):
+                    self.log(f"{basename} finished first elsewhere, discarding this result")
+                elif parts[0] == "DONE":
+                    self.ack(s)
+                    tag, exitcode, sent_filesize = parts
+                    filesize = int(sent_filesize)
+                    tmp_file = job.tmp_name(in_path)
+                    wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                              'file': basename,
+                                              'completed': 100,
+                                              'status': 'Retrieving'})
+
+                    if wandarr.VERBOSE:
+                        self.log(f"receiving ({filesize} bytes)")
+
+                    self.recvfile(s, filesize, tmp_file)
+                    self.store_result(job, tmp_file, orig_file_size_mb)
+
+                elif parts[0] == "ERR":
+                    job.status = "failed"
+                    self.log(f"Agent returned process error code '{parts[1]}'")
+                else:
+                    job.status = "failed"
+                    self.log(f"Unknown process code from agent: '{parts[0]}'")
+                self.complete(in_path, (job_stop - job_start).seconds)
+
+        except KeyboardInterrupt:
+            s.send(bytes("STOP".encode()))
 
-                self.sendfile(s, in_path)
+    def go(self):
 
-                wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
-                                          'file': basename,
-                                          'status': 'Running'})
-                job_start = datetime.datetime.now()
-                finished, stats = self.ffmpeg.monitor_agent_ffmpeg(s, super().callback_wrapper(job),
-                                                                   self.ffmpeg.monitor_agent)
-                job_stop = datetime.datetime.now()
+        # jobs to send ahead of the current one, so the agent moves on without waiting for the next
+        depth = 0 if wandarr.DRY_RUN else self.props.prefetch
+        uploads: Dict[EncodeJob, AgentUpload] = {}
 
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self.name}-upload") as uploader:
+            while (job := self.next_job()) is not None:
                 try:
-                    if finished:
-                        parts = stats.split(r"|")
-                        if parts[0] == "DONE":
-                            self.ack(s)
-                            tag, exitcode, sent_filesize = parts
-                            filesize = int(sent_filesize)
-                            tmp_file = in_path + ".tmp"
-                            wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
-                                                      'file': basename,
-                                                      'completed': 100,
-                                                      'status': 'Retrieving'})
-
-                            if wandarr.VERBOSE:
-                                self.log(f"receiving ({filesize} bytes)")
-
-                            self.recvfile(s, filesize, tmp_file)
-
-                            if not wandarr.KEEP_SOURCE:
-                                os.unlink(in_path)
-                                os.rename(tmp_file, in_path)
-                                new_filesize_mb = int(os.path.getsize(in_path) / (1024 * 1024))
-
-                                wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
-                                                          'file': basename,
-                                                          'completed': 100,
-                                                          'status': f'{orig_file_size_mb}mb -> {new_filesize_mb}mb'})
-
-                        elif parts[0] == "ERR":
-                            self.log(f"Agent returned process error code '{parts[1]}'")
-                        else:
-                            self.log(f"Unknown process code from agent: '{parts[0]}'")
-                        self.complete(in_path, (job_stop - job_start).seconds)
-
-                except KeyboardInterrupt:
-                    s.send(bytes("STOP".encode()))
-
-                s.close()
-
-            except Exception:
-                print(traceback.format_exc())
-            finally:
-                self.queue.task_done()
+                    self.drop_released(uploads, job)
+                    #
+                    # build command line
+                    #
+                    video_options = self.video_cli.split(" ")
+                    stream_map = super().map_streams(job)
+                    cmd = self.command(job)
+
+                    basename = os.path.basename(job.in_path)
+
+                    if super().dump_job_info(job, cmd):
+                        job.status = "skipped"
+                        continue
+
+                    opts_only = [*job.template.input_options_list(), *video_options,
+                                 *job.template.output_options_list(), *stream_map]
+                    print(f"{basename} -> ffmpeg {' '.join(opts_only)}")
+
+                    wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                              'file': basename,
+                                              'completed': 0,
+                                              'status': 'Connect'})
+
+                    #
+                    # Send to agent
+                    #
+                    if self.protocol < 2 or not self.encode_v2(job, cmd, uploads, uploader, depth):
+                        self.encode_v1(job, cmd)
+
+                except Exception:
+                    job.status = "failed"
+                    print(traceback.format_exc())
+                    # the session is out of step, the next job opens a new one
+                    self.close_session(uploads)
+                finally:
+                    if self.protocol < 2:
+                        # one connection per job
+                        self.close_session(uploads)
+                    self.job_done(job)
+
+            self.drop_released(uploads, None)
+            self.close_session(uploads)
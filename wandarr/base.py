@@ -2,12 +2,14 @@ import subprocess
 import sys
 from pathlib import PureWindowsPath, PosixPath
 from threading import Thread
-from typing import Dict, List
+from typing import Dict, List, Optional, Set, Tuple
 import os
 
 import wandarr
+from wandarr.capabilities import Capabilities, parse_report, remote_script
 from wandarr.ffmpeg import FFmpeg
 from wandarr.media import MediaInfo
+from wandarr.sshpool import ensure_master, ssh_options
 from wandarr.template import Template
 from wandarr.utils import get_local_os_type, calculate_progress
 
@@ -63,6 +65,34 @@ class RemoteHostProperties:
     def engines(self) -> Dict:
         return self.props.get('engines')
 
+    @property
+    def prefetch(self) -> int:
+        """Number of upcoming jobs a streaming or agent host uploads while encoding, 0 to work one job at a
+           time. Agents take one by default, their uploads go to the agent's own working dir."""
+        return self.props.get('prefetch', 1 if self.host_type == 'agent' else 0)
+
+    @property
+    def input_cache(self) -> int:
+        """Size in GB of the agent's cache of uploaded sources in working_dir, 0 for no cache"""
+        return self.props.get('input_cache', 0)
+
+    @property
+    def pipe(self) -> bool:
+        return self.props.get('pipe', False)
+
+    @property
+    def transfer_retries(self) -> int:
+        """Times an interrupted copy to or from a streaming host is resumed before the job fails"""
+        return self.props.get('transfer_retries', 3)
+
+    @property
+    def max_jobs(self) -> Optional[int]:
+        return self.props.get('max_jobs', None)
+
+    def engine_slots(self, engine_name: str) -> int:
+        """Number of jobs the named engine may run concurrently on this host"""
+        return self.props.get('engine_slots', {}).get(engine_name, 1)
+
     def substitute_paths(self, in_path, out_path):
         lst = self.props['path-substitutions']
         for item in lst:
@@ -116,42 +146,125 @@ class EncodeJob:
     in_path: str
     media_info: MediaInfo
     template_name: str
+    is_segment = False  # True for one part of a file encoded in segments, see wandarr.segments
 
     def __init__(self, in_path: str, info: MediaInfo, template: Template):
         self.in_path = os.path.abspath(in_path)
         self.media_info = info
         self.template = template
+        self.stats: Optional[Dict] = None  # latest progress reported by ffmpeg
+        self.status = "queued"  # then running, and finally done, skipped or failed
+        self.attempts = 0
+        self.failed_on: Set[Tuple[str, str]] = set()  # (host, engine) pairs that failed this job
+        self.not_before = 0.0  # time.monotonic() before which a retry may not start
+        self.twin: Optional["EncodeJob"] = None  # other copy, while the job also runs speculatively elsewhere
+        self.won = False  # this copy finished first and may replace the source
+        self.copy_tag = ""  # keeps the temporary files of a speculative copy apart from the original's
+
+    def tmp_name(self, path: str) -> str:
+        """Temporary name for output that ends up at path"""
+        return path + self.copy_tag + '.tmp'
+
+    def speed(self) -> Optional[float]:
+        """Average realtime factor so far, as reported by ffmpeg"""
+        if not self.stats:
+            return None
+        try:
+            return float(str(self.stats.get('speed', '')).strip())
+        except ValueError:
+            return None
+
+    def remaining_runtime(self) -> int:
+        done = self.stats.get('time', 0) if self.stats else 0
+        return max(self.media_info.runtime - done, 0)
 
     def should_abort(self, pct_done, pct_comp) -> bool:
         if self.template.threshold_check() < 100:
             return pct_done >= self.template.threshold_check() and pct_comp < self.template.threshold()
         return False
 
+    def finalize(self, host):
+        """Called by the host once the job has reached its final state and will not be retried"""
+
 
 class ManagedHost(Thread):
     """
         Base thread class for all remote host types.
     """
 
-    def __init__(self, hostname, props, queue):
+    # hosts that write their output next to the source can encode segments of a file
+    supports_segments = False
+    # hosts that copy each source to their working dir before encoding it
+    stages_sources = False
+
+    def __init__(self, hostname, props, dispatcher):
         """
         :param hostname:    name of host from cluster
         :param props:       dictionary of properties from cluster
-        :param queue:       Work queue assigned to this thread, could be many-to-one in the future.
+        :param dispatcher:  Shared source of jobs. This thread is one encoder slot of the host.
         """
         super().__init__(name=hostname, group=None, daemon=True)
         self.hostname = hostname
         self.props = props
-        self.queue = queue
+        self.dispatcher = dispatcher
         self._complete = []
         self.ffmpeg = FFmpeg(props.ffmpeg_path)
         self.video_cli = None
-        self.qname = None  # assigned queue
+        self.qname = None  # quality of the current job
         self.engine_name = None
+        self.qualities: Optional[Dict[str, str]] = None  # quality name -> video options of the assigned engine
+        self.capabilities: Optional[Capabilities] = None  # what the host's ffmpeg supports, if it could be asked
 
     def validate_settings(self):
         return self.props.validate_settings()
 
+    def can_encode(self, job: EncodeJob) -> bool:
+        if job.is_segment and not self.supports_segments:
+            return False
+        caps = self.capabilities
+        if caps is not None:
+            if caps.check([], job.template.input_options_list()) is not None:
+                return False
+            if self.stages_sources and caps.free_space is not None and \
+                    job.media_info.filesize_mb * 1024 * 1024 > caps.free_space:
+                return False
+        return self.qualities is None or job.template.video_select() in self.qualities
+
+    def capability_key(self) -> str:
+        """Names the host and ffmpeg in the capability cache"""
+        return '|'.join([self.hostname, self.props.props.get('ip', ''), self.props.ffmpeg_path or '',
+                         self.props.working_dir or ''])
+
+    def discover(self) -> Optional[Capabilities]:
+        """Ask the host what its ffmpeg supports, None if it did not answer"""
+        script = remote_script(self.props.ffmpeg_path, self.props.working_dir, self.props.is_windows())
+        try:
+            p = subprocess.run([*self.ssh_cmd(), script], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               shell=False, timeout=30, check=False)
+        except subprocess.TimeoutExpired:
+            return None
+        return parse_report(p.stdout.decode('utf-8', errors='replace'))
+
+    def next_job(self) -> Optional[EncodeJob]:
+        """Wait for the next job suitable for this slot, None when there is no more work"""
+        job = self.dispatcher.next_job(self)
+        if job is not None and self.qualities:
+            self.qname = job.template.video_select()
+            self.video_cli = self.qualities[self.qname]
+        return job
+
+    def claim(self, job: EncodeJob) -> bool:
+        """Call once the encode succeeded, before touching the source. False if a speculative copy of the
+           job already finished first, the caller then discards its output."""
+        if self.dispatcher.claim(self, job):
+            return True
+        job.status = "cancelled"
+        return False
+
+    def job_done(self, job: EncodeJob):
+        if self.dispatcher.task_done(self, job):
+            job.finalize(self)
+
     def complete(self, source, elapsed=0):
         self._complete.append((source, elapsed))
 
@@ -177,7 +290,7 @@ class ManagedHost(Thread):
         return str(PosixPath(path))
 
     def ssh_cmd(self):
-        return [wandarr.SSH, self.props.user + '@' + self.props.ip]
+        return [wandarr.SSH, *ssh_options(self.props.user, self.props.ip), self.props.user + '@' + self.props.ip]
 
     def ping_test_ok(self):
         addr = self.props.ip
@@ -208,6 +321,8 @@ class ManagedHost(Thread):
     def host_ok(self):
         if wandarr.DO_PING and not self.ping_test_ok():
             return False
+        # (re)start the shared connection first so the test and all later commands go through it
+        ensure_master(self.props.user, self.props.ip)
         return self.ssh_test_ok()
 
     def run_process(self, *args):
@@ -219,7 +334,8 @@ class ManagedHost(Thread):
         return p
 
     def terminate(self):
-        pass
+        """Abort the job in progress"""
+        self.ffmpeg.kill()
 
     def map_streams(self, job: EncodeJob):
         if job.media_info.is_multistream():
@@ -233,6 +349,7 @@ class ManagedHost(Thread):
             if not stats:
                 return False
 
+            job.stats = stats
             pct_done, pct_comp = calculate_progress(job.media_info, stats)
             wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
                                       'file': os.path.basename(job.in_path),
@@ -252,6 +369,36 @@ class ManagedHost(Thread):
 
         return log_callback
 
+    def segment_cli(self, job: EncodeJob, in_path: str, out_path: str) -> List[str]:
+        """Command line encoding only the video of a segment job, paths as seen by the encoding machine"""
+        return ['-y', *job.template.input_options_list(), *job.input_options(), '-i', in_path,
+                '-map', f'0:{job.media_info.stream}', *self.video_cli.split(" "), '-an', '-sn', '-f', 'matroska',
+                out_path]
+
+    def encode_segment(self, job: EncodeJob, cli: List[str], run) -> None:
+        """Run a segment job with the given runner (ffmpeg.run or run_remote bound to this host)"""
+        basename = f"{os.path.basename(job.in_path)} [{job.index + 1}/{len(job.group.segments)}]"
+        if self.dump_job_info(job, cli):
+            job.status = "skipped"
+            return
+        print(f"{basename} -> ffmpeg {' '.join(cli)}")
+        wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                  'file': basename,
+                                  'completed': 0})
+        code = run(cli, self.callback_wrapper(job))
+        if code == 0:
+            job.status = "done"
+            wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}", 'file': basename,
+                                      'completed': 100})
+            return
+        job.status = "failed"
+        self.log(f'Did not complete normally: {self.ffmpeg.last_command}')
+        self.log(f'Output can be found in {self.ffmpeg.log_path}')
+        try:
+            os.remove(job.out_path)
+        except OSError:
+            pass
+
     def dump_job_info(self, job: EncodeJob, cli):
         if wandarr.DRY_RUN:
             #
@@ -0,0 +1,202 @@
+"""
+    What the ffmpeg of each host can do, asked once and cached
+"""
+import json
+import os
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+from typing import Dict, List, Optional
+
+from wandarr.probecache import default_cache_dir
+
+# separates the output of the commands run on a remote host in one go
+SECTION = "--- wandarr ---"
+# seconds a cached free space figure is trusted, it changes far sooner than the encoders do
+FREE_SPACE_TTL = 600
+
+
+def option_value(options: List[str], names) -> Optional[str]:
+    """Value of the last of the named options, None if none is given"""
+    value = None
+    for option, arg in zip(options, options[1:]):
+        if option in names:
+            value = arg
+    return value
+
+
+def video_encoder(options: List[str]) -> Optional[str]:
+    """Video encoder chosen by ffmpeg options, None if left to ffmpeg"""
+    return option_value(options, ('-c:v', '-codec:v', '-vcodec'))
+
+
+def parse_version(output: str) -> Optional[str]:
+    """Version from the output of ffmpeg -version"""
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) >= 3 and parts[0] == 'ffmpeg' and parts[1] == 'version':
+            return parts[2]
+    return None
+
+
+def parse_encoders(output: str) -> List[str]:
+    """Names of the video encoders in the output of ffmpeg -encoders"""
+    encoders = []
+    for line in output.splitlines():
+        parts = line.split()
+        # " V....D hevc_nvenc   NVIDIA NVENC hevc encoder", the legend lines read " V..... = Video"
+        if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] == 'V' and parts[1] != '=':
+            encoders.append(parts[1])
+    return encoders
+
+
+def parse_hwaccels(output: str) -> List[str]:
+    """Names of the methods listed by ffmpeg -hwaccels"""
+    lines = output.splitlines()
+    for n, line in enumerate(lines):
+        if line.startswith('Hardware acceleration methods'):
+            return [name.strip() for name in lines[n + 1:] if name.strip()]
+    return []
+
+
+class Capabilities:
+    """Encoders and hardware acceleration available to a host's ffmpeg, and the room it has to work"""
+
+    def __init__(self, version: Optional[str] = None, encoders: List[str] = None, hwaccels: List[str] = None,
+                 cores: Optional[int] = None, free_space: Optional[int] = None, probed_at: float = 0.0):
+        self.version = version
+        self.encoders = encoders or []
+        self.hwaccels = hwaccels or []
+        self.cores = cores
+        self.free_space = free_space  # bytes free in the working dir, None if unknown
+        self.probed_at = probed_at or time.time()
+
+    def to_dict(self) -> Dict:
+        return {'version': self.version, 'encoders': self.encoders, 'hwaccels': self.hwaccels,
+                'cores': self.cores, 'free_space': self.free_space, 'probed_at': self.probed_at}
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "Capabilities":
+        return cls(d.get('version'), d.get('encoders'), d.get('hwaccels'), d.get('cores'), d.get('free_space'),
+                   d.get('probed_at', 0.0))
+
+    def check(self, video_options: List[str], input_options: List[str] = ()) -> Optional[str]:
+        """Why ffmpeg cannot run with the given options, None if it can. An empty list of encoders means
+           they could not be read, and nothing is ruled out."""
+        if not self.encoders:
+            return None
+        ffmpeg = f"ffmpeg {self.version}" if self.version else "ffmpeg"
+        encoder = video_encoder(video_options)
+        if encoder and encoder != 'copy' and encoder not in self.encoders:
+            return f"{ffmpeg} has no {encoder} encoder"
+        hwaccel = option_value(list(input_options), ('-hwaccel',))
+        if hwaccel and hwaccel != 'auto' and hwaccel not in self.hwaccels:
+            return f"{ffmpeg} has no {hwaccel} hwaccel"
+        return None
+
+    def __str__(self):
+        free = f"{self.free_space / 1024 ** 3:.0f}GB free" if self.free_space is not None else "free space unknown"
+        hwaccels = ', '.join(self.hwaccels) or 'none'
+        return (f"ffmpeg {self.version or '?'}, {len(self.encoders)} video encoders, hwaccels: {hwaccels}, "
+                f"{self.cores or '?'} cores, {free}")
+
+
+def local_capabilities(ffmpeg_path: str, directory: Optional[str] = None) -> Optional[Capabilities]:
+    """Ask the ffmpeg on this machine, None if it cannot be run"""
+    outputs = []
+    for option in ('-version', '-encoders', '-hwaccels'):
+        try:
+            p = subprocess.run([ffmpeg_path, '-hide_banner', option], capture_output=True, timeout=30, check=False)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        if p.returncode != 0:
+            return None
+        outputs.append(p.stdout.decode('utf8', errors='replace'))
+    free_space = None
+    if directory and os.path.isdir(directory):
+        free_space = shutil.disk_usage(directory).free
+    return Capabilities(parse_version(outputs[0]), parse_encoders(outputs[1]), parse_hwaccels(outputs[2]),
+                        os.cpu_count(), free_space)
+
+
+def remote_script(ffmpeg_path: str, directory: Optional[str], windows: bool) -> str:
+    """Shell command asking a remote host everything at once, its output is read by parse_report()"""
+    if windows:
+        ffmpeg = f'"{ffmpeg_path}"'
+        commands = [f'{ffmpeg} -hide_banner -version', f'{ffmpeg} -hide_banner -encoders',
+                    f'{ffmpeg} -hide_banner -hwaccels', 'echo %NUMBER_OF_PROCESSORS%']
+        return f' & echo {SECTION} & '.join(commands)
+    ffmpeg = shlex.quote(ffmpeg_path)
+    commands = [f'{ffmpeg} -hide_banner -version', f'{ffmpeg} -hide_banner -encoders',
+                f'{ffmpeg} -hide_banner -hwaccels', '(nproc || sysctl -n hw.ncpu) 2>/dev/null']
+    if directory:
+        commands.append(f'df -Pk {shlex.quote(directory)} | tail -1')
+    return f"; echo '{SECTION}'; ".join(commands)
+
+
+def parse_report(output: str) -> Optional[Capabilities]:
+    """Read the output of remote_script(), None if ffmpeg did not answer"""
+    sections = [section.strip() for section in output.split(SECTION)]
+    if len(sections) < 3 or parse_version(sections[0]) is None:
+        return None
+    cores = None
+    if len(sections) > 3 and sections[3].isdigit():
+        cores = int(sections[3])
+    free_space = None
+    if len(sections) > 4:
+        fields = sections[4].split()
+        # Filesystem 1024-blocks Used Available Capacity Mounted-on
+        if len(fields) >= 4 and fields[3].isdigit():
+            free_space = int(fields[3]) * 1024
+    return Capabilities(parse_version(sections[0]), parse_encoders(sections[1]), parse_hwaccels(sections[2]),
+                        cores, free_space)
+
+
+class CapabilityCache:
+    """SQLite store of the capabilities found per host, trusted for ttl seconds after they were asked"""
+
+    def __init__(self, path: str = None, ttl: int = 86400):
+        if path is None:
+            path = os.path.join(default_cache_dir(), 'capabilities.db')
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS capabilities (key TEXT PRIMARY KEY, info TEXT, '
+                         'probed_at REAL)')
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[Capabilities]:
+        with self._lock:
+            row = self._db.execute('SELECT info, probed_at FROM capabilities WHERE key=?', (key,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        capabilities = Capabilities.from_dict(json.loads(row[0]))
+        if time.time() - capabilities.probed_at > FREE_SPACE_TTL:
+            capabilities.free_space = None
+        return capabilities
+
+    def put(self, key: str, capabilities: Capabilities):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO capabilities (key, info, probed_at) VALUES (?,?,?)',
+                             (key, json.dumps(capabilities.to_dict()), capabilities.probed_at))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def open_capability_cache(config) -> Optional[CapabilityCache]:
+    """Open the capability cache, or None if disabled by a capability_ttl of 0 or unusable"""
+    if config.capability_ttl <= 0:
+        return None
+    try:
+        return CapabilityCache(ttl=config.capability_ttl)
+    except (sqlite3.Error, OSError) as ex:
+        print(f"Capability cache unavailable, hosts are asked every run: {ex}")
+        return None
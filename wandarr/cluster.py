@@ -4,20 +4,31 @@
 import os
 import signal
 import sys
-from queue import Queue
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import queue
 from threading import Thread
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 from rich.console import Console
 
 import wandarr
 from wandarr.agenthost import AgentManagedHost
 from wandarr.base import ManagedHost, RemoteHostProperties, EncodeJob
+from wandarr.capabilities import Capabilities, open_capability_cache
 from wandarr.config import ConfigFile
+from wandarr.dispatch import Dispatcher
 from wandarr.ffmpeg import FFmpeg
+from wandarr.health import HealthMonitor
+from wandarr.history import open_speed_history
+from wandarr.journal import open_journal
 from wandarr.localhost import LocalHost
+from wandarr.media import MediaInfo
 from wandarr.mountedhost import MountedManagedHost
+from wandarr.probecache import open_probe_cache
+from wandarr.segments import SegmentedEncode, segment_targets, split_points
 from wandarr.streaminghost import StreamingManagedHost
+from wandarr.template import Template
 
 
 class Cluster(Thread):
@@ -28,166 +39,307 @@ class Cluster(Thread):
         :param config:      The full configuration object
         """
         super().__init__(daemon=True)
-        self.queues: Dict[str, Queue] = {}
+        self.dispatcher = Dispatcher(wandarr.JOB_ORDER)
+        self.dispatcher.history = open_speed_history(config)
+        self.dispatcher.max_attempts = config.retries + 1
+        self.dispatcher.retry_backoff = config.retry_backoff
+        self.dispatcher.host_failure_limit = config.host_failure_limit
+        self.dispatcher.speculate = config.speculate
+        if not wandarr.DRY_RUN:
+            self.dispatcher.journal = open_journal(config)
         self.hosts: List[ManagedHost] = []
         self.config = config
         self.ffmpeg = FFmpeg(config.ffmpeg_path)
+        self.ffmpeg.probe_cache = open_probe_cache(config)
         self.completed: List = []
 
-        down_hosts = []
-        up_hosts = []
+        #
+        # resolve the host definitions first, then check all remote hosts at once
+        #
+        candidates = []
         for host, props in config.hosts.items():
-            if host in down_hosts:
-                continue
             host_props = RemoteHostProperties(host, props)
             if not host_props.is_enabled:
                 continue
             host_type = host_props.host_type
 
-            #
-            # each host gets a queue for each quality type, whether it is used or not
-            #
-            host_engines: Dict = host_props.engines
-            if len(host_engines) == 0:
+            match host_type:
+                case "local":
+                    host_class = LocalHost
+                case "mounted":
+                    host_class = MountedManagedHost
+                case "streaming":
+                    host_class = StreamingManagedHost
+                case "agent":
+                    host_class = AgentManagedHost
+                case _:
+                    print(f'Unknown cluster host type "{host_type}" - skipping')
+                    continue
+
+            if len(host_props.engines) == 0:
                 print(f"No engine(s) defined for host {host} - skipping")
                 continue
+            candidates.append((host, host_props, host_class))
 
-            for host_engine_name in host_engines:
-                if host in down_hosts:
-                    continue
+        probes = {host: host_class(host, host_props, self.dispatcher) for host, host_props, host_class in candidates}
+        status = self.check_hosts([(host, probe) for host, probe in probes.items()
+                                   if probe.props.host_type != "local"], config.discovery_timeout)
+        capabilities = self.discover_hosts([(host, probe) for host, probe in probes.items()
+                                            if host not in status or status[host][0]], config)
+
+        for host, host_props, host_class in candidates:
+            if host in status and not status[host][0]:
+                continue
+            caps = capabilities.get(host)
+            #
+            # each host gets one thread (slot) per concurrent job allowed on each of its engines
+            #
+            for host_engine_name in host_props.engines:
                 engine = self.config.engine(host_engine_name)
                 if not engine:
                     print(f"Engine {host_engine_name} not found for host {host} - skipping")
                     continue
-                eng_qualities = engine.qualities()
-                for qname, cli in eng_qualities.items():
-                    if host in down_hosts:
-                        continue
-                    if qname not in self.queues:
-                        self.queues[qname] = Queue()
-
-                    match host_type:
-                        case "local":
-                            if wandarr.VERBOSE:
-                                print(f"{host=} {qname=} {host_engine_name=} {cli=}")
-                            self._init_host_local(host, host_props, qname, host_engine_name, cli)
-
-                        case "mounted":
-                            if wandarr.VERBOSE:
-                                print(f"{host=} {qname=} {host_engine_name=} {cli=}")
-                            if not self._init_host_mounted(host, host_props, qname, host_engine_name, cli, host not in up_hosts):
-                                down_hosts.append(host)
-                                continue
-                            else:
-                                up_hosts.append(host)
-
-                        case "streaming":
-                            if wandarr.VERBOSE:
-                                print(f"{host=} {qname=} {host_engine_name=} {cli=}")
-                            if not self._init_host_streaming(host, host_props, qname, host_engine_name, cli, host not in up_hosts):
-                                down_hosts.append(host)
-                                continue
-                            else:
-                                up_hosts.append(host)
-
-                        case "agent":
-                            if wandarr.VERBOSE:
-                                print(f"{host=} {qname=} {host_engine_name=} {cli=}")
-                            if not self._init_host_agent(host, host_props, qname, host_engine_name, cli, host not in up_hosts):
-                               down_hosts.append(host)
-                               continue
-                            else:
-                                up_hosts.append(host)
-
-                        case _:
-                            print(f'Unknown cluster host type "{host_type}" - skipping')
-
-    def _init_host_local(self, host: str, host_props: RemoteHostProperties, qname: str, engine_name: str, cli: str):
-        _h = LocalHost(host, host_props, self.queues[qname])
-        if not _h.validate_settings():
-            sys.exit(1)
-        _h.video_cli = cli
-        _h.qname = qname
-        _h.engine_name = engine_name
-        self.hosts.append(_h)
-
-    def _init_host_mounted(self, host: str, host_props: RemoteHostProperties, qname: str, engine_name: str, cli: str, check_host: bool):
-        _h = MountedManagedHost(host, host_props, self.queues[qname])
-        if check_host and not _h.host_ok():
-            return False
-
-        if not _h.validate_settings():
-            sys.exit(1)
-        _h.video_cli = cli
-        _h.qname = qname
-        _h.engine_name = engine_name
-        self.hosts.append(_h)
-        return True
-
-    def _init_host_streaming(self, host: str, host_props: RemoteHostProperties, qname: str, engine_name: str, cli: str, check_host: bool):
-        _h = StreamingManagedHost(host, host_props, self.queues[qname])
-        if check_host and not _h.host_ok():
-            return False
-
-        if not _h.validate_settings():
-            sys.exit(1)
-        _h.video_cli = cli
-        _h.qname = qname
-        _h.engine_name = engine_name
-        self.hosts.append(_h)
-        return True
+                qualities = self.supported_qualities(host, host_engine_name, engine.qualities(), caps)
+                if not qualities:
+                    print(f"Engine {host_engine_name} not supported by host {host} - skipping")
+                    continue
+                for _ in range(host_props.engine_slots(host_engine_name)):
+                    if wandarr.VERBOSE:
+                        print(f"{host=} {host_engine_name=} qualities={list(qualities)}")
+                    self._init_host(host_class, host, host_props, host_engine_name, qualities, caps)
 
-    def _init_host_agent(self, host: str, host_props: RemoteHostProperties, qname: str, engine_name: str, cli: str, check_host: bool):
-        _h = AgentManagedHost(host, host_props, self.queues[qname])
-        if check_host and not _h.host_ok():
-            return False
+            self.dispatcher.set_max_jobs(host, host_props.max_jobs)
 
+    @staticmethod
+    def check_hosts(probes: List[Tuple[str, ManagedHost]], timeout: float) -> Dict[str, Tuple[bool, float]]:
+        """Run host_ok() for every host concurrently, giving up on any still unanswered after timeout seconds.
+           Returns hostname -> (up, seconds the check took).
+        """
+        if not probes:
+            return {}
+        results: Dict[str, Tuple[bool, float]] = {}
+
+        def check(hostname: str, probe: ManagedHost):
+            started = time.monotonic()
+            try:
+                ok = probe.host_ok()
+            except Exception:
+                print(traceback.format_exc())
+                ok = False
+            results[hostname] = (ok, time.monotonic() - started)
+
+        started = time.monotonic()
+        threads = [Thread(target=check, args=probe, daemon=True) for probe in probes]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(max(timeout - (time.monotonic() - started), 0))
+
+        status = {}
+        for hostname, _ in probes:
+            # copy, so late answers after the deadline don't change the outcome
+            status[hostname] = results.get(hostname, (False, timeout))
+            up, elapsed = status[hostname]
+            state = "up" if up else ("down" if hostname in results else "no answer")
+            print(f"{hostname:20}: {state} ({elapsed:.1f}s)")
+        return status
+
+    @staticmethod
+    def discover_hosts(probes: List[Tuple[str, ManagedHost]], config: ConfigFile) -> Dict[str, Capabilities]:
+        """What ffmpeg supports on every host, from the capability cache or by asking the hosts concurrently.
+           Hosts that do not answer within the discovery timeout are left out.
+        """
+        cache = open_capability_cache(config)
+        found: Dict[str, Capabilities] = {}
+        asked = []
+        for hostname, probe in probes:
+            caps = cache.get(probe.capability_key()) if cache is not None else None
+            if caps is not None:
+                found[hostname] = caps
+            else:
+                asked.append((hostname, probe))
+
+        def ask(hostname: str, probe: ManagedHost):
+            try:
+                caps = probe.discover()
+            except Exception:
+                print(traceback.format_exc())
+                return
+            if caps is None:
+                print(f"{hostname:20}: could not ask ffmpeg what it supports, engines not checked")
+                return
+            print(f"{hostname:20}: {caps}")
+            if cache is not None:
+                cache.put(probe.capability_key(), caps)
+            found[hostname] = caps
+
+        started = time.monotonic()
+        threads = [Thread(target=ask, args=probe, daemon=True) for probe in asked]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(max(config.discovery_timeout - (time.monotonic() - started), 0))
+        if cache is not None and not any(t.is_alive() for t in threads):
+            cache.close()
+        return dict(found)
+
+    @staticmethod
+    def supported_qualities(hostname: str, engine_name: str, qualities: Dict[str, str],
+                            caps: Optional[Capabilities]) -> Dict[str, str]:
+        """The qualities of an engine that the host's ffmpeg can encode, all of them if it was not asked"""
+        if caps is None:
+            return qualities
+        supported = {}
+        for name, video_cli in qualities.items():
+            reason = caps.check(video_cli.split())
+            if reason is None:
+                supported[name] = video_cli
+            else:
+                print(f"{hostname:20}: quality {name} of engine {engine_name} skipped, {reason}")
+        return supported
+
+    def _init_host(self, host_class, host: str, host_props: RemoteHostProperties, engine_name: str,
+                   qualities: Dict[str, str], caps: Optional[Capabilities] = None):
+        _h = host_class(host, host_props, self.dispatcher)
         if not _h.validate_settings():
             sys.exit(1)
-        _h.video_cli = cli
-        _h.qname = qname
+        _h.ffmpeg.probe_cache = self.ffmpeg.probe_cache
         _h.engine_name = engine_name
+        _h.qualities = qualities
+        _h.capabilities = caps
         self.hosts.append(_h)
-        return True
+        self.dispatcher.add_slot(_h)
 
-    def enqueue(self, file, template_name: str):
-        """Add a media file to this cluster queue.
-           This is different from in local mode in that we only care about handling skips here.
-           The profile will be selected once a host is assigned to the work
-        """
+    def check_template(self, template_name: str) -> Optional[Template]:
         if template_name is None:
             print("No template specified")
-            return None, None
+            return None
         if template_name not in self.config.templates:
             print(f"Template {template_name} not found")
-            return None, None
+            return None
+
+        template = self.config.templates[template_name]
+        video_quality = template.video_select()
+        if video_quality not in self.dispatcher.qualities:
+            print((f"Cannot match quality '{video_quality}' to any related host engines. "
+                  "Make sure there is at least one host with an engine that supports this quality."))
+            sys.exit(1)
+        return template
 
+    def _probe(self, file) -> Optional[MediaInfo]:
         path = os.path.abspath(file)
         if wandarr.VERBOSE:
             print('matching ' + path)
 
-        media_info = self.ffmpeg.fetch_details(path)
+        try:
+            media_info = self.ffmpeg.fetch_details(path)
+        except Exception as ex:
+            print(f'Unable to read media details from {path}: {ex}')
+            return None
 
         if media_info is None:
             print(f'File not found: {path}')
+            return None
+        if media_info.valid and wandarr.VERBOSE:
+            print(str(media_info))
+        return media_info
+
+    def _submit(self, file, media_info: Optional[MediaInfo], template: Template):
+        if media_info is None or not media_info.valid:
             return None, None
-        if media_info.valid:
-            if wandarr.VERBOSE:
-                print(str(media_info))
+        video_quality = template.video_select()
+        job = EncodeJob(file, media_info, template)
+        if self.hosts and not any(host.can_encode(job) for host in self.hosts):
+            print(f"No host has the ffmpeg support or free space to encode {file}")
+        group = self._segment(job)
+        if group is None:
+            self.dispatcher.submit(job)
+            return video_quality, job
 
-            template = self.config.templates[template_name]
+        if self.dispatcher.journal is not None:
+            self.dispatcher.journal.queued(job)
+        if wandarr.VERBOSE:
+            print(f"splitting {file} into {len(group.segments)} segments")
+        for segment in group.segments:
+            self.dispatcher.submit(segment)
+        return video_quality, job
+
+    def _segment(self, job: EncodeJob) -> Optional[SegmentedEncode]:
+        """Split a long source into segments when more than one host can work on it at once"""
+        length = self.config.segment_length
+        if length <= 0 or job.media_info.runtime < 2 * length:
+            return None
+        slots = [host for host in self.hosts if host.supports_segments and host.can_encode(job)]
+        if len(slots) < 2:
+            return None
+        targets = segment_targets(job.media_info.runtime, length)
+        cuts = split_points(job.media_info.runtime, length, self.ffmpeg.keyframes(job.in_path, targets))
+        if not cuts:
+            return None
+        return SegmentedEncode(job, cuts, self.config.ffmpeg_path, self.dispatcher.journal)
 
-            video_quality = template.video_select()
-            if video_quality not in self.queues:
-                print((f"Cannot match quality '{video_quality}' to any related host engines. "
-                      "Make sure there is at least one host with an engine that supports this quality."))
-                sys.exit(1)
-            job = EncodeJob(file, media_info, template)
-            self.queues[video_quality].put(job)
-            return video_quality, job
-        return None, None
+    def enqueue(self, file, template_name: str):
+        """Add a media file to the cluster's pending jobs.
+           This is different from in local mode in that we only care about handling skips here.
+           The profile will be selected once a host is assigned to the work
+        """
+        template = self.check_template(template_name)
+        if template is None:
+            return None, None
+        return self._submit(file, self._probe(file), template)
+
+    def enqueue_all(self, files, template_name: str) -> List[EncodeJob]:
+        """Probe a list of media files concurrently and queue a job for each valid one.
+           Jobs are queued in input order unless the config asks for probe_order: arrival, in which
+           case each job is queued as soon as its probe finishes.
+        """
+        template = self.check_template(template_name)
+        if template is None:
+            return []
+
+        jobs = []
+        with ThreadPoolExecutor(max_workers=self.config.probe_workers, thread_name_prefix="probe") as pool:
+            if self.config.probe_order == "arrival":
+                futures = {pool.submit(self._probe, file): file for file in files}
+                results = ((futures[f], f.result()) for f in as_completed(futures))
+            else:
+                results = zip(files, pool.map(self._probe, files))
+
+            for file, media_info in results:
+                _, job = self._submit(file, media_info, template)
+                if job:
+                    jobs.append(job)
+        return jobs
+
+    def enqueue_resumed(self, entries: List[Tuple[str, MediaInfo]], template_name: str) -> List[EncodeJob]:
+        """Queue the unfinished jobs of a journaled batch, reusing their recorded media details"""
+        template = self.check_template(template_name)
+        if template is None:
+            return []
+
+        jobs = []
+        for path, media_info in entries:
+            if not os.path.exists(path):
+                print(f'File not found: {path}')
+                continue
+            _, job = self._submit(path, media_info, template)
+            jobs.append(job)
+        return jobs
+
+    def produce(self, files, template_name: str, resumed: List[Tuple[str, MediaInfo]] = None):
+        """Feed jobs to the already running hosts, then signal the end of input"""
+        try:
+            if resumed is not None:
+                self.enqueue_resumed(resumed, template_name)
+            else:
+                self.enqueue_all(files, template_name)
+        except Exception:
+            print(traceback.format_exc())
+        finally:
+            self.dispatcher.close()
 
     def testrun(self):
+        self.dispatcher.close()
         for host in self.hosts:
             host.testrun()
 
@@ -200,23 +352,34 @@ class Cluster(Thread):
 
         for host in self.hosts:
             if wandarr.VERBOSE:
-                print(f"Starting {host.name} thread with queue {host.qname}")
+                print(f"Starting {host.name} thread for engine {host.engine_name}")
             host.start()
 
+        monitor = None
+        if self.config.health_interval > 0:
+            monitor = HealthMonitor(self.dispatcher, self.hosts, self.config.health_interval,
+                                    self.config.health_failures)
+            monitor.start()
+
         # all hosts running, wait for them to finish
         for host in self.hosts:
             host.join()
             self.completed.extend(host.completed)
 
+        if monitor is not None:
+            monitor.stop()
+
     def terminate(self):
+        self.dispatcher.close()
         for host in self.hosts:
             host.terminate()
 
 
-def manage_cluster(files, config: ConfigFile, template_name: str, testing=False) -> List:
+def manage_cluster(files, config: ConfigFile, template_name: str, testing=False, resume=False) -> List:
     """Main entry point for setup and execution of all jobs
 
         There is one thread for the cluster that manages multiple hosts, each having their own thread.
+        With resume, the files and template come from the unfinished jobs of the last journaled batch.
     """
     completed = []
 
@@ -236,16 +399,35 @@ def manage_cluster(files, config: ConfigFile, template_name: str, testing=False)
         print("Error initializing: " + str(ve))
         sys.exit(1)
 
-    for item in files:
-        cluster.enqueue(item, template_name)
+    journal = cluster.dispatcher.journal
+    resumed = None
+    if resume:
+        last = journal.last_batch() if journal else None
+        if last is None:
+            print('No journaled batch to resume')
+            return completed
+        batch, batch_template = last
+        template_name = template_name or batch_template
+        resumed = journal.unfinished(batch)
+        journal.resume_batch(batch)
+        print(f'Resuming batch {batch}: {len(resumed)} unfinished job(s)')
+
+    if cluster.check_template(template_name) is None:
+        return completed
+
+    if journal and not resume:
+        journal.new_batch(template_name)
 
     #
-    # Start cluster, which will start hosts too
+    # Start cluster, which will start hosts too. Hosts wait on the dispatcher while the files are
+    # probed and fed to them, so encoding begins as soon as the first job is ready.
     #
     if testing:
+        cluster.produce(files, template_name, resumed)
         cluster.testrun()
     else:
         cluster.start()
+        Thread(target=cluster.produce, args=(files, template_name, resumed), name="producer", daemon=True).start()
 
     def sig_handler(sig, frame):
         if cluster.is_alive():
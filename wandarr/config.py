@@ -86,3 +86,69 @@ class ConfigFile:
     def ssh_path(self):
         return self.settings.get('ssh', '/usr/bin/ssh')
 
+    @property
+    def probe_workers(self) -> int:
+        return max(1, int(self.settings.get('probe_workers', 4)))
+
+    @property
+    def probe_order(self) -> str:
+        return self.settings.get('probe_order', 'input')
+
+    @property
+    def probe_cache_path(self):
+        return self.settings.get('probe_cache', None)
+
+    @property
+    def probe_cache_size(self) -> int:
+        return self.settings.get('probe_cache_size', 50_000)
+
+    @property
+    def retries(self) -> int:
+        return self.settings.get('retries', 2)
+
+    @property
+    def retry_backoff(self) -> int:
+        return self.settings.get('retry_backoff', 30)
+
+    @property
+    def host_failure_limit(self) -> int:
+        return self.settings.get('host_failure_limit', 3)
+
+    @property
+    def ssh_multiplex(self) -> bool:
+        return self.settings.get('ssh_multiplex', True)
+
+    @property
+    def speculate(self) -> bool:
+        return self.settings.get('speculate', False)
+
+    @property
+    def segment_length(self) -> int:
+        return self.settings.get('segment_length', 0)
+
+    @property
+    def discovery_timeout(self) -> int:
+        return self.settings.get('discovery_timeout', 15)
+
+    @property
+    def capability_ttl(self) -> int:
+        """Seconds the ffmpeg capabilities found on a host are reused before asking again, 0 to always ask"""
+        return self.settings.get('capability_ttl', 86400)
+
+    @property
+    def health_interval(self) -> int:
+        return self.settings.get('health_interval', 60)
+
+    @property
+    def health_failures(self) -> int:
+        return self.settings.get('health_failures', 2)
+
+    @property
+    def journal_path(self):
+        return self.settings.get('journal', None)
+
+    @property
+    def speed_history(self):
+        """True for the default location, a path, or False to disable"""
+        return self.settings.get('speed_history', True)
+
@@ -0,0 +1,437 @@
+"""
+    Job distribution between the producer of encode jobs and the host threads consuming them
+"""
+import copy
+import os
+import time
+from collections import defaultdict
+from threading import Condition
+from typing import Callable, Dict, List, Optional, Set
+
+# codecs that are already efficient, re-encoding them saves comparatively little
+EFFICIENT_CODECS = ("hevc", "h265", "av1", "vp9")
+
+
+def estimated_work(job) -> float:
+    """Relative encode cost of a job, proportional to the number of pixels to be processed"""
+    mi = job.media_info
+    return max(mi.runtime, 1) * (mi.res_width * mi.res_height) * max(mi.fps, 1)
+
+
+def estimated_savings(job) -> float:
+    """Rough expected reduction in MB, large files in older codecs shrink the most"""
+    mi = job.media_info
+    factor = 0.3 if mi.vcodec in EFFICIENT_CODECS else 1.0
+    return mi.filesize_mb * factor
+
+
+#
+# Sort keys for pending jobs, lowest key is dispatched first. fifo keeps the submission order.
+#
+ORDER_POLICIES: Dict[str, Optional[Callable]] = {
+    "fifo": None,
+    "longest-first": lambda job: -estimated_work(job),
+    "smallest-first": lambda job: job.media_info.filesize_mb,
+    "savings-first": lambda job: -estimated_savings(job),
+}
+
+
+class Dispatcher:
+    """Central owner of the pending encode jobs.
+
+       Each host thread is one encoder slot. A slot asks for work with next_job() and is handed the first
+       pending job whose video quality its engine supports, as long as the host is below its max_jobs limit.
+       Slots block while nothing suitable is available, so they can be started before probing has finished,
+       and get None once input is closed and nothing is left for them.
+
+       The order policy decides which of the suitable pending jobs goes first, see ORDER_POLICIES.
+       With a speed history attached, a slot passes over a job when another slot is projected to finish it
+       clearly sooner, even counting the time that slot still needs for its current job, its reserved jobs
+       and the earlier candidates this slot already left to it.
+
+       A failed job goes back to the pending pool after an exponential backoff, for up to max_attempts runs
+       in total, and is steered away from the host/engine pairs it already failed on whenever another slot
+       could take it. A host that fails host_failure_limit jobs in a row is excluded for the rest of the batch.
+
+       With speculate enabled, once input is closed and nothing is pending, an idle slot may start a copy of
+       the in-flight job it is projected to finish clearly sooner than the slot now running it, going by
+       that job's live progress. The first copy to succeed claims the job and the other one is stopped.
+
+       A slot may reserve() jobs ahead of time to prepare them while it is busy, next_job() then hands them
+       back to it first. A slot can also detach() a job once its encoder is free but the results are still
+       being processed, so it can start on the next one before calling task_done() for the first.
+
+       A host reported down by the health monitor gets no work until it is reported up again, and its
+       running jobs go straight back to the pending pool.
+    """
+
+    # another slot must beat this one's projected finish by at least this factor to claim a job
+    PREFERENCE_MARGIN = 0.8
+    REEVALUATE_SECS = 5
+
+    def __init__(self, order: str = "fifo"):
+        if order not in ORDER_POLICIES:
+            raise ValueError(f"Unknown job order '{order}', expected one of {', '.join(ORDER_POLICIES)}")
+        self._order_key = ORDER_POLICIES[order]
+        self._cond = Condition()
+        self._pending: List = []
+        self._closed = False
+        self._slots: List = []
+        self._max_jobs: Dict[str, Optional[int]] = {}
+        self._running: Dict[str, int] = defaultdict(int)
+        self._current: Dict = {}  # active slot -> job it is running, None while waiting
+        self._reserved: Dict = defaultdict(list)  # slot -> jobs taken ahead of time, in order
+        self._detached: Set = set()  # jobs still being finished after their slot moved on
+        self._reclaimed: Set = set()  # jobs taken back from a host that went down
+        self._host_failures: Dict[str, int] = defaultdict(int)  # consecutive failures per host
+        self._excluded: Set[str] = set()
+        self._down: Set[str] = set()
+        self.history = None
+        self.journal = None
+        self.max_attempts = 1
+        self.retry_backoff = 30
+        self.host_failure_limit = 0     # 0 to never exclude a host
+        self.speculate = False
+
+    def add_slot(self, slot):
+        self._slots.append(slot)
+
+    def set_max_jobs(self, hostname: str, max_jobs: Optional[int]):
+        """Limit the number of concurrent jobs across all engines of a host, None for no limit"""
+        self._max_jobs[hostname] = max_jobs
+
+    @property
+    def qualities(self) -> Set[str]:
+        """All video qualities served by at least one slot"""
+        names = set()
+        for slot in self._slots:
+            names.update(slot.qualities or {})
+        return names
+
+    def _journal(self, event: str, job, *args):
+        # segments are journaled as the file they belong to, see wandarr.segments
+        if self.journal is not None and not job.is_segment:
+            getattr(self.journal, event)(job, *args)
+
+    def submit(self, job):
+        self._journal("queued", job)
+        with self._cond:
+            self._pending.append(job)
+            self._cond.notify_all()
+
+    def close(self):
+        """Mark the end of input and wake any slot waiting for work"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def pending_count(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def running_count(self, hostname: str) -> int:
+        with self._cond:
+            return self._running[hostname]
+
+    def _host_full(self, hostname: str) -> bool:
+        limit = self._max_jobs.get(hostname)
+        return limit is not None and self._running[hostname] >= limit
+
+    def _usable(self, slot) -> bool:
+        return slot in self._current and slot.hostname not in self._excluded and slot.hostname not in self._down
+
+    def host_down(self, hostname: str) -> List:
+        """Stop dispatching to a host and return its running jobs to the pending pool.
+           Returns the slots whose jobs were taken away, so the caller can abort them.
+        """
+        reclaimed = []
+        with self._cond:
+            self._down.add(hostname)
+            self._release_reserved(hostname)
+            for slot, job in self._current.items():
+                if slot.hostname != hostname or job is None:
+                    continue
+                reclaimed.append(slot)
+                self._current[slot] = None
+                self._running[hostname] -= 1
+                self._reclaimed.add(job)
+                if job.twin is not None and job.twin.status == "running":
+                    # a speculative copy runs elsewhere, let it carry on alone
+                    job.twin.twin = None
+                    continue
+                # the slot still holds the original job object, queue a fresh copy in its place
+                retry = copy.copy(job)
+                retry.status = "queued"
+                retry.stats = None
+                retry.failed_on = set(job.failed_on)
+                retry.twin = None
+                self._journal("queued", retry)
+                self._pending.append(retry)
+            self._cond.notify_all()
+        return reclaimed
+
+    def host_up(self, hostname: str):
+        with self._cond:
+            self._down.discard(hostname)
+            self._cond.notify_all()
+
+    def _release_reserved(self, hostname: str):
+        """Return the reserved jobs of a host's slots to the pending pool"""
+        for slot, jobs in self._reserved.items():
+            if slot.hostname == hostname and jobs:
+                self._pending.extend(jobs)
+                jobs.clear()
+                self._cond.notify_all()
+
+    def reserve(self, slot):
+        """Take the job this slot would be handed next, without waiting. The job stays queued and is
+           returned by the slot's next call to next_job(), so the slot can prepare it in the meantime."""
+        with self._cond:
+            if not self._usable(slot):
+                return None
+            job = self._select(slot)
+            if job is not None:
+                self._pending.remove(job)
+                self._reserved[slot].append(job)
+            return job
+
+    def reserved(self, slot) -> List:
+        """Jobs currently reserved by this slot, a job released back to the pool is no longer among them"""
+        with self._cond:
+            return list(self._reserved[slot])
+
+    def detach(self, slot, job):
+        """The slot's encoder is done with the job but its results are still being processed. The slot
+           may take its next job, task_done() is still due for this one."""
+        with self._cond:
+            if self._current.get(slot) is job:
+                self._current[slot] = None
+                self._running[slot.hostname] -= 1
+                self._detached.add(job)
+                self._cond.notify_all()
+
+    def _may_run(self, slot, job) -> bool:
+        """A job is not retried where it already failed unless no other usable slot can take it"""
+        if not slot.can_encode(job):
+            return False
+        if (slot.hostname, slot.engine_name) not in job.failed_on:
+            return True
+        return not any(self._usable(other) and other.can_encode(job) and
+                       (other.hostname, other.engine_name) not in job.failed_on
+                       for other in self._current if other is not slot)
+
+    def _candidates(self, slot) -> List:
+        """Pending jobs this slot could run now, in dispatch order"""
+        now = time.monotonic()
+        candidates = [job for job in self._pending if job.not_before <= now and self._may_run(slot, job)]
+        if self._order_key is not None:
+            # sort is stable, so ties stay in submission order
+            candidates.sort(key=self._order_key)
+        return candidates
+
+    def _expected_speed(self, slot, job) -> Optional[float]:
+        if self.history is None:
+            return None
+        return self.history.expected_speed(slot.hostname, slot.engine_name, job.template.video_select(),
+                                           job.media_info)
+
+    def _busy_for(self, slot) -> Optional[float]:
+        """Estimated seconds until the slot finishes its current job and the jobs it reserved, 0 if idle"""
+        current = self._current.get(slot)
+        if current is None:
+            busy_for = None if self._host_full(slot.hostname) else 0.0
+        else:
+            speed = current.speed() or self._expected_speed(slot, current)
+            busy_for = current.remaining_runtime() / speed if speed else None
+        for job in self._reserved[slot]:
+            if busy_for is None:
+                break
+            busy_for = self._finish_time(slot, job, busy_for)
+        return busy_for
+
+    def _finish_time(self, slot, job, busy_for: float) -> Optional[float]:
+        speed = self._expected_speed(slot, job)
+        if not speed:
+            return None
+        return busy_for + (job.media_info.runtime / speed)
+
+    def _better_slot(self, slot, job, queued: Dict):
+        """Another active slot projected to finish this job clearly sooner, even after completing its
+           current work and the jobs already passed to it in queued, or None"""
+        mine = self._finish_time(slot, job, 0.0)
+        if mine is None:
+            # no history for this slot yet, let it run the job and learn
+            return None
+        best, best_time = None, mine * self.PREFERENCE_MARGIN
+        for other in self._current:
+            if other is slot or not self._usable(other) or not self._may_run(other, job):
+                continue
+            busy_for = self._busy_for(other)
+            if busy_for is None:
+                continue
+            theirs = self._finish_time(other, job, busy_for + queued.get(other, 0.0))
+            if theirs is not None and theirs < best_time:
+                best, best_time = other, theirs
+        return best
+
+    def _select(self, slot):
+        # seconds of work each other slot is projected to take on before the next candidate
+        queued: Dict = defaultdict(float)
+        for job in self._candidates(slot):
+            other = self._better_slot(slot, job, queued)
+            if other is None:
+                return job
+            queued[other] += self._finish_time(other, job, 0.0)
+        return None
+
+    def _speculate(self, slot):
+        """Copy of the in-flight job this idle slot would gain the most time on, or None"""
+        best, best_gain = None, 0.0
+        for other, job in self._current.items():
+            if job is None or other.hostname == slot.hostname or job.is_segment or job.twin is not None:
+                continue
+            speed = job.speed()
+            if not speed or not self._may_run(slot, job):
+                continue
+            theirs = job.remaining_runtime() / speed
+            mine = self._finish_time(slot, job, 0.0)
+            if mine is not None and mine < theirs * self.PREFERENCE_MARGIN and theirs - mine > best_gain:
+                best, best_gain = job, theirs - mine
+        if best is None:
+            return None
+
+        print(f"Also running {os.path.basename(best.in_path)} on {slot.hostname}, projected to finish "
+              f"{int(best_gain)}s sooner")
+        copy_job = copy.copy(best)
+        copy_job.stats = None
+        copy_job.failed_on = set(best.failed_on)
+        copy_job.copy_tag = f".{slot.hostname}"
+        copy_job.twin = best
+        best.twin = copy_job
+        return copy_job
+
+    def claim(self, slot, job) -> bool:
+        """Called when a slot's run of a job succeeded, before it replaces the source. Returns False if the
+           other copy of a speculatively duplicated job finished first, or the job was taken back from the
+           slot's host, otherwise stops the other copy."""
+        loser = None
+        with self._cond:
+            if job in self._reclaimed:
+                # the host was reported down meanwhile and the job queued again, discard this late result
+                return False
+            if job.twin is None:
+                return True
+            if job.twin.won:
+                return False
+            job.won = True
+            loser = next((other for other, running in self._current.items() if running is job.twin), None)
+        if loser is not None:
+            print(f"{os.path.basename(job.in_path)} finished first on {slot.hostname}, "
+                  f"stopping the copy on {loser.hostname}")
+            loser.terminate()
+        return True
+
+    def _work_remaining(self, slot) -> bool:
+        """True while a pending job, or one running elsewhere that might fail and return, suits this slot"""
+        return (bool(self._reserved[slot]) or any(slot.can_encode(job) for job in self._pending) or
+                any(job is not None and slot.can_encode(job) for job in self._current.values()))
+
+    def _wait_time(self, slot) -> Optional[float]:
+        waiting = [job for job in self._pending if slot.can_encode(job)]
+        if not waiting:
+            if self.speculate and self._closed:
+                # projections of running jobs change as they progress
+                return self.REEVALUATE_SECS
+            return None
+        # re-check periodically as projections change and retry backoffs expire
+        now = time.monotonic()
+        return max(min([self.REEVALUATE_SECS] + [job.not_before - now for job in waiting]), 0.05)
+
+    def next_job(self, slot):
+        """Block until a job this slot can run is available, or return None once input is exhausted"""
+        with self._cond:
+            self._current[slot] = None
+            while True:
+                if slot.hostname in self._excluded:
+                    self._release_reserved(slot.hostname)
+                    del self._current[slot]
+                    return None
+                if slot.hostname in self._down:
+                    pass
+                elif not self._host_full(slot.hostname):
+                    if self._reserved[slot]:
+                        # taken off the pending list when it was reserved
+                        job = self._reserved[slot].pop(0)
+                    else:
+                        job = self._select(slot)
+                        if job is not None:
+                            self._pending.remove(job)
+                        elif self.speculate and self._closed and not self._pending:
+                            job = self._speculate(slot)
+                    if job is not None:
+                        self._running[slot.hostname] += 1
+                        self._current[slot] = job
+                        break
+                if self._closed and not self._work_remaining(slot):
+                    del self._current[slot]
+                    return None
+                self._cond.wait(self._wait_time(slot))
+
+        job.status = "running"
+        job.attempts += 1
+        self._journal("started", job, f"{slot.hostname}/{slot.engine_name}")
+        return job
+
+    def _failed(self, slot, job) -> bool:
+        """Account for a failed job, returns True if it should be retried"""
+        job.failed_on.add((slot.hostname, slot.engine_name))
+        self._host_failures[slot.hostname] += 1
+        if 0 < self.host_failure_limit <= self._host_failures[slot.hostname] and \
+                slot.hostname not in self._excluded:
+            print(f"Excluding host {slot.hostname} after {self._host_failures[slot.hostname]} consecutive failures")
+            self._excluded.add(slot.hostname)
+        if job.attempts >= self.max_attempts:
+            return False
+        job.not_before = time.monotonic() + self.retry_backoff * (2 ** (job.attempts - 1))
+        return True
+
+    def task_done(self, slot, job) -> bool:
+        """Account for a job the slot has stopped running, returns True if the job is final and
+           will not be run again"""
+        if job.status == "running":
+            # host ended the job without reporting an outcome
+            job.status = "failed"
+        with self._cond:
+            if job in self._reclaimed:
+                # job was taken back when the host went down, it has been queued again already
+                self._reclaimed.discard(job)
+                return False
+            if job in self._detached:
+                self._detached.discard(job)
+            else:
+                self._running[slot.hostname] -= 1
+                self._current[slot] = None
+            twin = job.twin
+            if twin is not None and (twin.won or (job.status != "done" and twin.status == "running")):
+                # the other copy won, or carries on alone after this one did not succeed
+                if not twin.won:
+                    twin.twin = None
+                self._cond.notify_all()
+                return False
+            retry = False
+            if job.status == "failed":
+                retry = self._failed(slot, job)
+            elif job.status == "done":
+                self._host_failures[slot.hostname] = 0
+            if retry:
+                print(f"Retrying {os.path.basename(job.in_path)} (attempt {job.attempts + 1} of {self.max_attempts})")
+                job.status = "queued"
+                self._journal("queued", job)
+                self._pending.append(job)
+            else:
+                self._journal("finished", job)
+            self._cond.notify_all()
+        if self.history is not None and job.speed():
+            self.history.record(slot.hostname, slot.engine_name, job.template.video_select(), job.media_info,
+                                job.speed())
+        return not retry
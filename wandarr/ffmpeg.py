@@ -1,23 +1,126 @@
 import datetime
+import io
 import os
 import re
+import shutil
 import subprocess
 import sys
 import threading
+from contextlib import contextmanager
 from pathlib import PurePath
 from random import randint
 import socket
 from tempfile import gettempdir
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import json
 
 from wandarr.media import MediaInfo
+from wandarr.sshpool import ssh_options
 
 status_re = re.compile(
     r'^.* fps=\s*(?P<fps>.+?) q=(?P<q>.+\.\d) size=\s*(?P<size>\d+?)kB time=(?P<time>\d\d:\d\d:\d\d\.\d\d) .*speed=(?P<speed>.*?)x')
 
 _CHARSET: str = sys.getdefaultencoding()
 
+PIPE_BUFFER = 1024 * 1024
+
+# containers ffmpeg can read from a pipe, and output muxers that never seek back in what they wrote
+PIPE_INPUTS = ('.mkv', '.webm', '.ts', '.m2ts', '.mpg', '.mpeg')
+PIPE_MUXERS = {'.mkv': 'matroska', '.webm': 'webm', '.ts': 'mpegts'}
+
+# machine-readable statistics on stdout instead of the status line ffmpeg keeps rewriting on stderr
+PROGRESS_OPTIONS = ['-nostats', '-progress', 'pipe:1']
+# the same on stderr, mixed with the log, for commands whose stdout carries the media
+PROGRESS_STDERR_OPTIONS = ['-nostats', '-progress', 'pipe:2']
+
+
+def parse_status(line: str) -> Optional[Dict[str, Any]]:
+    """Statistics from one ffmpeg status line, None if the line is something else. Only agents speaking
+       protocol version 1 still send these."""
+    match = status_re.match(line)
+    if match is None or len(match.groups()) < 5:
+        return None
+    info: Dict[str, Any] = match.groupdict()
+    info['size'] = int(info['size'].strip()) * 1024
+    hh, mm, ss = info['time'].split(':')
+    ss = ss.split('.')[0]
+    info['time'] = (int(hh) * 3600) + (int(mm) * 60) + int(ss)
+    return info
+
+
+def progress_field(line: str) -> Optional[Tuple[str, str]]:
+    """Key and value of a line of ffmpeg -progress output, None for any other line"""
+    key, sep, value = line.strip().partition('=')
+    if not sep or not key.isidentifier():
+        return None
+    return key, value.strip()
+
+
+def _number(value: Optional[str], kind=int):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def progress_stats(block: Dict[str, str]) -> Dict[str, Any]:
+    """Statistics from one block of -progress output. time (seconds) and size (bytes) are kept under the
+       names parse_status() uses."""
+    out_time_us = _number(block.get('out_time_us'))
+    total_size = _number(block.get('total_size'))
+    q = next((value for key, value in block.items() if key.startswith('stream_') and key.endswith('_q')), '')
+    return {'frame': _number(block.get('frame')),
+            'fps': block.get('fps', ''),
+            'q': q,
+            'bitrate': block.get('bitrate', ''),
+            'total_size': total_size,
+            'out_time_us': out_time_us,
+            'dup_frames': _number(block.get('dup_frames')),
+            'drop_frames': _number(block.get('drop_frames')),
+            'speed': block.get('speed', '').rstrip('x').strip(),
+            'progress': block.get('progress', ''),
+            'size': total_size,
+            'time': out_time_us / 1_000_000}
+
+
+class ProgressParser:
+    """Collects the key=value lines of ffmpeg -progress output, which come in blocks ending with progress="""
+
+    def __init__(self):
+        self.block: Dict[str, str] = {}
+
+    def feed(self, line: str) -> Optional[Dict[str, Any]]:
+        """Take one line of output, returns the statistics when it completes a block"""
+        field = progress_field(line)
+        if field is None:
+            return None
+        key, value = field
+        self.block[key] = value
+        if key != 'progress':
+            return None
+        stats = progress_stats(self.block)
+        self.block = {}
+        return stats
+
+
+def _feed(path: str, pipe):
+    """Copy a file into a process's stdin, stopping quietly if the process goes away"""
+    try:
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, pipe, PIPE_BUFFER)
+    except (BrokenPipeError, OSError):
+        pass
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+
+def _drain(pipe, path: str):
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(pipe, f, PIPE_BUFFER)
+
 
 class FFmpeg:
 
@@ -26,16 +129,33 @@ class FFmpeg:
         self.log_path: PurePath = None
         self.last_command = ''
         self.monitor_interval = 10
+        self.probe_cache = None
+        self.proc: Optional[subprocess.Popen] = None  # encode in progress, if any
+
+    @contextmanager
+    def transaction_log(self):
+        """Log of one run, left behind only if ffmpeg does not finish normally"""
+        self.log_path = PurePath(gettempdir(), f'wandarr-{threading.current_thread().name}-{randint(100, 999)}.log')
+        with open(str(self.log_path), 'w', encoding="utf8") as logfile:
+            yield logfile
+        if self.proc is not None and self.proc.returncode == 0:
+            try:
+                os.remove(str(self.log_path))
+            except OSError:
+                pass
+            self.log_path = None
 
     def execute_and_monitor(self, params, event_callback, monitor) -> Optional[int]:
         self.last_command = ' '.join([self.path, *params])
-        with subprocess.Popen([self.path,
-                               *params],
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
-                              universal_newlines=True,
-                              shell=False) as p:
-
+        with self.transaction_log() as logfile, \
+                subprocess.Popen([self.path,
+                                  *PROGRESS_OPTIONS,
+                                  *params],
+                                 stdout=subprocess.PIPE,
+                                 stderr=logfile,
+                                 universal_newlines=True,
+                                 shell=False) as p:
+            self.proc = p
             for stats in monitor(p):
                 if event_callback is not None:
                     veto = event_callback(stats)
@@ -57,13 +177,15 @@ class FFmpeg:
         return True, stats
 
     def remote_execute_and_monitor(self, sshcli: str, user: str, ip: str, params: list, event_callback, monitor) -> Optional[int]:
-        cli = [sshcli, '-v', user + '@' + ip, self.path, *params]
+        cli = [sshcli, '-v', *ssh_options(user, ip), user + '@' + ip, self.path, *PROGRESS_OPTIONS, *params]
         self.last_command = ' '.join(cli)
-        with subprocess.Popen(cli,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
-                              universal_newlines=True,
-                              shell=False) as p:
+        with self.transaction_log() as logfile, \
+                subprocess.Popen(cli,
+                                 stdout=subprocess.PIPE,
+                                 stderr=logfile,
+                                 universal_newlines=True,
+                                 shell=False) as p:
+            self.proc = p
             try:
                 for stats in monitor(p):
                     if event_callback is not None:
@@ -76,6 +198,52 @@ class FFmpeg:
                 p.kill()
         return None
 
+    def run_remote_piped(self, sshcli: str, user: str, ip: str, params: list, in_path: str, out_path: str,
+                         event_callback) -> Optional[int]:
+        """Run ffmpeg remotely with the source fed to its stdin and its stdout written to out_path, so
+           transfers overlap the encode and nothing is staged on the remote host. params must read
+           pipe:0 and write pipe:1.
+        """
+        cli = [sshcli, *ssh_options(user, ip), user + '@' + ip, self.path, *PROGRESS_STDERR_OPTIONS, *params]
+        self.last_command = ' '.join(cli)
+        with self.transaction_log() as logfile, \
+                subprocess.Popen(cli,
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 shell=False) as p:
+            self.proc = p
+            feeder = threading.Thread(target=_feed, args=(in_path, p.stdin), daemon=True)
+            drain = threading.Thread(target=_drain, args=(p.stdout, out_path), daemon=True)
+            feeder.start()
+            drain.start()
+            try:
+                # progress goes to stderr with the log as stdout carries the media
+                status = io.TextIOWrapper(p.stderr, encoding='utf8', errors='replace')
+                for stats in self.monitor_ffmpeg(p, status, logfile):
+                    if event_callback is not None:
+                        veto = event_callback(stats)
+                        if veto:
+                            p.kill()
+                            return None
+                return p.returncode
+            except KeyboardInterrupt:
+                p.kill()
+            except BaseException:
+                # stop ssh first, the transfer threads only end with it
+                p.kill()
+                raise
+            finally:
+                feeder.join()
+                drain.join()
+        return None
+
+    def kill(self):
+        """Stop the encode in progress, if any"""
+        p = self.proc
+        if p is not None and p.poll() is None:
+            p.kill()
+
     def fetch_details(self, _path: str) -> MediaInfo:
         """Use ffmpeg to get media information
 
@@ -83,6 +251,18 @@ class FFmpeg:
         :return:        Instance of MediaInfo
         """
 
+        if self.probe_cache is not None:
+            mi = self.probe_cache.get(_path)
+            if mi is not None:
+                return mi
+
+        mi = self._probe(_path)
+        if self.probe_cache is not None and mi.valid:
+            self.probe_cache.put(_path, mi)
+        return mi
+
+    def _probe(self, _path: str) -> MediaInfo:
+
         #
         # try ffprobe first since it's json output just better. ffprobe is typically installed in the same
         # location as ffmpeg
@@ -120,46 +300,52 @@ class FFmpeg:
             info = json.loads(output)
             return MediaInfo.parse_ffprobe_details_json(_path, info)
 
-    def monitor_ffmpeg(self, proc: subprocess.Popen):
+    def keyframes(self, _path: str, targets: List[float], window: int = 10) -> List[float]:
+        """Timestamps of the video keyframes found within window seconds after each target time.
+           Only the packets around the targets are read, not the whole file.
+        """
+        ffprobe_path = str(PurePath(self.path).parent.joinpath('ffprobe'))
+        if not targets or not os.path.exists(ffprobe_path):
+            return []
+        intervals = ','.join(f'{t:.3f}%+{window}' for t in targets)
+        args = [ffprobe_path, '-v', 'error', '-select_streams', 'v:0', '-read_intervals', intervals,
+                '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', _path]
+        with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+            output = proc.stdout.read().decode(encoding='utf8')
+        times = set()
+        for line in output.splitlines():
+            pts, _, flags = line.partition(',')
+            if 'K' in flags:
+                try:
+                    times.add(float(pts))
+                except ValueError:
+                    pass
+        return sorted(times)
+
+    def monitor_ffmpeg(self, proc: subprocess.Popen, output=None, logfile=None):
+        """Follow the -progress output of ffmpeg, yielding the latest statistics at most once per monitor interval
+           and once more when it ends. Where the progress shares its stream with the log, the other lines are
+           copied to logfile."""
         diff = datetime.timedelta(seconds=self.monitor_interval)
         event = datetime.datetime.now() + diff
 
-        #
-        # Create a transaction log for this run, to be left behind if an error is encountered.
-        #
-        suffix = randint(100, 999)
-        self.log_path: PurePath = PurePath(gettempdir(), 'wandarr-' +
-                                           threading.current_thread().name + '-' +
-                                           str(suffix) + '.log')
-
+        parser = ProgressParser()
         info: Dict[str, Any] = {}
 
-        with open(str(self.log_path), 'w', encoding="utf8") as logfile:
-            while proc.poll() is None:
-                line = proc.stdout.readline()
-                logfile.write(line)
-                logfile.flush()
-
-                match = status_re.match(line)
-                if match is not None and len(match.groups()) >= 5:
-                    info = match.groupdict()
-
-                    info['size'] = int(info['size'].strip()) * 1024
-                    hh, mm, ss = info['time'].split(':')
-                    ss = ss.split('.')[0]
-                    info['time'] = (int(hh) * 3600) + (int(mm) * 60) + int(ss)
-
-                    if datetime.datetime.now() > event:
-                        yield info
-                        event = datetime.datetime.now() + diff
-
-        if proc.returncode == 0:
-            # if we got here then everything went fine, so remove the transaction log
-            try:
-                os.remove(str(self.log_path))
-            except Exception:
-                pass
-            self.log_path = None
+        if output is None:
+            output = proc.stdout
+        for line in output:
+            stats = parser.feed(line)
+            if stats is None:
+                if logfile is not None and progress_field(line) is None:
+                    logfile.write(line)
+                continue
+            info = stats
+            if datetime.datetime.now() > event:
+                yield info
+                event = datetime.datetime.now() + diff
+
+        proc.wait()
         # yield the final info results before terminating loop
         yield info
 
@@ -194,17 +380,10 @@ class FFmpeg:
                 sock.send(bytes("ACK!".encode()))
                 line = c
 
-                match = status_re.match(line)
-                if match is not None and len(match.groups()) >= 5:
-                    if datetime.datetime.now() > event:
-                        event = datetime.datetime.now() + diff
-                        info: Dict[str, Any] = match.groupdict()
-
-                        info['size'] = int(info['size'].strip()) * 1024
-                        hh, mm, ss = info['time'].split(':')
-                        ss = ss.split('.')[0]
-                        info['time'] = (int(hh) * 3600) + (int(mm) * 60) + int(ss)
-                        yield info
+                info = parse_status(line)
+                if info is not None and datetime.datetime.now() > event:
+                    event = datetime.datetime.now() + diff
+                    yield info
 
     def run(self, params, event_callback) -> Optional[int]:
         return self.execute_and_monitor(params, event_callback, self.monitor_ffmpeg)
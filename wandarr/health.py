@@ -0,0 +1,63 @@
+"""
+    Background host health checks
+"""
+import traceback
+from collections import defaultdict
+from threading import Event, Thread
+from typing import Dict, List
+
+from wandarr.dispatch import Dispatcher
+
+
+class HealthMonitor(Thread):
+    """Periodically re-runs host_ok() against every remote host of the cluster.
+
+       Works as a circuit breaker per host: after failures_to_trip consecutive failed checks the host is
+       reported down, so the dispatcher stops handing it work and its running jobs are aborted and queued
+       again for the other hosts. The first successful check afterwards re-admits the host.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, hosts: List, interval: float, failures_to_trip: int = 2):
+        super().__init__(daemon=True)
+        self.dispatcher = dispatcher
+        self.interval = interval
+        self.failures_to_trip = max(failures_to_trip, 1)
+        # one slot per host is enough to run the checks, they all share the same connection details
+        self.probes: Dict = {}
+        for host in hosts:
+            if host.props.host_type != "local":
+                self.probes.setdefault(host.hostname, host)
+        self.failures: Dict[str, int] = defaultdict(int)
+        self.down = set()
+        self._halt = Event()
+
+    def _check(self, host) -> bool:
+        try:
+            return host.host_ok()
+        except Exception:
+            print(traceback.format_exc())
+            return False
+
+    def check_all(self):
+        for hostname, host in self.probes.items():
+            if self._check(host):
+                self.failures[hostname] = 0
+                if hostname in self.down:
+                    self.down.discard(hostname)
+                    host.log("reachable again, resuming dispatch")
+                    self.dispatcher.host_up(hostname)
+                continue
+
+            self.failures[hostname] += 1
+            if self.failures[hostname] >= self.failures_to_trip and hostname not in self.down:
+                self.down.add(hostname)
+                host.log(f"failed {self.failures[hostname]} health checks, pausing dispatch", style="magenta")
+                for slot in self.dispatcher.host_down(hostname):
+                    slot.terminate()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            self.check_all()
+
+    def stop(self):
+        self._halt.set()
@@ -0,0 +1,84 @@
+"""
+    Observed encode speeds, used to predict how long a job will take on a given host
+"""
+import os
+import sqlite3
+import threading
+from typing import Dict, Optional, Tuple
+
+from wandarr.probecache import default_cache_dir
+
+
+def resolution_class(height: int) -> int:
+    """Bucket a vertical resolution so that similar sources share speed samples"""
+    for limit in (480, 720, 1080, 1440):
+        if height <= limit:
+            return limit
+    return 2160
+
+
+class SpeedHistory:
+    """Realtime factor (ffmpeg's speed=) per host, engine, quality, source codec and resolution class.
+
+       Each sample is folded into an exponential moving average so the estimate follows driver or
+       hardware changes. Estimates for an unseen codec/resolution fall back to the host/engine/quality average.
+    """
+
+    # weight of the newest sample in the moving average
+    ALPHA = 0.3
+
+    def __init__(self, path: str = None):
+        if path is None:
+            path = os.path.join(default_cache_dir(), 'history.db')
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS speed ('
+                         'host TEXT, engine TEXT, quality TEXT, vcodec TEXT, resolution INTEGER, '
+                         'speed REAL, samples INTEGER, PRIMARY KEY (host, engine, quality, vcodec, resolution))')
+        self._db.commit()
+        self._speeds: Dict[Tuple, Tuple[float, int]] = {}
+        for host, engine, quality, vcodec, resolution, speed, samples in self._db.execute('SELECT * FROM speed'):
+            self._speeds[(host, engine, quality, vcodec, resolution)] = (speed, samples)
+
+    @staticmethod
+    def _key(host: str, engine: str, quality: str, media_info) -> Tuple:
+        return host, engine, quality, media_info.vcodec, resolution_class(media_info.res_height)
+
+    def record(self, host: str, engine: str, quality: str, media_info, speed: float):
+        if speed <= 0:
+            return
+        key = self._key(host, engine, quality, media_info)
+        with self._lock:
+            average, samples = self._speeds.get(key, (speed, 0))
+            average = speed if samples == 0 else (self.ALPHA * speed) + ((1 - self.ALPHA) * average)
+            self._speeds[key] = (average, samples + 1)
+            self._db.execute('INSERT OR REPLACE INTO speed VALUES (?,?,?,?,?,?,?)', (*key, average, samples + 1))
+            self._db.commit()
+
+    def expected_speed(self, host: str, engine: str, quality: str, media_info) -> Optional[float]:
+        """Predicted realtime factor, or None if this host/engine/quality has never been seen"""
+        key = self._key(host, engine, quality, media_info)
+        with self._lock:
+            if key in self._speeds:
+                return self._speeds[key][0]
+            related = [speed for k, (speed, _) in self._speeds.items() if k[:3] == key[:3]]
+        if related:
+            return sum(related) / len(related)
+        return None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def open_speed_history(config) -> Optional[SpeedHistory]:
+    if not config.speed_history:
+        return None
+    try:
+        path = config.speed_history if isinstance(config.speed_history, str) else None
+        return SpeedHistory(path)
+    except (sqlite3.Error, OSError) as ex:
+        print(f"Speed history unavailable, continuing without it: {ex}")
+        return None
@@ -0,0 +1,99 @@
+"""
+    Write-ahead record of every job in a batch, so an interrupted batch can be resumed
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from wandarr.media import MediaInfo
+from wandarr.probecache import default_cache_dir
+
+# states a job can be left in that mean it still needs to run
+UNFINISHED = ("queued", "running")
+
+
+class JobJournal:
+    """SQLite journal of job states (queued, running, done, skipped, failed) for each batch.
+
+       Every state change is committed before the work it describes continues, so whatever stops the
+       controller, the journal shows which jobs of the batch never finished. The parsed media details are
+       kept with each job so a resumed batch does not need to probe its files again.
+    """
+
+    def __init__(self, path: str = None):
+        if path is None:
+            path = os.path.join(default_cache_dir(), 'journal.db')
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS batch ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, template TEXT, created REAL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS job ('
+                         'batch INTEGER, path TEXT, state TEXT, host TEXT, info TEXT, '
+                         'queued REAL, started REAL, finished REAL, PRIMARY KEY (batch, path))')
+        self._db.commit()
+        self.batch: Optional[int] = None
+
+    def new_batch(self, template_name: str) -> int:
+        with self._lock:
+            cur = self._db.execute('INSERT INTO batch (template, created) VALUES (?,?)', (template_name, time.time()))
+            self._db.commit()
+            self.batch = cur.lastrowid
+        return self.batch
+
+    def last_batch(self) -> Optional[Tuple[int, str]]:
+        """Most recent batch as (id, template name)"""
+        with self._lock:
+            return self._db.execute('SELECT id, template FROM batch ORDER BY id DESC LIMIT 1').fetchone()
+
+    def resume_batch(self, batch: int):
+        self.batch = batch
+
+    def _update(self, sql: str, args: tuple):
+        if self.batch is None:
+            return
+        with self._lock:
+            self._db.execute(sql, args)
+            self._db.commit()
+
+    def queued(self, job):
+        self._update('INSERT INTO job (batch, path, state, info, queued) VALUES (?,?,?,?,?) '
+                     'ON CONFLICT (batch, path) DO UPDATE SET state=excluded.state, host=NULL',
+                     (self.batch, job.in_path, "queued", json.dumps(job.media_info.to_dict()), time.time()))
+
+    def started(self, job, host: str):
+        self._update('UPDATE job SET state=?, host=?, started=? WHERE batch=? AND path=?',
+                     ("running", host, time.time(), self.batch, job.in_path))
+
+    def finished(self, job):
+        self._update('UPDATE job SET state=?, finished=? WHERE batch=? AND path=?',
+                     (job.status, time.time(), self.batch, job.in_path))
+
+    def unfinished(self, batch: int) -> List[Tuple[str, MediaInfo]]:
+        """Jobs of a batch that were queued or running when it stopped, in queue order"""
+        with self._lock:
+            rows = self._db.execute(f'SELECT path, info FROM job WHERE batch=? AND state IN {UNFINISHED} '
+                                    'ORDER BY queued', (batch,)).fetchall()
+        return [(path, MediaInfo.from_dict(json.loads(info))) for path, info in rows]
+
+    def summary(self, batch: int) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute('SELECT state, COUNT(*) FROM job WHERE batch=? GROUP BY state', (batch,))
+            return dict(rows.fetchall())
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def open_journal(config) -> Optional[JobJournal]:
+    try:
+        return JobJournal(config.journal_path)
+    except (sqlite3.Error, OSError) as ex:
+        print(f"Job journal unavailable, continuing without it: {ex}")
+        return None
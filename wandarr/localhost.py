@@ -1,10 +1,12 @@
 import os
 import datetime
 import traceback
-from queue import Queue
+from typing import Optional
 
 import wandarr
-from .base import RemoteHostProperties, EncodeJob, ManagedHost
+from .base import RemoteHostProperties, ManagedHost
+from .capabilities import Capabilities, local_capabilities
+from .dispatch import Dispatcher
 from .utils import filter_threshold
 
 
@@ -12,8 +14,13 @@ class LocalHost(ManagedHost):
     """Implementation of a worker thread when the local machine is in the same cluster.
     Pretty much the same as the LocalHost class but without multiple dedicated queues"""
 
-    def __init__(self, hostname, props: RemoteHostProperties, queue: Queue):
-        super().__init__(hostname, props, queue)
+    supports_segments = True
+
+    def __init__(self, hostname, props: RemoteHostProperties, dispatcher: Dispatcher):
+        super().__init__(hostname, props, dispatcher)
+
+    def discover(self) -> Optional[Capabilities]:
+        return local_capabilities(self.props.ffmpeg_path, self.props.working_dir)
 
     #
     # initiate tests through here to avoid a new thread
@@ -29,9 +36,11 @@ class LocalHost(ManagedHost):
 
     def go(self):
 
-        while not self.queue.empty():
+        while (job := self.next_job()) is not None:
             try:
-                job: EncodeJob = self.queue.get()
+                if job.is_segment:
+                    self.encode_segment(job, self.segment_cli(job, job.in_path, job.out_path), self.ffmpeg.run)
+                    continue
 
                 in_path = job.in_path
 
@@ -39,7 +48,8 @@ class LocalHost(ManagedHost):
                 #
                 # calculate paths
                 #
-                out_path = in_path[0:in_path.rfind('.')] + job.template.extension() + '.tmp'
+                final_path = in_path[0:in_path.rfind('.')] + job.template.extension()
+                out_path = job.tmp_name(final_path)
 
                 #
                 # build command line
@@ -57,6 +67,7 @@ class LocalHost(ManagedHost):
                 basename = os.path.basename(job.in_path)
 
                 if super().dump_job_info(job, cli):
+                    job.status = "skipped"
                     continue
 
                 opts_only = [*job.template.input_options_list(), *video_options,
@@ -78,33 +89,41 @@ class LocalHost(ManagedHost):
                 #
                 if code is None:
                     # was vetoed by threshold checker, clean up
+                    job.status = "skipped"
                     self.complete(in_path, (job_stop - job_start).seconds)
                     os.remove(out_path)
                     continue
 
                 if code == 0:
+                    if not self.claim(job):
+                        os.remove(out_path)
+                        continue
                     wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}", 'file': basename, 'completed': 100})
                     if not filter_threshold(job.template, in_path, out_path):
+                        job.status = "skipped"
                         self.complete(in_path, (job_stop - job_start).seconds)
                         os.remove(out_path)
                         continue
 
+                    job.status = "done"
+
                     if not wandarr.KEEP_SOURCE:
                         if wandarr.VERBOSE:
                             self.log('removing ' + in_path)
                         os.remove(in_path)
                         if wandarr.VERBOSE:
                             self.log('renaming ' + out_path)
-                        os.rename(out_path, out_path[0:-4])
+                        os.rename(out_path, final_path)
                         self.complete(in_path, (job_stop - job_start).seconds)
 
-                        new_filesize_mb = int(os.path.getsize(out_path[0:-4]) / (1024 * 1024))
+                        new_filesize_mb = int(os.path.getsize(final_path) / (1024 * 1024))
                         wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
                                                   'file': basename,
                                                   'completed': 100,
                                                   'status': f'{orig_file_size_mb}mb -> {new_filesize_mb}mb'})
 
                 elif code is not None:
+                    job.status = "failed"
                     self.log(f'Did not complete normally: {self.ffmpeg.last_command}')
                     self.log(f'Output can be found in {self.ffmpeg.log_path}')
                     try:
@@ -113,6 +132,7 @@ class LocalHost(ManagedHost):
                         pass
 
             except Exception:
+                job.status = "failed"
                 self.log(traceback.format_exc())
             finally:
-                self.queue.task_done()
+                self.job_done(job)
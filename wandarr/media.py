@@ -65,6 +65,29 @@ class MediaInfo:
         self.audio: List[StreamInfoWrapper] = info['audio']
         self.subtitle: List[StreamInfoWrapper] = info['subtitle']
 
+    def to_dict(self) -> Dict:
+        """Flatten into a json-friendly dictionary, the inverse of from_dict()"""
+        return {
+            'path': self.path,
+            'vcodec': self.vcodec,
+            'stream': self.stream,
+            'res_height': self.res_height,
+            'res_width': self.res_width,
+            'runtime': self.runtime,
+            'filesize_mb': self.filesize_mb,
+            'fps': self.fps,
+            'colorspace': self.colorspace,
+            'audio': [a.data for a in self.audio],
+            'subtitle': [s.data for s in self.subtitle],
+        }
+
+    @staticmethod
+    def from_dict(info: Dict):
+        info = dict(info)
+        info['audio'] = [StreamInfoWrapper(a) for a in info.get('audio', [])]
+        info['subtitle'] = [StreamInfoWrapper(s) for s in info.get('subtitle', [])]
+        return MediaInfo(info)
+
     def __str__(self):
         runtime = "{:0>8}".format(str(timedelta(seconds=self.runtime)))
         print("DEBUG")
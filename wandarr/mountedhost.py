@@ -1,18 +1,20 @@
 import datetime
 import os
 import traceback
-from queue import Queue
 
 import wandarr
 from .base import ManagedHost, RemoteHostProperties, EncodeJob
+from .dispatch import Dispatcher
 from .utils import filter_threshold
 
 
 class MountedManagedHost(ManagedHost):
     """Implementation of a mounted host worker thread"""
 
-    def __init__(self, hostname, props: RemoteHostProperties, queue: Queue):
-        super().__init__(hostname, props, queue)
+    supports_segments = True
+
+    def __init__(self, hostname, props: RemoteHostProperties, dispatcher: Dispatcher):
+        super().__init__(hostname, props, dispatcher)
 
         # last modified paths - used for testing
         self.remote_in_path = None
@@ -31,18 +33,34 @@ class MountedManagedHost(ManagedHost):
         if self.host_ok():
             self.go()
 
+    def go_segment(self, job: EncodeJob):
+        remote_in_path, remote_out_path = job.in_path, job.out_path
+        if self.props.has_path_subst:
+            remote_in_path, remote_out_path = self.props.substitute_paths(remote_in_path, remote_out_path)
+        cmd = self.segment_cli(job, f'"{self.converted_path(remote_in_path)}"',
+                               f'"{self.converted_path(remote_out_path)}"')
+
+        def run(params, callback):
+            return self.ffmpeg.run_remote(wandarr.SSH, self.props.user, self.props.ip, params, callback)
+
+        self.encode_segment(job, cmd, run)
+
     def go(self):
 
-        while not self.queue.empty():
+        while (job := self.next_job()) is not None:
             try:
-                job: EncodeJob = self.queue.get()
+                if job.is_segment:
+                    self.go_segment(job)
+                    continue
+
                 in_path = job.in_path
                 orig_file_size_mb = int(os.path.getsize(in_path) / (1024 * 1024))
 
                 #
                 # calculate paths
                 #
-                out_path = in_path[0:in_path.rfind('.')] + job.template.extension() + '.tmp'
+                final_path = in_path[0:in_path.rfind('.')] + job.template.extension()
+                out_path = job.tmp_name(final_path)
                 self.remote_in_path = in_path
                 self.remote_out_path = out_path
                 if self.props.has_path_subst:
@@ -70,6 +88,7 @@ class MountedManagedHost(ManagedHost):
                 basename = os.path.basename(job.in_path)
 
                 if super().dump_job_info(job, cmd):
+                    job.status = "skipped"
                     continue
 
                 opts_only = [*job.template.input_options_list(), *video_options,
@@ -92,31 +111,39 @@ class MountedManagedHost(ManagedHost):
                 #
                 if code is None:
                     # was vetoed by threshold checker, clean up
+                    job.status = "skipped"
                     self.complete(in_path, (job_stop - job_start).seconds)
                     os.remove(out_path)
                     continue
 
                 if code == 0:
+                    if not self.claim(job):
+                        os.remove(out_path)
+                        continue
                     if not filter_threshold(job.template, in_path, out_path):
+                        job.status = "skipped"
                         self.complete(in_path, (job_stop - job_start).seconds)
                         os.remove(out_path)
                         continue
 
+                    job.status = "done"
+
                     if not wandarr.KEEP_SOURCE:
                         if wandarr.VERBOSE:
                             self.log('removing ' + in_path)
                         os.remove(in_path)
                         if wandarr.VERBOSE:
                             self.log('renaming ' + out_path)
-                        os.rename(out_path, out_path[0:-4])
+                        os.rename(out_path, final_path)
                         self.complete(in_path, (job_stop - job_start).seconds)
 
-                        new_filesize_mb = int(os.path.getsize(out_path[0:-4]) / (1024 * 1024))
+                        new_filesize_mb = int(os.path.getsize(final_path) / (1024 * 1024))
                         wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
                                                   'file': basename,
                                                   'completed': 100,
                                                   'status': f'{orig_file_size_mb}mb -> {new_filesize_mb}mb'})
                 elif code is not None:
+                    job.status = "failed"
                     self.log(f'Did not complete normally: {self.ffmpeg.last_command}')
                     self.log(f'Output can be found in {self.ffmpeg.log_path}')
                     try:
@@ -125,6 +152,7 @@ class MountedManagedHost(ManagedHost):
                         pass
 
             except Exception:
+                job.status = "failed"
                 print(traceback.format_exc())
             finally:
-                self.queue.task_done()
+                self.job_done(job)
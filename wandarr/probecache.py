@@ -0,0 +1,168 @@
+"""
+    Persistent cache of media probe results
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import wandarr
+from wandarr.media import MediaInfo
+
+
+def default_cache_dir() -> str:
+    if os.name == "nt":
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'wandarr')
+
+
+class ProbeCache:
+    """SQLite store of parsed MediaInfo keyed by absolute path, file size and modification time.
+
+       A file that has been touched or replaced since it was probed no longer matches its entry, so
+       the stale entry is dropped and the caller probes it again. The least recently used entries are
+       evicted once max_entries is exceeded. The content hashes of sources uploaded to agents are kept
+       alongside, under the same key.
+    """
+
+    # bump whenever the stored MediaInfo layout changes to discard old entries
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path: str = None, max_entries: int = 50_000):
+        if path is None:
+            path = os.path.join(default_cache_dir(), 'probe.db')
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            self._db.execute('DROP TABLE IF EXISTS probe')
+            self._db.execute(f'PRAGMA user_version={self.SCHEMA_VERSION}')
+        self._db.execute('CREATE TABLE IF NOT EXISTS probe ('
+                         'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, info TEXT, last_used REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS probe_last_used ON probe (last_used)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                         'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT, last_used REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)')
+        self._db.commit()
+        self._count = self._db.execute('SELECT COUNT(*) FROM probe').fetchone()[0]
+
+    @staticmethod
+    def _fingerprint(path: str) -> Optional[tuple]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def get(self, path: str) -> Optional[MediaInfo]:
+        path = os.path.abspath(path)
+        fingerprint = self._fingerprint(path)
+        if fingerprint is None:
+            return None
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime, info FROM probe WHERE path=?', (path,)).fetchone()
+            if row is None:
+                return None
+            if (row[0], row[1]) != fingerprint:
+                # file changed since it was probed
+                self._db.execute('DELETE FROM probe WHERE path=?', (path,))
+                self._db.commit()
+                self._count -= 1
+                return None
+            self._db.execute('UPDATE probe SET last_used=? WHERE path=?', (time.time(), path))
+            self._db.commit()
+        return MediaInfo.from_dict(json.loads(row[2]))
+
+    def put(self, path: str, media_info: MediaInfo):
+        if media_info is None or not media_info.valid:
+            return
+        path = os.path.abspath(path)
+        fingerprint = self._fingerprint(path)
+        if fingerprint is None:
+            return
+        info = json.dumps(media_info.to_dict())
+        with self._lock:
+            exists = self._db.execute('SELECT 1 FROM probe WHERE path=?', (path,)).fetchone() is not None
+            self._db.execute('INSERT OR REPLACE INTO probe (path, size, mtime, info, last_used) VALUES (?,?,?,?,?)',
+                             (path, fingerprint[0], fingerprint[1], info, time.time()))
+            if not exists:
+                self._count += 1
+            self._evict()
+            self._db.commit()
+
+    def get_hash(self, path: str) -> Optional[str]:
+        """Content hash recorded for a file, None if unknown or the file changed since"""
+        path = os.path.abspath(path)
+        fingerprint = self._fingerprint(path)
+        if fingerprint is None:
+            return None
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime, digest FROM hashes WHERE path=?', (path,)).fetchone()
+            if row is None:
+                return None
+            if (row[0], row[1]) != fingerprint:
+                self._db.execute('DELETE FROM hashes WHERE path=?', (path,))
+                self._db.commit()
+                return None
+            self._db.execute('UPDATE hashes SET last_used=? WHERE path=?', (time.time(), path))
+            self._db.commit()
+        return row[2]
+
+    def put_hash(self, path: str, digest: str):
+        path = os.path.abspath(path)
+        fingerprint = self._fingerprint(path)
+        if fingerprint is None:
+            return
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO hashes (path, size, mtime, digest, last_used) VALUES (?,?,?,?,?)',
+                             (path, fingerprint[0], fingerprint[1], digest, time.time()))
+            self._db.execute('DELETE FROM hashes WHERE path IN (SELECT path FROM hashes ORDER BY last_used DESC '
+                             'LIMIT -1 OFFSET ?)', (self.max_entries,))
+            self._db.commit()
+
+    def invalidate(self, path: str):
+        with self._lock:
+            cur = self._db.execute('DELETE FROM probe WHERE path=?', (os.path.abspath(path),))
+            self._count -= cur.rowcount
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM probe')
+            self._db.commit()
+            self._count = 0
+
+    def _evict(self):
+        excess = self._count - self.max_entries
+        if excess > 0:
+            self._db.execute('DELETE FROM probe WHERE path IN '
+                             '(SELECT path FROM probe ORDER BY last_used LIMIT ?)', (excess,))
+            self._count -= excess
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def open_probe_cache(config) -> Optional[ProbeCache]:
+    """Open the probe cache described by the configuration, or None if disabled or unusable"""
+    if not wandarr.PROBE_CACHE:
+        return None
+    try:
+        return ProbeCache(config.probe_cache_path, config.probe_cache_size)
+    except (sqlite3.Error, OSError) as ex:
+        print(f"Probe cache unavailable, continuing without it: {ex}")
+        return None
@@ -0,0 +1,233 @@
+"""
+    Framed messages between wandarr and its agents, protocol version 2
+
+    A version 2 connection opens with MAGIC, sent by the controller. Everything after it is a sequence of
+    frames: a header holding the payload length, the frame type and the id of the job the frame belongs to,
+    then the payload. Control frames carry a JSON object. DATA frames carry part of a file, prefixed with
+    the offset of that part in the file, so a file may be sent in any number of frames.
+
+    A connection is a session carrying any number of jobs. After the HELLO exchange the controller announces
+    each job with a JOB frame followed by its source, and may announce the next job while the agent still
+    encodes the previous one. The agent encodes the jobs of a session one at a time, in the order announced.
+    An INFO frame asks the agent what its ffmpeg supports instead.
+
+    When the controller asks for it and the output format allows, the agent sends the output as ffmpeg writes
+    it. Once ffmpeg exits, DONE says how many bytes are still to follow: the end of the file, and any part
+    ffmpeg rewrote after it was sent, such as the header of a matroska file.
+
+    Agents still accept the original line-based protocol (version 1) from older controllers, which never
+    send MAGIC.
+"""
+import hashlib
+import json
+import os
+import socket
+import struct
+from contextlib import nullcontext
+from threading import Event, Lock
+from typing import Callable, Dict, Optional, Tuple
+
+VERSION = 2
+MAGIC = b"WND2"
+
+HELLO = 1       # controller: open a session, agent: accepted, with the version to speak
+DATA = 2        # part of an input or output file
+PROGRESS = 3    # agent: latest encode statistics, sent at most once per progress interval
+DONE = 4        # agent: encode finished, with the output size and the bytes still to follow, controller: send them
+ERROR = 5       # agent: the job failed, with the exit code and the tail of the ffmpeg log
+VETO = 6        # controller: stop the job, or discard its output
+JOB = 7         # controller: job to run, its source follows as DATA frames
+QUEUED = 8      # agent: the job waits for a free encoder, with its place in the queue
+HAVE = 9        # agent: answer to a JOB giving the hash of its source, if cached no DATA is to follow
+INFO = 10       # controller: describe the agent's ffmpeg, agent: its version, encoders, hwaccels and room to work
+
+FRAME_NAMES = {HELLO: "HELLO", DATA: "DATA", PROGRESS: "PROGRESS", DONE: "DONE", ERROR: "ERROR", VETO: "VETO",
+               JOB: "JOB", QUEUED: "QUEUED", HAVE: "HAVE", INFO: "INFO"}
+
+# payload length, frame type, job id
+_HEADER = struct.Struct('!IBI')
+_OFFSET = struct.Struct('!Q')
+
+# largest control frame accepted, anything bigger means the stream is out of step
+MAX_MESSAGE = 1024 * 1024
+# largest part of a file sent in one DATA frame
+CHUNK_SIZE = 16 * 1024 * 1024
+# socket buffer sizes asked for, enough to keep a 10GbE link busy at LAN latencies
+SOCKET_BUFFER = 4 * 1024 * 1024
+# receive buffer, reused for every read of a transfer
+RECV_BUFFER = 1024 * 1024
+
+
+class ProtocolError(Exception):
+    """The peer sent something other than the frame expected"""
+
+
+class PeerClosed(ConnectionError):
+    """The peer closed the connection in an orderly way, as an agent does on an opening it does not know"""
+
+
+def recv_exact(sock: socket.socket, size: int) -> bytes:
+    """Read exactly size bytes, raising PeerClosed if the connection closes first"""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise PeerClosed("connection closed by peer")
+        received += n
+    return bytes(buf)
+
+
+def send_frame(sock: socket.socket, kind: int, job_id: int, payload: bytes = b'', lock: Optional[Lock] = None):
+    with lock or nullcontext():
+        sock.sendall(_HEADER.pack(len(payload), kind, job_id) + payload)
+
+
+def send_message(sock: socket.socket, kind: int, job_id: int = 0, lock: Optional[Lock] = None, **fields):
+    """Send a control frame. Threads sharing a socket pass the same lock so frames do not interleave."""
+    send_frame(sock, kind, job_id, json.dumps(fields).encode('utf8'), lock)
+
+
+def recv_header(sock: socket.socket) -> Tuple[int, int, int]:
+    """Read the next frame header, returns (type, job id, payload length)"""
+    size, kind, job_id = _HEADER.unpack(recv_exact(sock, _HEADER.size))
+    if kind not in FRAME_NAMES:
+        raise ProtocolError(f"unknown frame type {kind}")
+    if kind != DATA and size > MAX_MESSAGE:
+        raise ProtocolError(f"{FRAME_NAMES[kind]} frame of {size} bytes")
+    return kind, job_id, size
+
+
+def recv_fields(sock: socket.socket, kind: int, size: int) -> Dict:
+    """Read the payload of a control frame whose header has been read"""
+    try:
+        return json.loads(recv_exact(sock, size).decode('utf8')) if size else {}
+    except ValueError as ex:
+        raise ProtocolError(f"malformed {FRAME_NAMES[kind]} frame") from ex
+
+
+def recv_message(sock: socket.socket) -> Tuple[int, int, Dict]:
+    """Read the next control frame, returns (type, job id, fields)"""
+    kind, job_id, size = recv_header(sock)
+    if kind == DATA:
+        raise ProtocolError("unexpected DATA frame")
+    return kind, job_id, recv_fields(sock, kind, size)
+
+
+def expect(sock: socket.socket, kind: int, job_id: Optional[int] = None) -> Dict:
+    """Read the next control frame, which must be of the given type"""
+    got, got_id, fields = recv_message(sock)
+    if got != kind or (job_id is not None and got_id != job_id):
+        raise ProtocolError(f"expected {FRAME_NAMES[kind]}, got {FRAME_NAMES[got]}")
+    return fields
+
+
+def tune_socket(sock: socket.socket):
+    """Large buffers for bulk transfers, and no delay for the small control frames"""
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+        except OSError:
+            pass
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def send_data(sock: socket.socket, job_id: int, offset: int, data: bytes, lock: Optional[Lock] = None):
+    """Send part of a file held in memory as one DATA frame"""
+    send_frame(sock, DATA, job_id, _OFFSET.pack(offset) + data, lock)
+
+
+def send_file(sock: socket.socket, job_id: int, path: str, offset: int = 0, size: Optional[int] = None,
+              lock: Optional[Lock] = None, cancelled: Optional[Event] = None, digest=None) -> bool:
+    """Send size bytes of a file starting at offset, as DATA frames. The file contents go from the page
+       cache to the socket without passing through user space where the OS supports it, unless a hashlib
+       digest is given to be updated with them on the way.
+
+       Other threads may send frames on the same socket between the DATA frames while holding lock.
+       Returns False if the transfer was stopped early by setting cancelled, which is checked under lock.
+    """
+    with open(path, 'rb') as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size - offset
+        f.seek(offset)
+        while size > 0:
+            count = min(CHUNK_SIZE, size)
+            data = None
+            if digest is not None:
+                data = f.read(count)
+                if len(data) != count:
+                    raise PeerClosed(f"file shrank, {len(data)} of {count} bytes read")
+                digest.update(data)
+            with lock or nullcontext():
+                if cancelled is not None and cancelled.is_set():
+                    return False
+                sock.sendall(_HEADER.pack(_OFFSET.size + count, DATA, job_id) + _OFFSET.pack(offset))
+                if data is None:
+                    sent = sock.sendfile(f, offset, count)
+                else:
+                    sock.sendall(data)
+                    sent = count
+            if sent != count:
+                raise PeerClosed(f"file shrank or connection closed after {sent} of {count} bytes")
+            offset += count
+            size -= count
+    return True
+
+
+def skip_data(sock: socket.socket, size: int, buffer: Optional[memoryview] = None):
+    """Read and drop the payload of a DATA frame whose header has been read"""
+    if buffer is None:
+        buffer = memoryview(bytearray(RECV_BUFFER))
+    while size > 0:
+        n = sock.recv_into(buffer, min(len(buffer), size))
+        if n == 0:
+            raise PeerClosed("connection closed by peer")
+        size -= n
+
+
+def recv_data(sock: socket.socket, size: int, out, buffer: Optional[memoryview] = None) -> int:
+    """Read the payload of a DATA frame whose header has been read, writing it at its offset in the
+       file object out. Returns the number of file bytes received."""
+    if size < _OFFSET.size:
+        raise ProtocolError("short DATA frame")
+    offset, = _OFFSET.unpack(recv_exact(sock, _OFFSET.size))
+    if buffer is None:
+        buffer = memoryview(bytearray(RECV_BUFFER))
+    out.seek(offset)
+    remaining = size - _OFFSET.size
+    while remaining > 0:
+        n = sock.recv_into(buffer, min(len(buffer), remaining))
+        if n == 0:
+            raise PeerClosed("connection closed by peer")
+        out.write(buffer[:n])
+        remaining -= n
+    return size - _OFFSET.size
+
+
+def recv_file(sock: socket.socket, job_id: int, size: int, out,
+              on_message: Optional[Callable[[int, int, Dict], None]] = None) -> int:
+    """Receive DATA frames of a job into the file object out until size bytes arrived. Control frames for
+       other jobs arriving in between are passed to on_message(type, job id, fields). Returns the number
+       of bytes received."""
+    buffer = memoryview(bytearray(RECV_BUFFER))
+    received = 0
+    while received < size:
+        kind, frame_job, length = recv_header(sock)
+        if kind != DATA and on_message is not None and frame_job != job_id:
+            on_message(kind, frame_job, recv_fields(sock, kind, length))
+            continue
+        if kind != DATA or frame_job != job_id:
+            raise ProtocolError(f"expected DATA, got {FRAME_NAMES[kind]}")
+        received += recv_data(sock, length, out, buffer)
+    return received
+
+
+def file_hash(path: str) -> str:
+    """Hash of a file's contents, naming a source in an agent's input cache"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(RECV_BUFFER):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,200 @@
+"""
+    Segment-parallel encoding, one large file encoded by several hosts at once
+"""
+import copy
+import datetime
+import math
+import os
+import traceback
+from bisect import bisect_left
+from threading import Lock
+from typing import List, Optional
+
+import wandarr
+from wandarr.base import EncodeJob
+from wandarr.ffmpeg import FFmpeg
+from wandarr.utils import filter_threshold
+
+
+def segment_targets(runtime: int, segment_length: int) -> List[float]:
+    """Evenly spaced cut times splitting runtime into segments of at most segment_length seconds"""
+    count = math.ceil(runtime / segment_length)
+    return [runtime * n / count for n in range(1, count)]
+
+
+def split_points(runtime: int, segment_length: int, keyframes: List[float] = None) -> List[float]:
+    """Times at which to cut a source of the given runtime into segments of about segment_length seconds.
+       Each cut is moved to the first keyframe at or after it, when one is known.
+    """
+    keyframes = keyframes or []
+    cuts = []
+    for target in segment_targets(runtime, segment_length):
+        i = bisect_left(keyframes, target)
+        if i < len(keyframes):
+            target = keyframes[i]
+        if (not cuts or target > cuts[-1]) and target < runtime:
+            cuts.append(target)
+    return cuts
+
+
+def concat_stream_map(stream_map: List[str]) -> List[str]:
+    """Rewrite a Template.stream_map for the assembly step, where input 0 is the concatenated video
+       and input 1 is the original source supplying the audio and subtitle streams.
+    """
+    if not stream_map:
+        return ['-map', '0:v:0', '-map', '1:a?', '-map', '1:s?']
+    if stream_map == ['-map', '0']:
+        return ['-map', '0:v:0', '-map', '1', '-map', '-1:v']
+    result = ['-map', '0:v:0']
+    # the first mapping is always the video stream
+    args = iter(stream_map[2:])
+    for arg in args:
+        if arg == '-map':
+            result.extend(['-map', '1:' + next(args).split(':', 1)[1]])
+        else:
+            result.append(arg)
+    return result
+
+
+class SegmentJob(EncodeJob):
+    """Video of one time range of a source, encoded to its own file"""
+
+    is_segment = True
+
+    def __init__(self, group: "SegmentedEncode", index: int, start: float, end: Optional[float]):
+        parent = group.job
+        info = copy.copy(parent.media_info)
+        runtime = parent.media_info.runtime
+        duration = (end if end is not None else runtime) - start
+        info.runtime = max(int(duration), 1)
+        if runtime > 0:
+            info.filesize_mb = parent.media_info.filesize_mb * duration / runtime
+        super().__init__(parent.in_path, info, parent.template)
+        self.group = group
+        self.index = index
+        self.start = start
+        self.end = end
+        self.out_path = f"{group.base_path}.seg{index:03d}.mkv"
+
+    def input_options(self) -> List[str]:
+        """Seek and limit options, placed before -i so ffmpeg seeks the input accurately"""
+        opts = ['-ss', f'{self.start:.3f}']
+        if self.end is not None:
+            opts.extend(['-t', f'{self.end - self.start:.3f}'])
+        return opts
+
+    def should_abort(self, pct_done, pct_comp) -> bool:
+        # compression of a single segment says little about the whole file
+        return False
+
+    def finalize(self, host):
+        self.group.segment_finished(self, host)
+
+
+class SegmentedEncode:
+    """A source file split into segments that are queued as separate jobs.
+
+       Hosts encode only the video of each segment. When the last one is finished, the segments are joined
+       with the concat demuxer, without re-encoding, and muxed with the audio and subtitle streams of the
+       source as selected by the template. Segments are written next to the source, so only hosts sharing
+       its filesystem (local and mounted) take them.
+    """
+
+    def __init__(self, job: EncodeJob, cuts: List[float], ffmpeg_path: str, journal=None):
+        self.job = job
+        self.ffmpeg_path = ffmpeg_path
+        self.journal = journal
+        self.base_path = job.in_path[0:job.in_path.rfind('.')]
+        bounds = [0.0, *cuts, None]
+        self.segments = [SegmentJob(self, n, bounds[n], bounds[n + 1]) for n in range(len(bounds) - 1)]
+        self._outcomes = {}  # segment index -> final status, retried segments run as copies of the original
+        self._lock = Lock()
+        self.started = datetime.datetime.now()
+
+    def segment_finished(self, segment: SegmentJob, host):
+        """Called as each segment reaches its final state, assembles the output after the last one"""
+        with self._lock:
+            self._outcomes[segment.index] = segment.status
+            if len(self._outcomes) < len(self.segments):
+                return
+            states = set(self._outcomes.values())
+
+        if states == {"done"}:
+            try:
+                self.job.status = self.assemble(host)
+            except Exception:
+                self.job.status = "failed"
+                host.log(traceback.format_exc())
+        else:
+            self.job.status = "failed" if "failed" in states else "skipped"
+            if self.job.status == "failed":
+                host.log(f"{os.path.basename(self.job.in_path)}: a segment failed, output not assembled")
+        self.cleanup()
+        if self.journal is not None:
+            self.journal.finished(self.job)
+
+    def concat_list(self) -> str:
+        path = self.base_path + '.segments.txt'
+        with open(path, 'w', encoding='utf8') as f:
+            for segment in self.segments:
+                escaped = segment.out_path.replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        return path
+
+    def assemble_cli(self, list_path: str, out_path: str) -> List[str]:
+        mi = self.job.media_info
+        stream_map = []
+        if mi.is_multistream():
+            stream_map = self.job.template.stream_map(mi.stream, mi.audio, mi.subtitle)
+        return ['-y', '-f', 'concat', '-safe', '0', '-i', list_path, '-i', self.job.in_path,
+                *concat_stream_map(stream_map), '-c:v', 'copy',
+                *self.job.template.output_options_list(), out_path]
+
+    def assemble(self, host) -> str:
+        """Join the encoded segments into the final output, returns the job status"""
+        in_path = self.job.in_path
+        basename = os.path.basename(in_path)
+        out_path = self.base_path + self.job.template.extension() + '.tmp'
+        orig_file_size_mb = int(os.path.getsize(in_path) / (1024 * 1024))
+
+        ffmpeg = FFmpeg(self.ffmpeg_path)
+        cli = self.assemble_cli(self.concat_list(), out_path)
+        if wandarr.VERBOSE:
+            host.log(f"assembling {len(self.segments)} segments of {basename}")
+        code = ffmpeg.run(cli, None)
+        elapsed = (datetime.datetime.now() - self.started).seconds
+
+        if code != 0:
+            host.log(f'Did not complete normally: {ffmpeg.last_command}')
+            host.log(f'Output can be found in {ffmpeg.log_path}')
+            try:
+                os.remove(out_path)
+            except OSError:
+                pass
+            return "failed"
+
+        if not filter_threshold(self.job.template, in_path, out_path):
+            host.complete(in_path, elapsed)
+            os.remove(out_path)
+            return "skipped"
+
+        if not wandarr.KEEP_SOURCE:
+            if wandarr.VERBOSE:
+                host.log('removing ' + in_path)
+            os.remove(in_path)
+            os.rename(out_path, out_path[0:-4])
+            host.complete(in_path, elapsed)
+
+            new_filesize_mb = int(os.path.getsize(out_path[0:-4]) / (1024 * 1024))
+            wandarr.status_queue.put({'host': f"{host.hostname}/{host.engine_name}",
+                                      'file': basename,
+                                      'completed': 100,
+                                      'status': f'{orig_file_size_mb}mb -> {new_filesize_mb}mb'})
+        return "done"
+
+    def cleanup(self):
+        for path in [segment.out_path for segment in self.segments] + [self.base_path + '.segments.txt']:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,98 @@
+"""
+    Shared SSH connections, one multiplexing master per remote host
+"""
+import atexit
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Dict, List, Tuple
+
+import wandarr
+
+# seconds between keepalive probes on an idle master, and how many may go unanswered
+KEEPALIVE_INTERVAL = 30
+KEEPALIVE_COUNT = 3
+
+_lock = threading.Lock()
+_host_locks: Dict[Tuple[str, str], threading.Lock] = {}
+_masters: Dict[Tuple[str, str], str] = {}   # (user, ip) -> control socket of a running master
+_control_dir = None
+
+
+def _control_path(user: str, ip: str) -> str:
+    global _control_dir
+    with _lock:
+        if _control_dir is None:
+            # unix socket paths are limited to around 100 characters, the per-user temp dir on macOS is too deep
+            _control_dir = tempfile.mkdtemp(prefix='wandarr-ssh-', dir='/tmp' if os.path.isdir('/tmp') else None)
+    return os.path.join(_control_dir, f'{user}@{ip}')
+
+
+def _control(path: str, user: str, ip: str, command: str) -> bool:
+    p = subprocess.run([wandarr.SSH, '-o', f'ControlPath={path}', '-O', command, f'{user}@{ip}'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10, check=False)
+    return p.returncode == 0
+
+
+def ensure_master(user: str, ip: str) -> bool:
+    """Start the master connection to a host unless one is already up, True if it is usable"""
+    if not wandarr.SSH_MULTIPLEX:
+        return False
+    key = (user, ip)
+    with _lock:
+        host_lock = _host_locks.setdefault(key, threading.Lock())
+    with host_lock:
+        path = _control_path(user, ip)
+        try:
+            if key in _masters and _control(path, user, ip, 'check'):
+                return True
+            _masters.pop(key, None)
+            # -f returns once authenticated, leaving the master in the background
+            p = subprocess.run([wandarr.SSH, '-M', '-N', '-f',
+                                '-o', f'ControlPath={path}', '-o', 'ControlPersist=yes',
+                                '-o', f'ServerAliveInterval={KEEPALIVE_INTERVAL}',
+                                '-o', f'ServerAliveCountMax={KEEPALIVE_COUNT}',
+                                '-o', 'BatchMode=yes', f'{user}@{ip}'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=15, check=False)
+        except subprocess.TimeoutExpired:
+            return False
+        if p.returncode != 0:
+            return False
+        with _lock:
+            _masters[key] = path
+        return True
+
+
+def ssh_options(user: str, ip: str) -> List[str]:
+    """Options making ssh or scp reuse the host's master connection, empty if there is none"""
+    path = _masters.get((user, ip))
+    if path is None:
+        return []
+    return ['-o', f'ControlPath={path}']
+
+
+def rsync_options(user: str, ip: str) -> List[str]:
+    opts = ssh_options(user, ip)
+    if not opts:
+        return []
+    return ['-e', ' '.join([wandarr.SSH, *opts])]
+
+
+def close_all():
+    """Stop every master connection, called at exit"""
+    global _control_dir
+    with _lock:
+        for (user, ip), path in _masters.items():
+            try:
+                _control(path, user, ip, 'exit')
+            except subprocess.TimeoutExpired:
+                pass
+        _masters.clear()
+        if _control_dir is not None:
+            shutil.rmtree(_control_dir, ignore_errors=True)
+            _control_dir = None
+
+
+atexit.register(close_all)
@@ -1,20 +1,49 @@
 import os
 import datetime
+import hashlib
 import shutil
+import time
 import traceback
-from queue import Queue
-from tempfile import gettempdir
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
 
 import wandarr
 from wandarr.base import ManagedHost, RemoteHostProperties, EncodeJob
+from wandarr.dispatch import Dispatcher
+from wandarr.ffmpeg import PIPE_INPUTS, PIPE_MUXERS
+from wandarr.sshpool import rsync_options
 from wandarr.utils import filter_threshold, run, get_local_os_type
 
 
+# rsync exit codes for a dropped connection, stalled or partial transfer and failing ssh, worth resuming
+RSYNC_RETRY_CODES = (10, 11, 12, 20, 23, 30, 35, 255)
+# seconds without any data moving before rsync gives up on a transfer
+TRANSFER_TIMEOUT = 120
+
+
+class StreamingTask:
+    """Paths and command line of one job on a streaming host"""
+
+    def __init__(self, job: EncodeJob, in_path: str, out_path: str, remote_in_path: str, remote_out_path: str,
+                 piped: bool):
+        self.job = job
+        self.in_path = in_path
+        self.out_path = out_path
+        self.remote_in_path = remote_in_path
+        self.remote_out_path = remote_out_path
+        self.piped = piped
+        self.cmd: List[str] = []
+        self.opts_only: List[str] = []
+        self.upload: Optional[Future] = None  # upload started ahead of time, resolves to success
+
+
 class StreamingManagedHost(ManagedHost):
     """Implementation of a streaming host worker thread"""
 
-    def __init__(self, hostname, props: RemoteHostProperties, queue: Queue):
-        super().__init__(hostname, props, queue)
+    stages_sources = True
+
+    def __init__(self, hostname, props: RemoteHostProperties, dispatcher: Dispatcher):
+        super().__init__(hostname, props, dispatcher)
 
     #
     # initiate tests through here to avoid a new thread
@@ -29,176 +58,320 @@ class StreamingManagedHost(ManagedHost):
         if self.host_ok():
             self.go()
 
-    def go(self):
+    def finish(self, job: EncodeJob, code, in_path: str, out_path: str, retrieved_copy_name: str,
+               job_start, job_stop):
+        """Check the results of a finished encode, now available locally in retrieved_copy_name"""
+        if code is None:
+            # was vetoed by threshold checker, clean up
+            job.status = "skipped"
+            self.complete(in_path, (job_stop - job_start).seconds)
+
+        elif code == 0 and not self.claim(job):
+            # the other copy of the job finished first
+            os.remove(retrieved_copy_name)
+
+        elif code == 0:
+            if not filter_threshold(job.template, in_path, retrieved_copy_name):
+#                self.log(
+#                    f'Encoding file {in_path} did not meet minimum savings threshold, skipped')
+                job.status = "skipped"
+                self.complete(in_path, (job_stop - job_start).seconds)
+                os.remove(retrieved_copy_name)
+                return
+            self.complete(in_path, (job_stop - job_start).seconds)
+
+            if wandarr.COPY_METADATA:
+                exiftool = ['exiftool', '-q', '-overwrite_original', '-tagsfromfile',
+                       in_path, retrieved_copy_name]
+                self.log(' '.join(exiftool))
+
+                code, output = run(exiftool)
+                if code != 0:
+                    self.log('Unknown error copying source to remote - media skipped', style="magenta")
+                    if wandarr.VERBOSE:
+                        self.log(output)
+                    job.status = "failed"
+                    return
+            if wandarr.VERBOSE:
+                self.log(f'moving media to {in_path}')
+            shutil.move(retrieved_copy_name, out_path)
+            job.status = "done"
+
+        else:
+            job.status = "failed"
+            self.log(f'error during remote transcode of {in_path}', style="magenta")
+            self.log(f' Did not complete normally: {self.ffmpeg.last_command}')
+            self.log(f'Output can be found in {self.ffmpeg.log_path}')
+
+    def can_pipe(self, job: EncodeJob) -> bool:
+        """True if the job can stream through ssh instead of being copied to and from the host"""
+        return (self.props.pipe and os.path.splitext(job.in_path)[1].lower() in PIPE_INPUTS and
+                job.template.extension().lower() in PIPE_MUXERS)
+
+    def prepare(self, job: EncodeJob, announce: bool = True) -> Optional[StreamingTask]:
+        """Work out the paths and command line of a job, None if it is to be skipped"""
+        in_path = job.in_path
 
-        ssh_cmd = [wandarr.SSH, self.props.user + '@' + self.props.ip]
+        #
+        # Convert escaped spaces back to normal. Typical for bash to escape spaces and special characters
+        # in filenames.
+        #
+        in_path = in_path.replace('\\ ', ' ')
+
+        #
+        # calculate full input and output paths
+        #
+        remote_working_dir = self.props.working_dir
+        namenoext = '.'.join(os.path.basename(in_path).split('.')[0:-1])
+        # sources from different folders may share a name, and several can be staged at once
+        staged_name = namenoext + '.' + hashlib.md5(in_path.encode('utf8')).hexdigest()[0:8]
+        remote_in_path = os.path.join(remote_working_dir, staged_name + os.path.splitext(in_path)[1])
+        remote_out_path = os.path.join(remote_working_dir,
+                                       staged_name + job.copy_tag + '.tmp' + job.template.extension())
+        infolder = os.path.dirname(in_path)
+        outfolder = wandarr.OUTPUT_FOLDER
+        # Determine output file
+        if not outfolder:
+            outfolder = infolder
+        else:
+            if not os.path.exists(outfolder):
+                os.makedirs(outfolder)
+
+        if wandarr.OVERWRITE_SOURCE:
+            out_path = os.path.join(outfolder, namenoext+job.template.extension())
+            if os.path.exists(out_path) and wandarr.SKIP_EXISTING:
+                if announce:
+                    self.log(f'skipping existing file {out_path}')
+                    job.status = "skipped"
+                return None
+        else:
+            out_path = os.path.join(outfolder, namenoext+f'.wandarr-{job.template.name()}{job.template.extension()}')
+            if os.path.exists(out_path) and wandarr.SKIP_EXISTING:
+                if announce:
+                    self.log(f'skipping existing file {out_path}')
+                    job.status = "skipped"
+                return None
+            cnt = 1
+            while os.path.exists(out_path):
+                out_path = os.path.join(outfolder, namenoext+f'.wandarr-{job.template.name()}-{cnt}{job.template.extension()}')
+                cnt += 1
+
+        if out_path == in_path and not wandarr.OVERWRITE_SOURCE:
+            if announce:
+                self.log(f'refusing to overwrite original file')
+                job.status = "skipped"
+            return None
+
+        #
+        # build remote commandline
+        #
+        video_cli = self.qualities[job.template.video_select()] if self.qualities else self.video_cli
+        video_options = video_cli.split(" ")
+
+        stream_map = super().map_streams(job)
+
+        task = StreamingTask(job, in_path, out_path, remote_in_path, remote_out_path, self.can_pipe(job))
+        if task.piped:
+            task.cmd = ['-y', *job.template.input_options_list(), '-i', 'pipe:0',
+                        *video_options,
+                        *job.template.output_options_list(), *stream_map,
+                        '-f', PIPE_MUXERS[job.template.extension().lower()], 'pipe:1']
+        else:
+            task.cmd = ['-y', *job.template.input_options_list(), '-i', self.converted_path(remote_in_path),
+                        *video_options,
+                        *job.template.output_options_list(), *stream_map,
+                        self.converted_path(remote_out_path)]
+        task.opts_only = [*job.template.input_options_list(), *video_options,
+                          *job.template.output_options_list(), *stream_map]
+        return task
+
+    def remote_spec(self, path: str) -> str:
+        if self.props.is_windows():
+            # trick to make rsync work on the Windows side
+            path = '/' + path
+        return self.props.user + '@' + self.props.ip + ':' + path
+
+    def transfer(self, src: str, dest: str) -> bool:
+        """Copy a file to or from the host with rsync. It checks every file it writes against the source
+           by size and checksum, and keeps what arrived of an interrupted copy so the next attempt only
+           sends the rest.
+        """
+        cmd = ['rsync', '--partial', f'--timeout={TRANSFER_TIMEOUT}', *rsync_options(self.props.user, self.props.ip),
+               src, dest]
+        for attempt in range(self.props.transfer_retries + 1):
+            if attempt > 0:
+                self.log(f'transfer interrupted, resuming (attempt {attempt + 1} of {self.props.transfer_retries + 1})')
+                time.sleep(min(5 * 2 ** (attempt - 1), 60))
+            self.log(' '.join(cmd))
+            code, output = run(cmd)
+            if code == 0:
+                return True
+            if wandarr.VERBOSE:
+                self.log(output)
+            if code not in RSYNC_RETRY_CODES:
+                break
+        return False
+
+    def upload(self, task: StreamingTask) -> bool:
+        """Copy the source file to its staging name in the remote working dir"""
+        if not self.transfer(task.in_path, self.remote_spec(task.remote_in_path)):
+            self.log('Unknown error copying source to remote - media skipped', style="magenta")
+            return False
+        return True
+
+    def prefetch(self, depth: int, tasks: Dict, uploader: ThreadPoolExecutor):
+        """Reserve the next jobs for this slot and start uploading them while the current one encodes"""
+        while len(tasks) < depth:
+            job = self.dispatcher.reserve(self)
+            if job is None:
+                return
+            task = self.prepare(job, announce=False)
+            if task is not None and not task.piped:
+                task.upload = uploader.submit(self.upload, task)
+            # a job that prepared to nothing is prepared again when its turn comes, to report why
+            tasks[job] = task
+
+    def drop_released(self, tasks: Dict, current: EncodeJob, uploader: ThreadPoolExecutor):
+        """Forget prefetched jobs the dispatcher gave back to the pool, and remove their uploaded sources"""
+        kept = self.dispatcher.reserved(self)
+        for job in [job for job in tasks if job is not current and job not in kept]:
+            task = tasks.pop(job)
+            if task is not None and task.upload is not None:
+                # queued behind the upload itself
+                uploader.submit(self.remove_remote, task.remote_in_path)
+
+    def remove_remote(self, *paths: str):
+        ssh_cmd = self.ssh_cmd()
+        if self.props.is_windows():
+            paths = [path.replace("/", "\\") for path in paths]
+            if get_local_os_type() == "linux":
+                paths = [path.replace(r"\\", "\\") for path in paths]
+            self.run_process([*ssh_cmd, 'del ' + ' '.join(f'"{path}"' for path in paths)])
+        else:
+            self.run_process([*ssh_cmd, 'rm ' + ' '.join(paths)])
+
+    def retrieve_and_finish(self, task: StreamingTask, code, job_start, job_stop):
+        """Copy the result back, check it and clean up the remote working dir"""
+        job = task.job
+        remote_out_path = task.remote_out_path
+        remote_in_path = task.remote_in_path
+
+        #
+        # copy results back to local
+        #
+        # next to the final output, so moving it in place is a rename on the same filesystem
+        retrieved_copy_name = os.path.join(os.path.dirname(task.out_path), os.path.basename(remote_out_path))
+        if code == 0:
+            if not self.transfer(self.remote_spec(remote_out_path), retrieved_copy_name):
+                self.log('Unknown error retrieving encoded media from remote', style="magenta")
+                if os.path.exists(retrieved_copy_name):
+                    os.remove(retrieved_copy_name)
+                code = -1
 
         #
-        # Keep pulling items from the queue until done. Other threads will be pulling from the same queue
-        # if multiple hosts configured on the same cluster.
+        # process completed, check results and finish
         #
-        while not self.queue.empty():
-            try:
-                job: EncodeJob = self.queue.get()
-                in_path = job.in_path
-
-                #
-                # Convert escaped spaces back to normal. Typical for bash to escape spaces and special characters
-                # in filenames.
-                #
-                in_path = in_path.replace('\\ ', ' ')
-
-                #
-                # calculate full input and output paths
-                #
-                remote_working_dir = self.props.working_dir
-                remote_in_path = os.path.join(remote_working_dir, os.path.basename(in_path))
-                namenoext = '.'.join(os.path.basename(in_path).split('.')[0:-1])
-                remote_out_path = os.path.join(remote_working_dir, namenoext + '.tmp' + job.template.extension())
-                infolder = os.path.dirname(in_path)
-                outfolder = wandarr.OUTPUT_FOLDER
-                # Determine output file
-                if not outfolder:
-                    outfolder = infolder
-                else:
-                    if not os.path.exists(outfolder):
-                        os.makedirs(outfolder)
-
-                if wandarr.OVERWRITE_SOURCE:
-                    out_path = os.path.join(outfolder, namenoext+job.template.extension())
-                    if os.path.exists(out_path) and wandarr.SKIP_EXISTING:
-                        self.log(f'skipping existing file {out_path}')
+        self.finish(job, code, task.in_path, task.out_path, retrieved_copy_name, job_start, job_stop)
+        self.remove_remote(remote_out_path, remote_in_path)
+
+    def finish_in_background(self, task: StreamingTask, code, job_start, job_stop):
+        try:
+            self.retrieve_and_finish(task, code, job_start, job_stop)
+        except Exception:
+            task.job.status = "failed"
+            print(traceback.format_exc())
+        finally:
+            self.job_done(task.job)
+
+    def go(self):
+
+        # jobs to upload ahead of the current one, and so also retrieve results in the background
+        depth = 0 if wandarr.DRY_RUN else self.props.prefetch
+        tasks: Dict[EncodeJob, Optional[StreamingTask]] = {}
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self.name}-upload") as uploader, \
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self.name}-retrieve") as retriever:
+            #
+            # Keep pulling items from the queue until done. Other threads will be pulling from the same queue
+            # if multiple hosts configured on the same cluster.
+            #
+            while (job := self.next_job()) is not None:
+                background = False
+                try:
+                    self.drop_released(tasks, job, uploader)
+                    task = tasks.pop(job, None) or self.prepare(job)
+                    if task is None:
                         continue
-                else:
-                    out_path = os.path.join(outfolder, namenoext+f'.wandarr-{job.template.name()}{job.template.extension()}')
-                    if os.path.exists(out_path) and wandarr.SKIP_EXISTING:
-                        self.log(f'skipping existing file {out_path}')
+
+                    cli = [*self.ssh_cmd(), *task.cmd]
+                    basename = os.path.basename(job.in_path)
+
+                    if super().dump_job_info(job, cli):
+                        job.status = "skipped"
                         continue
-                    cnt = 1
-                    while os.path.exists(out_path):
-                        out_path = os.path.join(outfolder, namenoext+f'.wandarr-{job.template.name()}-{cnt}{job.template.extension()}')
-                        cnt += 1
-
-                if out_path == in_path and not wandarr.OVERWRITE_SOURCE:
-                    self.log(f'refusing to overwrite original file')
-                    continue
-
-                #
-                # build remote commandline
-                #
-                video_options = self.video_cli.split(" ")
-
-                stream_map = super().map_streams(job)
-
-                cmd = ['-y', *job.template.input_options_list(), '-i', self.converted_path(remote_in_path),
-                       *video_options,
-                       *job.template.output_options_list(), *stream_map,
-                       self.converted_path(remote_out_path)]
-                cli = [*ssh_cmd, *cmd]
-
-                basename = os.path.basename(job.in_path)
-
-                super().dump_job_info(job, cli)
-
-                opts_only = [*job.template.input_options_list(), *video_options,
-                             *job.template.output_options_list(), *stream_map]
-                print(f"{basename} -> ffmpeg {' '.join(opts_only)}")
-                wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
-                                      'file': basename,
-                                      'speed': '0x',
-                                      'comp': '0%',
-                                      'completed': 0,
-                                      'status': 'Copying'})
-                #
-                # Copy source file to remote
-                #
-                target_dir = remote_working_dir
-                if self.props.is_windows():
-                    # trick to make scp work on the Windows side
-                    target_dir = '/' + remote_working_dir
-
-                scp = ['rsync', in_path, self.props.user + '@' + self.props.ip + ':' + target_dir]
-                self.log(' '.join(scp))
-
-                code, output = run(scp)
-                if code != 0:
-                    self.log('Unknown error copying source to remote - media skipped', style="magenta")
-                    if wandarr.VERBOSE:
-                        self.log(output)
-                    continue
-
-                basename = os.path.basename(job.in_path)
-
-                #
-                # Start remote
-                #
-                wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
-                                      'file': basename,
-                                      'completed': 0,
-                                      'status': 'Running'})
-                job_start = datetime.datetime.now()
-                code = self.ffmpeg.run_remote(wandarr.SSH, self.props.user, self.props.ip, cmd,
-                                              super().callback_wrapper(job))
-                job_stop = datetime.datetime.now()
-
-                #
-                # copy results back to local
-                #
-                retrieved_copy_name = os.path.join(gettempdir(), os.path.basename(remote_out_path))
-                cmd = ['scp', self.props.user + '@' + self.props.ip + ':' + remote_out_path, retrieved_copy_name]
-                self.log(' '.join(cmd))
-
-                code, output = run(cmd)
-
-                #
-                # process completed, check results and finish
-                #
-                if code is None:
-                    # was vetoed by threshold checker, clean up
-                    self.complete(in_path, (job_stop - job_start).seconds)
-                    os.remove(retrieved_copy_name)
-                    continue
-
-                if code == 0:
-                    if not filter_threshold(job.template, in_path, retrieved_copy_name):
-#                        self.log(
-#                            f'Encoding file {in_path} did not meet minimum savings threshold, skipped')
-                        self.complete(in_path, (job_stop - job_start).seconds)
-                        os.remove(retrieved_copy_name)
+
+                    print(f"{basename} -> ffmpeg {' '.join(task.opts_only)}")
+                    if task.piped:
+                        #
+                        # Stream the source in and the result out while encoding
+                        #
+                        wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                                  'file': basename,
+                                                  'completed': 0,
+                                                  'status': 'Running'})
+                        retrieved_copy_name = job.tmp_name(task.out_path)
+                        job_start = datetime.datetime.now()
+                        code = self.ffmpeg.run_remote_piped(wandarr.SSH, self.props.user, self.props.ip, task.cmd,
+                                                            task.in_path, retrieved_copy_name,
+                                                            super().callback_wrapper(job))
+                        job_stop = datetime.datetime.now()
+                        if code != 0 and os.path.exists(retrieved_copy_name):
+                            os.remove(retrieved_copy_name)
+                        self.finish(job, code, task.in_path, task.out_path, retrieved_copy_name, job_start, job_stop)
                         continue
-                    self.complete(in_path, (job_stop - job_start).seconds)
-
-                    if wandarr.COPY_METADATA:
-                        exiftool = ['exiftool', '-q', '-overwrite_original', '-tagsfromfile',
-                               in_path, retrieved_copy_name]
-                        self.log(' '.join(exiftool))
-
-                        code, output = run(exiftool)
-                        if code != 0:
-                            self.log('Unknown error copying source to remote - media skipped', style="magenta")
-                            if wandarr.VERBOSE:
-                                self.log(output)
-                            continue
-                    if wandarr.VERBOSE:
-                        self.log(f'moving media to {in_path}')
-                    shutil.move(retrieved_copy_name, out_path)
-
-                elif code is not None:
-                    self.log(f'error during remote transcode of {in_path}', style="magenta")
-                    self.log(f' Did not complete normally: {self.ffmpeg.last_command}')
-                    self.log(f'Output can be found in {self.ffmpeg.log_path}')
-
-                if self.props.is_windows():
-                    remote_out_path = remote_out_path.replace("/", "\\")
-                    remote_in_path = remote_in_path.replace("/", "\\")
-                    if get_local_os_type() == "linux":
-                        remote_out_path = remote_out_path.replace(r"\\", "\\")
-                        remote_in_path = remote_in_path.replace(r"\\", "\\")
-                    self.run_process([*ssh_cmd, f'del "{remote_out_path}"'])
-                else:
-                    self.run_process([*ssh_cmd, f'rm {remote_out_path}'])
-
-            except Exception:
-                print(traceback.format_exc())
-            finally:
-                self.queue.task_done()
+
+                    wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                              'file': basename,
+                                              'speed': '0x',
+                                              'comp': '0%',
+                                              'completed': 0,
+                                              'status': 'Copying'})
+                    #
+                    # Copy source file to remote, unless that was started while the previous job encoded
+                    #
+                    uploaded = task.upload.result() if task.upload is not None else self.upload(task)
+                    if not uploaded:
+                        job.status = "failed"
+                        continue
+
+                    self.prefetch(depth, tasks, uploader)
+
+                    #
+                    # Start remote
+                    #
+                    wandarr.status_queue.put({'host': f"{self.hostname}/{self.engine_name}",
+                                              'file': basename,
+                                              'completed': 0,
+                                              'status': 'Running'})
+                    job_start = datetime.datetime.now()
+                    code = self.ffmpeg.run_remote(wandarr.SSH, self.props.user, self.props.ip, task.cmd,
+                                                  super().callback_wrapper(job))
+                    job_stop = datetime.datetime.now()
+
+                    if depth > 0 and code == 0:
+                        # the encoder is free, fetch the result while the next job starts
+                        self.dispatcher.detach(self, job)
+                        retriever.submit(self.finish_in_background, task, code, job_start, job_stop)
+                        background = True
+                        continue
+
+                    self.retrieve_and_finish(task, code, job_start, job_stop)
+
+                except Exception:
+                    job.status = "failed"
+                    print(traceback.format_exc())
+                finally:
+                    if not background:
+                        self.job_done(job)
+
+            self.drop_released(tasks, None, uploader)
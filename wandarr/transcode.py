@@ -10,11 +10,13 @@ import subprocess
 import wandarr
 
 from wandarr import __version__
-from wandarr.agent import Agent
+from wandarr.agent import Agent, parse_slots
 from wandarr.cluster import manage_cluster
 from wandarr.config import ConfigFile
+from wandarr.dispatch import ORDER_POLICIES
 from wandarr.ffmpeg import FFmpeg
 from wandarr.media import MediaInfo
+from wandarr.probecache import open_probe_cache
 from wandarr.utils import files_from_file, dump_stats
 
 DEFAULT_CONFIG = os.path.expanduser('~/.wandarr.yml')
@@ -47,6 +49,8 @@ def init_argparse() -> argparse.ArgumentParser:
     parser.add_argument('--agent', dest='agent_mode',
                         action='store_true',
                         help="Start in agent mode on a host and listen for transcode requests from other wandarr.")
+    parser.add_argument('--agent-slots', dest='agent_slots', type=parse_slots, default=None, metavar='LIMITS',
+                        help='Jobs an agent runs at once per encoder, e.g. "nvenc=3,*=2" (the default)')
     parser.add_argument('-t', dest='template', required=False,
                         action='store', help="Template name to use for transcode jobs")
     parser.add_argument('--hosts', dest='host_override',
@@ -63,6 +67,14 @@ def init_argparse() -> argparse.ArgumentParser:
                         help='Copy metadata (default)')
     parser.add_argument('--no-metadata', dest='metadata', action='store_false', 
                         help='Do not copy metadata')
+    parser.add_argument('--no-probe-cache', dest='probe_cache', action='store_false',
+                        help='Do not use or update the cache of media file details')
+    parser.add_argument('--order', dest='order', choices=list(ORDER_POLICIES), default='fifo',
+                        help='Order in which pending jobs are handed to hosts (default fifo)')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='Resume the unfinished jobs of the last batch instead of processing the given files')
+    parser.add_argument('--segment', dest='segment', type=int, metavar='SECONDS', default=None,
+                        help='Split files longer than twice this many seconds into segments encoded on several hosts (0 to disable)')
     parser.set_defaults(metadata=True)
     return parser
 
@@ -128,6 +140,8 @@ def start():
     wandarr.COPY_METADATA = args.metadata
     wandarr.OUTPUT_FOLDER = args.output_path
     wandarr.OVERWRITE_SOURCE = args.overwrite_source
+    wandarr.PROBE_CACHE = args.probe_cache
+    wandarr.JOB_ORDER = args.order
 
     if wandarr.OVERWRITE_SOURCE:
         wandarr.SKIP_EXISTING = False
@@ -144,7 +158,7 @@ def start():
             sys.exit(1)
 
     if args.agent_mode:
-        agent = Agent()
+        agent = Agent(args.agent_slots)
         agent.serve()
         sys.exit(0)
 
@@ -153,6 +167,12 @@ def start():
     if args.console:
         configfile.rich = False
 
+    # ssh on Windows has no connection sharing
+    wandarr.SSH_MULTIPLEX = configfile.ssh_multiplex and os.name != "nt"
+
+    if args.segment is not None:
+        configfile.settings['segment_length'] = args.segment
+
     if not wandarr.COPY_METADATA and configfile.settings['metadata']: wandarr.COPY_METADATA = True
 
     if args.template == '?':
@@ -160,11 +180,20 @@ def start():
               ", ".join(list(configfile.templates.keys())))
         sys.exit(0)
 
-    files = finalize_files(files, args.from_file)
     setup_host_override(args.host_override, args.local_only, configfile)
 
+    if args.resume:
+        completed: List = manage_cluster([], configfile, args.template, resume=True)
+        if len(completed) > 0:
+            dump_stats(completed)
+        sys.exit(0)
+
+    files = finalize_files(files, args.from_file)
+
     if wandarr.SHOW_INFO:
-        MediaInfo.show_info(configfile.rich, files, FFmpeg(configfile.ffmpeg_path))
+        ffmpeg = FFmpeg(configfile.ffmpeg_path)
+        ffmpeg.probe_cache = open_probe_cache(configfile)
+        MediaInfo.show_info(configfile.rich, files, ffmpeg)
         sys.exit(0)
 
     if not args.template: